@@ -1,6 +1,12 @@
-from collections import defaultdict, namedtuple
+from collections import OrderedDict, defaultdict, namedtuple
 from functools import partial
 from abc import ABCMeta, abstractmethod
+from array import array
+from bisect import bisect_right
+import copy
+from itertools import chain
+import re
+import time
 
 # Symbol, NonTerminal, Terminal are convenience classes for the symbols that compose a ParseRule
 # These classes are duck-typed, so you don't have to use the ones here
@@ -66,6 +72,11 @@ class Terminal(Symbol):
 
     is_terminal = True
 
+    #: Terminals with equal, non-``None`` match keys are assumed to always match the same tokens, so `match` is
+    #: only called for one of them at each position. ``None`` means the terminal is only equivalent to itself.
+    #: Subclasses with an expensive `match` can declare a hashable key describing what they match.
+    match_key = None
+
     def match(self, token):
         """Returns true if token is matched by this Terminal"""
         return token == self.token
@@ -81,6 +92,92 @@ class Terminal(Symbol):
         return repr(str(self.token))
 
 
+class CharacterClass(Terminal):
+    """Represents a terminal matching any single character in a set of characters and character ranges.
+    This is intended for scannerless parsing, where `parse` is given a ``str`` and each character is a token.
+
+    ``chars`` is a string of individual characters to match, and ``ranges`` is a list of inclusive
+    ``(first, last)`` character pairs. If ``negate`` is set, the class matches every other character instead."""
+    def __init__(self, chars="", ranges=(), *, negate=False, **kwargs):
+        Symbol.__init__(self, **kwargs)
+        self.token = None
+        self.negate = negate
+        spans = sorted([(ord(c), ord(c)) for c in chars] + [(ord(first), ord(last)) for first, last in ranges])
+        merged = []
+        for first, last in spans:
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        #: Tuple of inclusive ``(first, last)`` code point pairs, sorted and non-overlapping
+        self.ranges = tuple((first, last) for first, last in merged)
+        # Code points below 256 are looked up directly in a table, with negation already applied.
+        # Anything else is found by binary search over the start of each range.
+        table = bytearray([1 if negate else 0]) * 256
+        for first, last in self.ranges:
+            for code_point in range(first, min(last, 255) + 1):
+                table[code_point] = 0 if negate else 1
+        self._table = bytes(table)
+        self._starts = [first for first, last in self.ranges]
+        self._ends = [last for first, last in self.ranges]
+        self.match_key = (type(self), self.ranges, negate)
+
+    def match(self, token):
+        """Returns true if token is a single character in this class"""
+        if not isinstance(token, str) or len(token) != 1:
+            return False
+        code_point = ord(token)
+        if code_point < 256:
+            return self._table[code_point] == 1
+        i = bisect_right(self._starts, code_point) - 1
+        return (i >= 0 and code_point <= self._ends[i]) != self.negate
+
+    def __repr__(self):
+        return "CharacterClass({0!r}, negate={1!r})".format(
+            [(chr(first), chr(last)) for first, last in self.ranges], self.negate)
+
+    def __str__(self):
+        def fmt(first, last):
+            if first == last:
+                return chr(first)
+            return "{0}-{1}".format(chr(first), chr(last))
+        return "[{0}{1}]{2}".format("^" if self.negate else "",
+                                    "".join(fmt(first, last) for first, last in self.ranges),
+                                    self._specifier())
+
+
+class RegexTerminal(Terminal):
+    """Represents a terminal matching any ``str`` token that is entirely matched by a regular expression.
+
+    When tokens come from `axaxaxas.lexer.Lexer`, they are tagged with the pattern that produced them, which saves
+    matching them again. Tokens the lexer found as literals, such as keywords, never match a `RegexTerminal`."""
+    def __init__(self, pattern, flags=0, **kwargs):
+        Symbol.__init__(self, **kwargs)
+        self.token = None
+        #: The regular expression source
+        self.pattern = pattern
+        #: Flags the pattern is compiled with
+        self.flags = flags
+        self.regex = re.compile(pattern, flags)
+        self.match_key = (type(self), pattern, flags)
+
+    def match(self, token):
+        """Returns true if token is entirely matched by the pattern"""
+        kind = getattr(token, "kind", token)
+        if kind is not token:
+            if kind is None:
+                return False
+            if kind == self.pattern and token.flags == self.flags:
+                return True
+        return isinstance(token, str) and self.regex.fullmatch(token) is not None
+
+    def __repr__(self):
+        return "RegexTerminal({0!r})".format(self.pattern)
+
+    def __str__(self):
+        return "/{0}/{1}".format(self.pattern, self._specifier())
+
+
 class ParseRule:
     """Represents a single production in a context free grammar."""
     def __init__(self, head, symbols, *,
@@ -108,6 +205,8 @@ class ParseTree:
         #: Tuple of matched items, one for each symbol of `rule`. Each item
         #: is either a token, a `ParseTree`, None or a tuple.
         self.children = children or tuple()
+        # ParseTrees are immutable, so the hash is computed at most once
+        self._hash = None
 
     def extend(self, child):
         return ParseTree(self.rule, self.children + (child,))
@@ -122,11 +221,23 @@ class ParseTree:
         return id(self.rule), self.children
 
     def __hash__(self):
-        return hash(self.to_tuple())
+        if self._hash is None:
+            self._hash = hash(self.to_tuple())
+        return self._hash
 
     def __eq__(self, other):
+        if self is other:
+            return True
+        if hash(self) != hash(other):
+            return False
         return self.to_tuple() == other.to_tuple()
 
+    def __getstate__(self):
+        # The hash depends on object ids, so mustn't be kept
+        state = self.__dict__.copy()
+        state["_hash"] = None
+        return state
+
 
 class ParseError(Exception):
     """Base parse error"""
@@ -149,21 +260,164 @@ class AmbiguousParseError(ParseError):
         self.values = values
 
 class NoParseError(ParseError):
-    """Indicates there were no possible parses"""
-    def __init__(self, message, start_index, end_index, encountered, expected_terminals, expected):
+    """Indicates there were no possible parses.
+
+    Working out what was expected can be slow, so the parser passes ``describe``, a function returning the
+    message, expected_terminals and expected, in place of those values. It is called the first time any of them is
+    read, so errors that are caught and discarded cost little."""
+    def __init__(self, message, start_index, end_index, encountered, expected_terminals, expected, describe=None):
+        self._describe = describe
         super(NoParseError, self).__init__(message, start_index, end_index)
         #: The token that we failed at, or ``None`` for end of stream.
         self.encountered = encountered
-        #: List of all terminal symbols that tried and failed to match `encountered`
-        self.expected_terminals = expected_terminals
-        #: List of terminal and non-terminal symbols summarizing `expected_terminals`
-        self.expected = expected
+        self._expected_terminals = expected_terminals
+        self._expected = expected
+
+    def _load_description(self):
+        describe = self._describe
+        if describe is not None:
+            self._describe = None
+            self._message, self._expected_terminals, self._expected = describe()
+            self.args = (self._message,)
+
+    @property
+    def message(self):
+        """A text description of the error"""
+        self._load_description()
+        return self._message
+
+    @message.setter
+    def message(self, message):
+        self._message = message
+
+    @property
+    def expected_terminals(self):
+        """List of all terminal symbols that tried and failed to match `encountered`"""
+        self._load_description()
+        return self._expected_terminals
+
+    @property
+    def expected(self):
+        """List of terminal and non-terminal symbols summarizing `expected_terminals`"""
+        self._load_description()
+        return self._expected
+
+    def __str__(self):
+        return str(self.message)
+
+    def __repr__(self):
+        self._load_description()
+        return super(NoParseError, self).__repr__()
+
+    def __reduce__(self):
+        # describe refers to the chart, so send the description itself
+        return (type(self), (self.message, self.start_index, self.end_index, self.encountered,
+                             self.expected_terminals, self.expected), self.__dict__)
 
 
 class InfiniteParseError(ParseError):
     """Indicates there were infinite possible parses"""
     pass
 
+
+class ParseLimitError(ParseError):
+    """Indicates that parsing, or building from a `ParseForest`, was stopped by a `ParseLimits`"""
+    def __init__(self, message, start_index, end_index, limit, stats):
+        super(ParseLimitError, self).__init__(message, start_index, end_index)
+        #: The name of the `ParseLimits` attribute that was exceeded, or ``"cancel"``
+        self.limit = limit
+        #: `ParseStats` for the work done before stopping
+        self.stats = stats
+
+
+class ParseStats:
+    """Counts of the work done parsing"""
+    def __init__(self):
+        #: The number of tokens parsed
+        self.tokens = 0
+        #: The number of Earley items in the chart
+        self.items = 0
+        #: The number of nodes in the `ParseForest`, once it's been built
+        self.forest_nodes = 0
+        #: The number of times the rules for a predicted head were needed
+        self.rule_lookups = 0
+        #: The number of rule lookups not already memoized by this parse
+        self.rule_gets = 0
+
+    def copy(self):
+        stats = ParseStats()
+        stats.__dict__.update(self.__dict__)
+        return stats
+
+    def __repr__(self):
+        return "ParseStats({0})".format(", ".join("{0}={1!r}".format(k, v) for k, v in sorted(self.__dict__.items())))
+
+
+class ParseLimits:
+    """Optional bounds on the work done by `parse` and `ParseForest`, to guard against pathological inputs.
+    When a limit is exceeded, `ParseLimitError` is raised.
+
+    The limits are checked after each token and every 1024 Earley items while parsing, and every 1024 nodes
+    while trimming or building from a forest.
+
+    :param max_items: Maximum number of Earley items in the chart.
+    :param max_sources: Maximum number of ways any single item can be derived.
+    :param max_forest_nodes: Maximum number of nodes in a `ParseForest`.
+    :param timeout: Maximum number of seconds for each call, such as `parse`, `ParseSession.edit` or
+        `ParseForest.apply`. The clock starts again for every call, so one `ParseLimits` can be reused.
+    :param cancel: An object with an ``is_set()`` method, such as a ``threading.Event``.
+        Work stops once it returns true, which makes it possible to cancel parsing from another thread.
+    """
+    def __init__(self, *, max_items=None, max_sources=None, max_forest_nodes=None, timeout=None, cancel=None):
+        self.max_items = max_items
+        self.max_sources = max_sources
+        self.max_forest_nodes = max_forest_nodes
+        self.timeout = timeout
+        #: The ``time.monotonic()`` value after which work stops, or ``None``. This is only set on the copies
+        #: returned by `start`.
+        self.deadline = None
+        self.cancel = cancel
+
+    def start(self):
+        """Returns a copy of these limits with the clock started, for use by a single call.
+        The copy shares ``cancel``, so cancelling still stops every call."""
+        limits = copy.copy(self)
+        limits.deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        return limits
+
+    def check(self, stats, start_index, end_index):
+        """Raises `ParseLimitError` if the deadline has passed or work has been cancelled"""
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise ParseLimitError("Timed out.", start_index, end_index, "timeout", stats)
+        if self.cancel is not None and self.cancel.is_set():
+            raise ParseLimitError("Cancelled.", start_index, end_index, "cancel", stats)
+
+    def check_column(self, column, stats):
+        index = column.index
+        if self.max_items is not None and stats.items > self.max_items:
+            raise ParseLimitError("Too many items.", index, index, "max_items", stats)
+        if self.max_sources is not None:
+            for partial_rule in column.canon_rules:
+                if partial_rule.sources is not None and len(partial_rule.sources) > self.max_sources:
+                    raise ParseLimitError("Too many sources.", partial_rule.start_index, partial_rule.end_index,
+                                          "max_sources", stats)
+        self.check(stats, index, index)
+
+    def check_progress(self, column, stats):
+        """Like `check_column`, but for a column that is still being processed"""
+        index = column.index
+        stats = stats.copy()
+        stats.items += len(column.canon_rules.d)
+        stats.tokens = index
+        if self.max_items is not None and stats.items > self.max_items:
+            raise ParseLimitError("Too many items.", index, index, "max_items", stats)
+        self.check(stats, index, index)
+
+
+def _start_limits(limits):
+    # Each call gets its own deadline
+    return None if limits is None else limits.start()
+
 BuilderContext = namedtuple("BuilderContext",[
     "rule",
     "symbol_index",
@@ -191,6 +445,27 @@ meaning is specific to each method of `Builder`.
     After the last token in the relevant range of tokens.
 """
 
+ParseEvent = namedtuple("ParseEvent", [
+    "kind",
+    "context",
+    "token",
+])
+ParseEvent.__doc__ = """A single step of walking a parse tree, produced by `ParseForest.iter_events`.
+
+.. py:attribute:: kind
+
+    The name of the `Builder` method that would be called for this step: ``"start_rule"``, ``"end_rule"``,
+    ``"terminal"``, ``"skip_optional"``, ``"begin_multiple"`` or ``"end_multiple"``.
+
+.. py:attribute:: context
+
+    A `BuilderContext`, the same as would be passed to the `Builder` method.
+
+.. py:attribute:: token
+
+    The token matched, for ``"terminal"`` events, otherwise ``None``.
+"""
+
 class Builder(metaclass=ABCMeta):
     """Abstract base class for constructing parse trees and other objects from a `ParseForest`.
     See :ref:`builders` for more details."""
@@ -273,12 +548,24 @@ class CountingBuilder(Builder):
 
 
 class SingleParseTreeBuilder(Builder):
-    """Builds a single parse tree, or raises AmbiguousParseError"""
+    """Builds a single parse tree, or raises AmbiguousParseError.
+
+    If ``intern`` is set, equal subtrees are only created once, and shared. This saves memory when there are
+    several similar trees, and makes comparing or hashing trees from the same builder very fast. Tokens are
+    compared by identity, so subtrees for equal tokens at different positions, such as lexer tokens with
+    different offsets, are kept separate.
+
+    Every value passed between the methods is a `ParseTree`, a token, or a tuple for a ``star`` or ``plus``
+    symbol, so this is easy to subclass. Each child is added by copying the children before it, so a long
+    repetition takes quadratic time. `LinearParseTreeBuilder` avoids that."""
+    def __init__(self, intern=False):
+        self.interned = {} if intern else None
+
     def start_rule(self, context):
         return ParseTree(context.rule)
 
     def end_rule(self, context, prev_value):
-        return prev_value
+        return self._intern(prev_value)
 
     def terminal(self, context, token):
         return token
@@ -298,6 +585,100 @@ class SingleParseTreeBuilder(Builder):
         else:
             return prev_value.extend(extension_value)
 
+    def _intern(self, tree):
+        if self.interned is not None:
+            # Subtrees are interned already, so every child can be compared by identity. The ids stay valid, as
+            # the interned tree keeps its children alive.
+            key = (id(tree.rule), tuple(tuple(map(id, child)) if type(child) is tuple else id(child)
+                                        for child in tree.children))
+            tree = self.interned.setdefault(key, tree)
+        return tree
+
+
+class LinearParseTreeBuilder(SingleParseTreeBuilder):
+    """Builds the same trees as `SingleParseTreeBuilder`, in linear time. This is what `ParseForest.single`
+    and `ParseForest.all` use.
+
+    While a rule is in progress, its value is a ``PartialParseTree`` rather than a `ParseTree`, so that each child
+    can be added in constant time. The `ParseTree` is only created in `end_rule`. Subclasses overriding the other
+    methods can read ``prev_value.rule`` and ``prev_value.children``, and call ``extend`` and ``replace_last``,
+    but ``children`` is built afresh each time it is read, which loses the benefit."""
+    def start_rule(self, context):
+        return PartialParseTree(context.rule, None)
+
+    def end_rule(self, context, prev_value):
+        return self._intern(prev_value.finish())
+
+    def begin_multiple(self, context, prev_value):
+        return prev_value.extend(PartialMultiple(None))
+
+    def end_multiple(self, context, prev_value):
+        return prev_value.replace_last(prev_value.cons[0].finish())
+
+    def extend(self, context, prev_value, extension_value):
+        if context.rule.symbols[context.symbol_index].multiple:
+            return prev_value.replace_last(prev_value.cons[0].extend(extension_value))
+        else:
+            return prev_value.extend(extension_value)
+
+    def merge(self, context, values):
+        values = [value.finish() if isinstance(value, PartialParseTree) else value for value in values]
+        return Builder.merge(self, context, values)
+
+
+def cons_to_tuple(cons):
+    """Converts a linked list of (head, tail) pairs, in reverse order, to a tuple"""
+    items = []
+    while cons is not None:
+        head, cons = cons
+        items.append(head)
+    items.reverse()
+    return tuple(items)
+
+
+class PartialParseTree:
+    """The value of an incomplete rule in LinearParseTreeBuilder. Children are stored in ``cons``, a linked list of
+    (child, rest) pairs, most recent first. Values can be shared between several parses, so are never modified."""
+    __slots__ = ("rule", "cons")
+
+    def __init__(self, rule, cons):
+        self.rule = rule
+        self.cons = cons
+
+    @property
+    def children(self):
+        """Tuple of the children so far, as for `ParseTree.children`"""
+        children = cons_to_tuple(self.cons)
+        if children and isinstance(children[-1], PartialMultiple):
+            children = children[:-1] + (children[-1].finish(),)
+        return children
+
+    def extend(self, child):
+        return PartialParseTree(self.rule, (child, self.cons))
+
+    def replace_last(self, child):
+        return PartialParseTree(self.rule, (child, self.cons[1]))
+
+    def finish(self):
+        return ParseTree(self.rule, self.children)
+
+    def __repr__(self):
+        return repr(self.finish())
+
+
+class PartialMultiple:
+    """The matches so far of a ``star`` or ``plus`` symbol, stored the same way as PartialParseTree"""
+    __slots__ = ("cons",)
+
+    def __init__(self, cons):
+        self.cons = cons
+
+    def extend(self, child):
+        return PartialMultiple((child, self.cons))
+
+    def finish(self):
+        return cons_to_tuple(self.cons)
+
 class ListBuilder(Builder):
     """Wraps another builder, adding ambiguity support by producing lists of values"""
     def __init__(self, underlying):
@@ -440,12 +821,78 @@ def make_iter_builder(builder):
     new `Builder` that will accumulate all possible built parse trees into an iterator."""
     return IterBuilder(builder)
 
-class ParseForest:
+class BaseParseForest:
+    """Methods shared by `ParseForest` and `CompactParseForest`, implemented in terms of ``apply``."""
+    def single(self, intern=False):
+        """Returns the only `ParseTree` in the collection, or throws if there are multiple.
+        If ``intern`` is set, equal subtrees made from the same tokens are shared."""
+        return self.apply(LinearParseTreeBuilder(intern))
+
+    def all(self, intern=False):
+        """Returns a list of the contained `ParseTree` objects.
+        If ``intern`` is set, equal subtrees made from the same tokens are shared, which can save a great deal of
+        memory."""
+        return self.apply(make_list_builder(LinearParseTreeBuilder(intern)))
+
+    def count(self):
+        """Returns a count of the contained `ParseTree` objects"""
+        return self.apply(CountingBuilder())
+
+    def __iter__(self):
+        """Iterators over the list of contained `ParseTree` objects. Calling `all` is somewhat faster"""
+        thunk_iterator = self.apply(make_iter_builder(LinearParseTreeBuilder()))
+        while True:
+            cons = thunk_iterator.force()
+            if cons is None:
+                break
+            head, thunk_iterator = cons
+            yield head
+
+    def __len__(self):
+        return self.count()
+
+    def ambiguities(self):
+        """Returns a list of every point of ambiguity in the forest, without building any trees. Each is a pair
+        of ``"merge_vertical"`` or ``"merge_horizontal"``, and the `BuilderContext` that would be passed to
+        that method of a `Builder`. They are sorted by position, then by the head and priority of the rule."""
+        return sorted(self._iter_ambiguities(), key=_ambiguity_key)
+
+    def is_ambiguous(self):
+        """Returns true if there is more than one parse tree. This stops at the first ambiguity found."""
+        for ambiguity in self._iter_ambiguities():
+            return True
+        return False
+
+    def apply(self, builder):
+        """Constructs a result step at a time using the given `Builder`."""
+        raise NotImplementedError()
+
+
+def _ambiguity_key(ambiguity):
+    # A total order, as several rules can be ambiguous at the same position. Rules with the same head come from
+    # the same rule set, so have different priorities, apart from the gamma rule, which has none.
+    kind, context = ambiguity
+    return (context.start_index, context.end_index, kind, context.symbol_index, context.rule.head,
+            getattr(context.rule, "priority", 0))
+
+
+class ParseForest(BaseParseForest):
     """Represents a collection of related `ParseTree` objects."""
     # The PartialRule objects themselves already form the forest. This just adds post processing
     # to that data structure for a variety of effects, plus a nicer API.
-    def __init__(self, top_partial_rule):
+    def __init__(self, top_partial_rule, limits=None, stats=None):
         self.top_partial_rule = top_partial_rule
+        #: The `ParseLimits` checked when building from this forest, or ``None``
+        self.limits = limits
+        #: `ParseStats` from parsing
+        self.stats = stats if stats is not None else ParseStats()
+
+        # Trimming never modifies the PartialRule objects themselves, as they can be shared with
+        # a ParseSession. Instead, any node that has had links removed has its sources stored here.
+        self._trimmed = {}
+
+        # Complete PartialRules by (head, start_index, end_index), built when first needed
+        self._index = None
 
         self.dests = {}
         self._compute_dests()
@@ -456,46 +903,227 @@ class ParseForest:
 
         self._trim_loops()
 
-    def single(self):
-        """Returns the only `ParseTree` in the collection, or throws if there are multiple."""
-        return self.apply(SingleParseTreeBuilder())
-
-    def all(self):
-        """Returns a list of the contained `ParseTree` objects"""
-        return self.apply(make_list_builder(SingleParseTreeBuilder()))
-
-    def count(self):
-        """Returns a count of the contained `ParseTree` objects"""
-        return self.apply(CountingBuilder())
+        self._trim_dead()
 
     @property
     def internal_node_count(self):
         return len(self.dests)
 
-    def __iter__(self):
-        """Iterators over the list of contained `ParseTree` objects. Calling `all` is somewhat faster"""
-        thunk_iterator = self.apply(make_iter_builder(SingleParseTreeBuilder()))
-        while True:
-            cons = thunk_iterator.force()
-            if cons is None:
-                break
-            head, thunk_iterator = cons
-            yield head
-
-    def __len__(self):
-        return self.count()
+    def spans(self, head):
+        """Returns a sorted list of ``(start_index, end_index)`` for each range of tokens that the non-terminal
+        ``head`` matches in some parse tree of the forest."""
+        return sorted((start_index, end_index) for index_head, start_index, end_index in self._get_index()
+                      if index_head == head)
+
+    def subforest(self, head, start_index, end_index):
+        """Returns a `ParseForest` of just the parses of the non-terminal ``head`` between ``start_index`` and
+        ``end_index``, as they occur in this forest, or ``None`` if there are none. This is much faster than
+        building all of this forest's trees to find the relevant part."""
+        partial_rules = self._get_index().get((head, start_index, end_index))
+        if not partial_rules:
+            return None
+        # Make a new gamma rule to act as the top of the forest
+        gamma_rule = ParseRule("anon gamma", [GammaNonTerminal(head)])
+        start = PartialRule(gamma_rule, 0, 0, start_index, start_index)
+        top = PartialRule(gamma_rule, 1, 0, start_index, end_index,
+                          [(start, partial_rule) for partial_rule in partial_rules])
+        # This forest has already been trimmed, so the sub forest shares the results rather than trimming again.
+        forest = ParseForest.__new__(ParseForest)
+        forest.top_partial_rule = top
+        forest.limits = self.limits
+        forest.stats = self.stats.copy()
+        forest._trimmed = self._trimmed
+        forest._index = None
+        forest.dests = {}
+        forest._compute_dests()
+        return forest
+
+    def _get_index(self):
+        if self._index is None:
+            index = defaultdict(list)
+            stack = [self.top_partial_rule]
+            visited = set(stack)
+            while stack:
+                current = stack.pop()
+                symbols = current.rule.symbols
+                if current.is_complete and not (symbols and isinstance(symbols[0], GammaNonTerminal)):
+                    index[current.rule.head, current.start_index, current.end_index].append(current)
+                sources = self._sources(current)
+                if sources is not None:
+                    for source in chain.from_iterable(sources):
+                        if isinstance(source, PartialRule) and source not in visited:
+                            visited.add(source)
+                            stack.append(source)
+            self._index = dict(index)
+        return self._index
+
+    def _iter_ambiguities(self):
+        stack = [self.top_partial_rule]
+        visited = set(stack)
+        while stack:
+            current = stack.pop()
+            sources = self._sources(current)
+            if sources is None:
+                continue
+            extensions_by_source0 = defaultdict(list)
+            for source0, source1 in sources:
+                extensions_by_source0[id(source0), source0].append(source1)
+                for source in (source0, source1):
+                    if isinstance(source, PartialRule) and source not in visited:
+                        visited.add(source)
+                        stack.append(source)
+            rule = current.rule
+            for (_, source0), extensions in extensions_by_source0.items():
+                if len(extensions) > 1:
+                    yield ("merge_vertical",
+                           BuilderContext(rule, source0.state, source0.end_index, current.end_index))
+            if len(extensions_by_source0) > 1:
+                yield ("merge_horizontal",
+                       BuilderContext(rule, current.state, current.start_index, current.end_index))
+
+    def iter_events(self):
+        """Generates a `ParseEvent` for each step of walking the only parse tree, in document order, or
+        raises `AmbiguousParseError` when reaching any ambiguity.
+
+        No tree is built, so this can process results far larger than would fit in memory as a `ParseTree`.
+        Memory used is proportional to the number of symbols in the rules currently being walked, except that a
+        long repetition is walked in segments, using memory that grows only logarithmically with its length."""
+        top = self.top_partial_rule
+        if top.rule.symbols and isinstance(top.rule.symbols[0], GammaNonTerminal):
+            # Skip over the gamma rule
+            _, first = self._single_source(top)
+        else:
+            first = top
+        limits = _start_limits(self.limits)
+        steps = 0
+        # Stack of generators for each rule being walked
+        stack = [self._rule_events(first)]
+        while stack:
+            for event in stack[-1]:
+                if isinstance(event, PartialRule):
+                    if limits is not None:
+                        steps += 1
+                        if steps % 1024 == 0:
+                            limits.check(self.stats, event.start_index, event.end_index)
+                    stack.append(self._rule_events(event))
+                    break
+                yield event
+            else:
+                stack.pop()
+
+    def walk(self, callback):
+        """Calls ``callback(kind, context, token)`` for every `ParseEvent` of `iter_events`"""
+        for kind, context, token in self.iter_events():
+            callback(kind, context, token)
+
+    def _single_source(self, partial_rule):
+        sources = self._sources(partial_rule)
+        if len(sources) != 1:
+            prev_items = set(source0 for source0, source1 in sources)
+            if len(prev_items) == 1:
+                start_index = next(iter(prev_items)).end_index
+            else:
+                start_index = partial_rule.start_index
+            raise AmbiguousParseError("Ambiguous parse.", start_index, partial_rule.end_index, [])
+        for source in sources:
+            return source
+
+    def _rule_events(self, partial_rule):
+        # Yields the events for a completed rule, or a PartialRule for each child rule that needs walking
+        rule = partial_rule.rule
+        current, chain = self._forward_sources(partial_rule)
+        yield ParseEvent("start_rule", BuilderContext(rule, 0, current.start_index, current.end_index), None)
+        for prev_item, extension in chain:
+            next_symbol = prev_item.next_symbol
+            context = BuilderContext(rule, prev_item.state, prev_item.start_index, prev_item.end_index)
+            if next_symbol.multiple and prev_item.sub_state == 0:
+                yield ParseEvent("begin_multiple", context, None)
+            if extension is None:
+                if next_symbol.multiple:
+                    yield ParseEvent("end_multiple", context, None)
+                else:
+                    yield ParseEvent("skip_optional", context, None)
+            elif isinstance(extension, PartialRule):
+                yield extension
+            else:
+                yield ParseEvent("terminal", context, extension)
+        context = BuilderContext(rule, partial_rule.state, partial_rule.start_index, partial_rule.end_index)
+        yield ParseEvent("end_rule", context, None)
+
+    # Most sources of a rule that _forward_sources holds at once
+    _chain_block = 1024
+
+    def _forward_sources(self, partial_rule):
+        # Returns the first item of the rule, and an iterator of the single sources leading to partial_rule,
+        # in order. Sources point backwards, so they must be followed to the start of the rule first.
+        chain = []
+        current = partial_rule
+        while self._sources(current) is not None:
+            if len(chain) == self._chain_block:
+                # A long repetition, so rather than hold every source, count them and walk in segments
+                length = len(chain)
+                while self._sources(current) is not None:
+                    current = self._single_source(current)[0]
+                    length += 1
+                return current, self._segment_sources(partial_rule, length)
+            source = self._single_source(current)
+            chain.append(source)
+            current = source[0]
+        return current, reversed(chain)
+
+    def _segment_sources(self, end, length):
+        # Yields the length sources leading to end, in order, holding at most _chain_block of them per level
+        # of recursion, at the cost of walking them once per level
+        block = max(self._chain_block, 2)
+        if length <= block:
+            chain = []
+            for i in range(length):
+                source = self._single_source(end)
+                chain.append(source)
+                end = source[0]
+            yield from reversed(chain)
+            return
+        step = -(-length // block)
+        segments = []
+        while length > 0:
+            size = min(step, length)
+            segments.append((end, size))
+            for i in range(size):
+                end = self._single_source(end)[0]
+            length -= size
+        for segment_end, size in reversed(segments):
+            yield from self._segment_sources(segment_end, size)
+
+    def compact(self):
+        """Returns a `CompactParseForest` with the same contents as this forest.
+
+        The compact form stores the forest in a handful of flat arrays, so takes far less memory, and
+        doesn't keep the parse chart alive. Trimming has already been applied."""
+        return CompactParseForest(self)
 
     def apply(self, builder):
         """Constructs a result step at a time using the given `Builder`."""
+        top = self.top_partial_rule
+        if self._sources(top) is not None and not self._sources(top):
+            # Trimming left no trees at all
+            return builder.merge_horizontal(BuilderContext(top.rule, top.state, top.start_index, top.end_index), [])
         memo = {}
-        stack = [(self.top_partial_rule, True)]
+        trimmed = self._trimmed
+        limits = _start_limits(self.limits)
+        steps = 0
+        stack = [(top, True)]
         while stack:
             current_rule, first_time = stack.pop()
             if current_rule in memo:
                 continue
+            if limits is not None:
+                steps += 1
+                if steps % 1024 == 0:
+                    limits.check(self.stats, current_rule.start_index, current_rule.end_index)
+            sources = trimmed.get(current_rule, current_rule.sources)
             is_gamma = current_rule.rule.symbols and isinstance(current_rule.rule.symbols[0], GammaNonTerminal)
             if first_time:
-                if current_rule.sources is None:
+                if sources is None:
                     if is_gamma:
                         value = None
                     else:
@@ -507,7 +1135,7 @@ class ParseForest:
                     memo[current_rule] = value
                 else:
                     stack.append((current_rule, False))
-                    for source0, source1 in current_rule.sources:
+                    for source0, source1 in sources:
                         if isinstance(source0, PartialRule):
                             stack.append((source0, True))
                         if isinstance(source1, PartialRule):
@@ -515,14 +1143,16 @@ class ParseForest:
             else:
                 skip_sentinel = object()
                 values_by_source0 = defaultdict(list)
-                for source0, source1 in current_rule.sources:
+                for source0, source1 in sources:
                     if source1 is None:
                         value1 = skip_sentinel
                     else:
                         if isinstance(source1, PartialRule):
                             value1 = memo[source1]
                         else:
-                            value1 = builder.terminal(context, source1)
+                            terminal_context = BuilderContext(source0.rule, source0.state,
+                                                              source0.start_index, source0.end_index)
+                            value1 = builder.terminal(terminal_context, source1)
                     values_by_source0[id(source0), source0].append(value1)
                 values = []
                 for (_, source0), current_values in values_by_source0.items():
@@ -584,6 +1214,7 @@ class ParseForest:
             p0 = penalties.get(source0, 0) if source0 in visited else 0
             p1 = penalties.get(source1, 0) if source1 in visited else 0
             return p0 + p1
+        limits = self.limits
         while stack:
             current, first = stack.pop()
             if not isinstance(current, PartialRule):
@@ -592,22 +1223,26 @@ class ParseForest:
                 if current in visited:
                     continue
                 visited.add(current)
-                if current.sources is None:
+                if limits is not None and len(visited) % 1024 == 0:
+                    limits.check(self.stats, current.start_index, current.end_index)
+                sources = self._sources(current)
+                if sources is None:
                     penalties[current] = current.rule.penalty
                 else:
                     stack.append((current, False))
-                    for source0, source1 in current.sources:
+                    for source0, source1 in sources:
                         stack.append((source0, True))
                         stack.append((source1, True))
             else:
                 min_penalty = float("inf")
                 max_penalty = -float("inf")
-                for source0, source1 in current.sources:
+                sources = self._sources(current)
+                for source0, source1 in sources:
                     p = score_pair(source0, source1)
                     min_penalty = min(min_penalty, p)
                     max_penalty = max(max_penalty, p)
                 if min_penalty != max_penalty:
-                    for source0, source1 in list(current.sources):
+                    for source0, source1 in list(sources):
                         if score_pair(source0, source1) != min_penalty:
                             self._remove_link(source0, source1, current)
                 penalties[current] = min_penalty
@@ -620,6 +1255,7 @@ class ParseForest:
         # when walking the ParseForest to omit loops without huge amounts of book keeping
         # But who needs that feature?
 
+        limits = self.limits
         index = 0
         indices = {}
         lowlinks = {}
@@ -632,16 +1268,19 @@ class ParseForest:
             if source_iterator is None:
                 # Initialize this node
                 indices[current] = index
+                if limits is not None and index % 1024 == 1023:
+                    limits.check(self.stats, current.start_index, current.end_index)
                 # Using inf here is useful for connected components of size 1 (the common case)
                 # as we can distinguish between those with a self-loop and those without
                 lowlinks[current] = float("inf")
                 index += 1
                 short_stack.append(current)
                 short_stack_set.add(current)
-                if current.sources is None:
+                sources = self._sources(current)
+                if sources is None:
                     source_iterator = iter([])
                 else:
-                    source_iterator = (source for pair in current.sources for source in pair)
+                    source_iterator = (source for pair in sources for source in pair)
                 stack_item = current, source_iterator, parent
 
             # Either process a single item from source_iterator
@@ -658,7 +1297,7 @@ class ParseForest:
 
                 if source not in indices:
                     # Recurse (skipping leaf nodes, which are uninteresting)
-                    if isinstance(source, PartialRule) and source.sources is not None:
+                    if isinstance(source, PartialRule) and self._sources(source) is not None:
                         full_stack.append((source, None, current))
                     continue
                 elif source in short_stack_set:
@@ -691,6 +1330,7 @@ class ParseForest:
 
     def _compute_dests(self):
         """Fills in self.dests with the reverse pointers to partial_rule.sources"""
+        limits = self.limits
         stack = [(self.top_partial_rule, True)]
         while stack:
             current, is_first = stack.pop()
@@ -700,18 +1340,29 @@ class ParseForest:
                 if current in self.dests:
                     continue
                 self.dests[current] = set()
-                if current.sources is None:
+                if limits is not None and len(self.dests) % 1024 == 0:
+                    self.stats.forest_nodes = len(self.dests)
+                    if limits.max_forest_nodes is not None and len(self.dests) > limits.max_forest_nodes:
+                        raise ParseLimitError("Too many forest nodes.", current.start_index, current.end_index,
+                                              "max_forest_nodes", self.stats)
+                    limits.check(self.stats, current.start_index, current.end_index)
+                if self._sources(current) is None:
                     continue
                 stack.append((current, False))
-                for prev_item, extension in current.sources:
+                for prev_item, extension in self._sources(current):
                     stack.append((prev_item, True))
                     stack.append((extension, True))
             else:
-                for prev_item, extension in current.sources:
+                for prev_item, extension in self._sources(current):
                     self.dests[prev_item].add((current, extension))
+        self.stats.forest_nodes = len(self.dests)
+        if limits is not None and limits.max_forest_nodes is not None and len(self.dests) > limits.max_forest_nodes:
+            raise ParseLimitError("Too many forest nodes.", self.top_partial_rule.start_index,
+                                  self.top_partial_rule.end_index, "max_forest_nodes", self.stats)
 
     def _trim_greedy(self):
         """Removes any links that have a better choice available, according to greedy/lazy/prefer_early/prefer_late"""
+        limits = self.limits
         stack = [(self.top_partial_rule, True)]
         visited = set()
         while stack:
@@ -722,15 +1373,19 @@ class ParseForest:
                 if current in visited:
                     continue
                 visited.add(current)
+                if limits is not None and len(visited) % 1024 == 0:
+                    limits.check(self.stats, current.start_index, current.end_index)
                 stack.append((current, False))
-                if current.sources is not None:
-                    for source0, source1 in current.sources:
+                sources = self._sources(current)
+                if sources is not None:
+                    for source0, source1 in sources:
                         stack.append((source0, True))
                         stack.append((source1, True))
             else:
                 # Check to see if all the sources of this current
                 # Have trimmed it. If so, this node is dead.
-                if current.sources is not None and len(current.sources) == 0:
+                sources = self._sources(current)
+                if sources is not None and len(sources) == 0:
                     for next_item, extension in list(self.dests[current]):
                         self._remove_link(current, extension, next_item)
                 # Check if there's actual work
@@ -762,15 +1417,268 @@ class ParseForest:
                             if extension.rule.priority != keep_priority:
                                 self._remove_link(current, extension, next_item)
 
+    def _trim_dead(self):
+        """Removes every link to a node that trimming has left without any sources, and so has no trees.
+        Afterwards, only the top of the forest can be such a dead node."""
+        # Unlike a dead node, a node whose sources are None is the start of a rule
+        limits = self.limits
+        dead = set()
+        stack = [(self.top_partial_rule, True)]
+        visited = set()
+        while stack:
+            current, is_first = stack.pop()
+            if is_first:
+                if current in visited:
+                    continue
+                visited.add(current)
+                if limits is not None and len(visited) % 1024 == 0:
+                    limits.check(self.stats, current.start_index, current.end_index)
+                sources = self._sources(current)
+                if sources is None:
+                    continue
+                stack.append((current, False))
+                for source0, source1 in sources:
+                    stack.append((source0, True))
+                    if isinstance(source1, PartialRule):
+                        stack.append((source1, True))
+            else:
+                # Loops have already been rejected, so every source has been finished
+                sources = self._sources(current)
+                for source0, source1 in list(sources):
+                    if source0 in dead or (isinstance(source1, PartialRule) and source1 in dead):
+                        self._remove_link(source0, source1, current)
+                if not self._sources(current):
+                    dead.add(current)
+
+    def _sources(self, partial_rule):
+        return self._trimmed.get(partial_rule, partial_rule.sources)
+
     def _remove_link(self, before_partial_rule, extension, after_partial_rule, no_dest=False):
-        after_partial_rule.sources.remove((before_partial_rule, extension))
+        sources = self._trimmed.get(after_partial_rule)
+        if sources is None:
+            sources = self._trimmed[after_partial_rule] = set(after_partial_rule.sources)
+        sources.remove((before_partial_rule, extension))
         if not no_dest:
             self.dests[before_partial_rule].remove((after_partial_rule, extension))
 
 
+# Marks nodes of a CompactParseForest that have no trees, because trimming removed all their sources
+_DEAD = object()
+
+
+class CompactParseForest(BaseParseForest):
+    """A read-only `ParseForest` packed into flat arrays. Create one with `ParseForest.compact`.
+
+    Each internal node of the forest is numbered, in an order where every node comes after all of its sources,
+    so the forest can be evaluated with a single pass over the arrays. Node ``i`` is an item for rule
+    ``rules[node_rule[i]]``, and its sources are the pairs ``(source_prev[j], source_extension[j])`` for ``j``
+    between ``source_offsets[i]`` and ``source_offsets[i + 1]``. Nodes without any sources are the start of a rule.
+    A non-negative extension is another node, ``-1`` indicates an optional symbol was skipped, and any other value
+    ``-2 - n`` is the ``n`` th token of the input, stored in `tokens`.
+
+    The last node is the top of the forest, unless trimming left no trees at all, in which case there are no nodes.
+    Unlike `ParseForest`, instances are small, and can be pickled."""
+    def __init__(self, forest):
+        #: The `ParseLimits` checked when building from this forest, or ``None``
+        self.limits = forest.limits
+        #: `ParseStats` from parsing
+        self.stats = forest.stats
+        #: The `ParseRule` objects referenced by the nodes
+        self.rules = []
+        #: The input tokens, by index
+        self.tokens = [None] * forest.top_partial_rule.end_index
+
+        rule_ids = {}
+        node_ids = {}
+        self.node_rule = array("l")
+        self.node_state = array("l")
+        self.node_sub_state = array("l")
+        self.node_start = array("l")
+        self.node_end = array("l")
+        self.source_offsets = array("l", [0])
+        self.source_prev = array("l")
+        self.source_extension = array("l")
+
+        stack = [(forest.top_partial_rule, True)]
+        while stack:
+            current, first_time = stack.pop()
+            if first_time:
+                if current in node_ids:
+                    continue
+                # Placeholder, so loops are not followed twice. Loops have already been rejected by ParseForest.
+                node_ids[current] = None
+                stack.append((current, False))
+                sources = forest._sources(current)
+                if sources is not None:
+                    for source0, source1 in sources:
+                        stack.append((source0, True))
+                        if isinstance(source1, PartialRule):
+                            stack.append((source1, True))
+                continue
+            sources = forest._sources(current)
+            if sources is not None and not sources:
+                # Trimming removed every source, so there are no trees. ParseForest has already removed the links
+                # to such nodes, so this can only be the top.
+                node_ids[current] = _DEAD
+                continue
+            rule_id = rule_ids.get(current.rule)
+            if rule_id is None:
+                rule_id = rule_ids[current.rule] = len(self.rules)
+                self.rules.append(current.rule)
+            node_ids[current] = len(self.node_rule)
+            self.node_rule.append(rule_id)
+            self.node_state.append(current.state)
+            self.node_sub_state.append(current.sub_state)
+            self.node_start.append(current.start_index)
+            self.node_end.append(current.end_index)
+            if sources is not None:
+                for source0, source1 in sources:
+                    self.source_prev.append(node_ids[source0])
+                    if source1 is None:
+                        self.source_extension.append(-1)
+                    elif isinstance(source1, PartialRule):
+                        self.source_extension.append(node_ids[source1])
+                    else:
+                        self.tokens[source0.end_index] = source1
+                        self.source_extension.append(-2 - source0.end_index)
+            self.source_offsets.append(len(self.source_prev))
+        top = forest.top_partial_rule
+        # Context of the empty merge that apply makes when there are no trees
+        self._empty_context = None
+        if node_ids[top] is _DEAD:
+            self._empty_context = BuilderContext(top.rule, top.state, top.start_index, top.end_index)
+            self.rules = []
+            for name in ["node_rule", "node_state", "node_sub_state", "node_start", "node_end", "source_prev",
+                         "source_extension"]:
+                setattr(self, name, array("l"))
+            self.source_offsets = array("l", [0])
+
+    @property
+    def internal_node_count(self):
+        return len(self.node_rule)
+
+    def spans(self, head):
+        """Returns a sorted list of ``(start_index, end_index)`` for each range of tokens that the non-terminal
+        ``head`` matches in some parse tree of the forest, as for `ParseForest.spans`."""
+        spans = set()
+        for current in range(len(self.node_rule)):
+            rule = self.rules[self.node_rule[current]]
+            if rule.head == head and self.node_state[current] == len(rule.symbols) and \
+                    not (rule.symbols and isinstance(rule.symbols[0], GammaNonTerminal)):
+                spans.add((self.node_start[current], self.node_end[current]))
+        return sorted(spans)
+
+    def _iter_ambiguities(self):
+        # Every node is reachable, so this is just a scan over the arrays
+        source_offsets = self.source_offsets
+        source_prev = self.source_prev
+        for current in range(len(self.node_rule)):
+            offset, end_offset = source_offsets[current], source_offsets[current + 1]
+            if end_offset - offset < 2:
+                continue
+            rule = self.rules[self.node_rule[current]]
+            counts = defaultdict(int)
+            for i in range(offset, end_offset):
+                counts[source_prev[i]] += 1
+            for source0, count in counts.items():
+                if count > 1:
+                    yield ("merge_vertical",
+                           BuilderContext(rule, self.node_state[source0], self.node_end[source0],
+                                          self.node_end[current]))
+            if len(counts) > 1:
+                yield ("merge_horizontal",
+                       BuilderContext(rule, self.node_state[current], self.node_start[current],
+                                      self.node_end[current]))
+
+    def apply(self, builder):
+        """Constructs a result step at a time using the given `Builder`."""
+        rules = self.rules
+        tokens = self.tokens
+        node_rule = self.node_rule
+        node_state = self.node_state
+        node_sub_state = self.node_sub_state
+        node_start = self.node_start
+        node_end = self.node_end
+        source_offsets = self.source_offsets
+        source_prev = self.source_prev
+        source_extension = self.source_extension
+        limits = _start_limits(self.limits)
+        if self._empty_context is not None:
+            return builder.merge_horizontal(self._empty_context, [])
+        skip_sentinel = object()
+        memo = [None] * len(node_rule)
+        for current in range(len(node_rule)):
+            if limits is not None and current % 1024 == 1023:
+                limits.check(self.stats, node_start[current], node_end[current])
+            rule = rules[node_rule[current]]
+            state = node_state[current]
+            is_gamma = rule.symbols and isinstance(rule.symbols[0], GammaNonTerminal)
+            is_complete = len(rule.symbols) == state
+            offset, end_offset = source_offsets[current], source_offsets[current + 1]
+            if offset == end_offset:
+                if is_gamma:
+                    value = None
+                else:
+                    context = BuilderContext(rule, 0, node_start[current], node_end[current])
+                    value = builder.start_rule(context)
+                    if is_complete:
+                        context = BuilderContext(rule, state, node_start[current], node_end[current])
+                        value = builder.end_rule(context, value)
+                memo[current] = value
+                continue
+            values_by_source0 = defaultdict(list)
+            for i in range(offset, end_offset):
+                values_by_source0[source_prev[i]].append(source_extension[i])
+            values = []
+            for source0, extensions in values_by_source0.items():
+                value0 = memo[source0]
+                symbol_index = node_state[source0]
+                next_symbol = rule.symbols[symbol_index]
+                context = BuilderContext(rule, symbol_index, node_start[source0], node_end[source0])
+                if next_symbol.multiple and node_sub_state[source0] == 0:
+                    # This was the first call to skip/extend, need to actually create the array
+                    value0 = builder.begin_multiple(context, value0)
+
+                if extensions[0] == -1:
+                    assert len(extensions) == 1
+                    if next_symbol.multiple:
+                        value = builder.end_multiple(context, value0)
+                    else:
+                        value = builder.skip_optional(context, value0)
+                else:
+                    current_values = []
+                    for extension in extensions:
+                        assert extension != -1
+                        if extension >= 0:
+                            current_values.append(memo[extension])
+                        else:
+                            current_values.append(builder.terminal(context, tokens[-2 - extension]))
+                    if len(current_values) == 1:
+                        value = current_values[0]
+                    else:
+                        merge_context = BuilderContext(rule, symbol_index, node_end[source0], node_end[current])
+                        value = builder.merge_vertical(merge_context, current_values)
+                    if not is_gamma:
+                        value = builder.extend(context, value0, value)
+                values.append(value)
+            if len(values) == 1:
+                value = values[0]
+            else:
+                assert not is_gamma
+                context = BuilderContext(rule, state, node_start[current], node_end[current])
+                value = builder.merge_horizontal(context, values)
+            if is_complete and not is_gamma:
+                context = BuilderContext(rule, state, node_start[current], node_end[current])
+                value = builder.end_rule(context, value)
+            memo[current] = value
+        return memo[-1]
+
+
 class PartialRule:
     """Represents partial parse of a specified rule, plus some bookkeeping info.
      This is often called an Earley Item in the literature"""
+    # There are a great many of these, so they are kept small
+    __slots__ = ("rule", "state", "sub_state", "start_index", "end_index", "sources")
 
     def __init__(self, rule, state, sub_state, start_index, end_index, sources=None):
         self.rule = rule
@@ -778,7 +1686,8 @@ class PartialRule:
         self.sub_state = sub_state
         self.start_index = start_index
         self.end_index = end_index
-        # Set of pairs of (prev_state, extension)
+        # List of distinct pairs of (prev_state, extension), or None for a newly predicted rule.
+        # Most items only have one, and a list of one is much smaller than a set.
         # This is the only mutable part of PartialRule
         self.sources = sources
 
@@ -795,12 +1704,10 @@ class PartialRule:
             next_sub_state = self.sub_state + 1
             if next_sub_state > self.next_symbol.min_occurs:
                 next_sub_state = self.next_symbol.min_occurs
-            # This is a hack. In principle there is nothing wrong with
-            # not stepping next_sub_state for star rules - it's not used.
-            # But in practise doing so can generate loops in the grammar which
-            # are awkward to represent in the graph of partial_rules.
-            # It's mostly harmless to have a few extra states as we'll just
-            # miss a few memoization opportunities.
+            # For star symbols, sub_state still records that there has been at least one match.
+            # Otherwise an empty match at the start of a rule would give the newly predicted PartialRule
+            # (which has no sources) a loop back to itself. Further matches stay in sub_state 1, so
+            # a repetition still needs only one PartialRule per match, and begin_multiple is easy to place.
             if next_sub_state == 0:
                 next_sub_state = 1
             return PartialRule(self.rule,
@@ -808,14 +1715,14 @@ class PartialRule:
                                next_sub_state,
                                self.start_index,
                                end_index,
-                               set([(self, token_or_partial_rule)]))
+                               [(self, token_or_partial_rule)])
         else:
             return PartialRule(self.rule,
                                self.state + 1,
                                0,
                                self.start_index,
                                end_index,
-                               set([(self, token_or_partial_rule)]))
+                               [(self, token_or_partial_rule)])
 
     def skip(self):
         if self.next_symbol.multiple:
@@ -827,7 +1734,7 @@ class PartialRule:
                                0,
                                self.start_index,
                                self.end_index,
-                               set([(self, None)]))
+                               [(self, None)])
         else:
             assert self.next_symbol.optional
             return PartialRule(self.rule,
@@ -835,7 +1742,7 @@ class PartialRule:
                                0,
                                self.start_index,
                                self.end_index,
-                               set([(self, None)]))
+                               [(self, None)])
 
     def __repr__(self):
         return repr(
@@ -853,8 +1760,18 @@ class PartialRule:
 
 class ParseRuleSet:
     """Stores a set of `ParseRule`, with fast retrieval by rule head"""
+    #: If true, `parse` calls `get` at most once per head, rather than each time the head is predicted.
+    #: Subclasses should set this false if `get` can return different rules for the same head during a parse.
+    memoize_get = True
+
     def __init__(self):
         self._rules = defaultdict(list)
+        #: Incremented whenever the rules change, so that cached results can be discarded
+        self.version = 0
+        #: An optional `MatchCache`, remembering which tokens each terminal matches across all parses
+        self.match_cache = None
+        #: An optional `RuleCache`, remembering the results of `get` across all parses
+        self.rule_cache = None
 
     def get(self, head, lookahead_token=None):
         """Returns a list of `ParseRule` objects with matching head"""
@@ -864,11 +1781,270 @@ class ParseRuleSet:
         """Adds a new `ParseRule` to the set"""
         self._rules[rule.head].append(rule)
         rule.priority = len(self._rules[rule.head])
+        self.version += 1
+
+    def __iter__(self):
+        """Iterates over every `ParseRule` that has been added"""
+        for rules in self._rules.values():
+            yield from rules
 
     def is_anonymous(self, head):
         """Returns true if a given head symbol should be omitted from error reporting"""
         return False
 
+    def freeze(self):
+        """Returns a `FrozenParseRuleSet` with the rules added so far, which is safe to share between threads.
+        Later changes to this rule set do not affect it.
+
+        Only the rules are copied, so subclasses that override `get` or `is_anonymous` should override this too."""
+        return FrozenParseRuleSet(self)
+
+
+class FrozenParseRuleSet(ParseRuleSet):
+    """An immutable snapshot of a `ParseRuleSet`, returned by `ParseRuleSet.freeze`.
+
+    Parsing never modifies a frozen rule set or its rules, so any number of threads can call `parse` with it
+    at the same time. The `ParseRule` objects are shared with the original rule set, so should not be changed
+    either. A frozen rule set has no `match_cache` or `rule_cache`, as they are updated while parsing. If you
+    set them anyway, or share a `Vocabulary` between threads, you are responsible for any locking they need."""
+    def __init__(self, rule_set):
+        # Rules are stored as tuples, so get can return them directly without risk of them being changed
+        self._rules = dict((head, tuple(rules)) for head, rules in rule_set._rules.items() if rules)
+        self.version = rule_set.version
+        self.match_cache = None
+        self.rule_cache = None
+
+    def get(self, head, lookahead_token=None):
+        """Returns a tuple of `ParseRule` objects with matching head"""
+        # Unlike ParseRuleSet, missing heads aren't inserted, so this never modifies the rule set
+        return self._rules.get(head, ())
+
+    def add(self, rule):
+        """Raises ``TypeError``, as frozen rule sets cannot be changed"""
+        raise TypeError("Cannot add rules to a FrozenParseRuleSet")
+
+    def freeze(self):
+        """Returns self, as this is already frozen"""
+        return self
+
+
+class MatchCache:
+    """Remembers the results of `Terminal.match` for each terminal and token, for grammars where matching is
+    expensive and the same tokens occur repeatedly. Set it as `ParseRuleSet.match_cache` to use it.
+
+    Terminals are identified by their `match_key`, or themselves if they don't have one, and tokens must
+    be hashable. If ``maxsize`` is set, the cache is emptied whenever it grows larger."""
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        #: Number of matches found in the cache
+        self.hits = 0
+        #: Number of calls to `Terminal.match`
+        self.misses = 0
+        self._results = {}
+
+    @property
+    def hit_rate(self):
+        """The fraction of matches found in the cache"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def match(self, symbol, token):
+        """Returns whether ``symbol`` matches ``token``, calling ``symbol.match`` if it isn't known"""
+        key = getattr(symbol, "match_key", None)
+        if key is None:
+            key = symbol
+        cache_key = (key, token)
+        result = self._results.get(cache_key)
+        if result is None:
+            self.misses += 1
+            result = bool(symbol.match(token))
+            if self.maxsize is not None and len(self._results) >= self.maxsize:
+                self._results.clear()
+            self._results[cache_key] = result
+        else:
+            self.hits += 1
+        return result
+
+    def clear(self):
+        """Forgets all results"""
+        self._results.clear()
+
+
+class RuleCache:
+    """Remembers the results of `ParseRuleSet.get` for each head, for rule sets that generate their rules
+    on the fly. Set it as `ParseRuleSet.rule_cache` to use it. It is only used if `ParseRuleSet.memoize_get`
+    is true.
+
+    Results are discarded when `ParseRuleSet.version` changes. If ``maxsize`` is set, the least recently used
+    results are discarded to keep that many."""
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        #: Number of lookups found in the cache
+        self.hits = 0
+        #: Number of calls to `ParseRuleSet.get`
+        self.misses = 0
+        self._rules = OrderedDict()
+        self._version = None
+
+    @property
+    def hit_rate(self):
+        """The fraction of lookups found in the cache"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, rule_set, head):
+        """Returns a list of the rules of ``rule_set`` with matching head, calling ``rule_set.get`` if it isn't known"""
+        version = getattr(rule_set, "version", None)
+        if version != self._version:
+            self._rules.clear()
+            self._version = version
+        rules = self._rules.get(head)
+        if rules is None:
+            self.misses += 1
+            rules = _as_rule_list(rule_set.get(head))
+            self._rules[head] = rules
+            if self.maxsize is not None and len(self._rules) > self.maxsize:
+                self._rules.popitem(last=False)
+        else:
+            self.hits += 1
+            self._rules.move_to_end(head)
+        return rules
+
+    def clear(self):
+        """Forgets all results"""
+        self._rules.clear()
+
+
+def _as_rule_list(rules):
+    # get can return any iterable, but memoized results are iterated repeatedly
+    if isinstance(rules, (list, tuple)):
+        return rules
+    return list(rules)
+
+
+class Vocabulary:
+    """Assigns a small integer id to each distinct token, so that `parse` can look up plain `Terminal` objects
+    by id, rather than comparing each against the token. Predicted rules that start with a plain `Terminal` are
+    only created if the next token has the right id. `CharacterClass` terminals are looked up by character, so
+    all of those waiting at a position are matched at once. Other terminals still have `Terminal.match` called.
+
+    ``tokens`` are the initial tokens, which are given ids in order starting at zero. Tokens must be hashable."""
+    def __init__(self, tokens=()):
+        #: List of tokens, indexed by id
+        self.tokens = []
+        #: Dict of ids, keyed by token
+        self.ids = {}
+        # Token id and CharacterClass id (or None) of each terminal seen by _index_terminals, keyed by id
+        self._symbol_ids = {}
+        # Small integer ids for each distinct CharacterClass, keyed by match_key
+        self._class_ids = {}
+        # Cached results of _split_rules, keyed by head
+        self._rule_splits = {}
+        # For each combination of CharacterClass ids seen by _index_terminals, a dict from characters
+        # to the positions of the classes matching them, filled in as characters are scanned
+        self._class_tables = {}
+        for token in tokens:
+            self.add(token)
+
+    @classmethod
+    def from_rule_set(cls, rule_set):
+        """Returns a `Vocabulary` of the tokens of every plain `Terminal` in ``rule_set``"""
+        vocabulary = cls()
+        for rule in rule_set:
+            for symbol in rule.symbols:
+                if vocabulary._is_plain(symbol):
+                    vocabulary.add(symbol.token)
+        return vocabulary
+
+    def add(self, token):
+        """Returns the id of ``token``, giving it a new one if necessary"""
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def encode(self, tokens):
+        """Returns a list of ids for ``tokens``, or -1 for tokens not in the vocabulary"""
+        ids = self.ids
+        return [ids.get(token, -1) for token in tokens]
+
+    def decode(self, token_ids):
+        """Returns a list of tokens for a sequence of ids"""
+        tokens = self.tokens
+        return [tokens[token_id] for token_id in token_ids]
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def _split_rules(self, head, rules):
+        # Splits predicted rules into a list of those that must be created eagerly, and a dict keyed by token id of
+        # those starting with a plain Terminal, which scan only creates if the token matches.
+        # ParseRuleSet.get returns the same list for each head, so the split is usually cached.
+        entry = self._rule_splits.get(head)
+        if entry is not None and entry[0] is rules and entry[1] == len(rules):
+            return entry[2], entry[3]
+        eager = []
+        by_id = {}
+        for rule in rules:
+            symbols = rule.symbols
+            if symbols and self._is_plain(symbols[0]) and not (symbols[0].optional or symbols[0].multiple):
+                by_id.setdefault(self.add(symbols[0].token), []).append(rule)
+            else:
+                eager.append(rule)
+        if isinstance(rules, (list, tuple)):
+            self._rule_splits[head] = (rules, len(rules), eager, by_id)
+        return eager, by_id
+
+    def _index_terminals(self, partial_rules):
+        # Splits PartialRules waiting on a terminal into a dict of plain Terminals by token id, a pair of the
+        # character table and the list of (class, partial rules) groups for CharacterClasses (or None), and a list
+        # of the rest
+        by_id = {}
+        class_groups = {}
+        others = []
+        symbol_ids = self._symbol_ids
+        for partial_rule in partial_rules:
+            symbol = partial_rule.rule.symbols[partial_rule.state]
+            entry = symbol_ids.get(id(symbol))
+            if entry is None:
+                # The symbol is kept in the entry so its id is not reused
+                token_id = self.add(symbol.token) if self._is_plain(symbol) else None
+                class_id = None
+                if getattr(type(symbol), "match", None) is CharacterClass.match:
+                    class_id = self._class_ids.setdefault(symbol.match_key, len(self._class_ids))
+                entry = symbol_ids[id(symbol)] = (symbol, token_id, class_id)
+            token_id = entry[1]
+            if token_id is None:
+                class_id = entry[2]
+                if class_id is None:
+                    others.append(partial_rule)
+                elif class_id in class_groups:
+                    class_groups[class_id][1].append(partial_rule)
+                else:
+                    class_groups[class_id] = (symbol, [partial_rule])
+            elif token_id in by_id:
+                by_id[token_id].append(partial_rule)
+            else:
+                by_id[token_id] = [partial_rule]
+        by_char = None
+        if class_groups:
+            # Scannerless grammars wait on the same few combinations of classes over and over,
+            # so the table is shared by every column with the same combination
+            by_char = (self._class_tables.setdefault(tuple(class_groups), {}), list(class_groups.values()))
+        return by_id, by_char, others
+
+    @staticmethod
+    def _is_plain(symbol):
+        # Terminals that match by equality, so can be matched by id instead
+        if getattr(type(symbol), "match", None) is not Terminal.match:
+            return False
+        try:
+            hash(symbol.token)
+        except TypeError:
+            return False
+        return True
+
 
 class PartialRuleSet:
     # Behaves like a set, only it will merge sources,
@@ -885,7 +2061,8 @@ class PartialRuleSet:
             if canon_rule.sources is None:
                 assert partial_rule.sources is None
             else:
-                canon_rule.sources.update(partial_rule.sources)
+                # Each pair is only ever derived once, so there are no duplicates to check for
+                canon_rule.sources.extend(partial_rule.sources)
             return None
 
     def __iter__(self):
@@ -902,21 +2079,48 @@ class GammaNonTerminal:
     prefer_early = False
     prefer_late = False
 
+def iter_unparse(parse_tree):
+    """Generates the tokens of a `ParseTree` in order. Unlike `unparse`, no lists are built, and
+    trees of any depth can be handled."""
+    # Stack of iterators over the children of each tree being visited
+    stack = [iter((parse_tree,))]
+    while stack:
+        for child in stack[-1]:
+            if isinstance(child, ParseTree):
+                stack.append(iter(child.children))
+                break
+            if isinstance(child, (tuple, list)):
+                stack.append(iter(child))
+                break
+            if child is not None:
+                yield child
+        else:
+            stack.pop()
+
+
 def unparse(parse_tree):
     """Converts a `ParseTree` back to a list of tokens"""
-    if isinstance(parse_tree, (tuple, list)):
-        results = []
-        for r in map(unparse, parse_tree):
-            results.extend(r)
-        return results
-    if parse_tree is None:
-        return []
-    if not isinstance(parse_tree, ParseTree):
-        return [parse_tree]
-    results = []
-    for child in parse_tree.children:
-        results.extend(unparse(child))
-    return results
+    return list(iter_unparse(parse_tree))
+
+
+def unparse_to(parse_tree, file, separator=""):
+    """Writes the tokens of a `ParseTree` to a file-like object, converting each to ``str`` and putting
+    ``separator`` between them. Like `iter_unparse`, this works on trees of any size."""
+    chunk = []
+    first = True
+    for token in iter_unparse(parse_tree):
+        chunk.append(str(token))
+        # Writing in chunks is much faster than writing each token
+        if len(chunk) == 1024:
+            if not first:
+                file.write(separator)
+            file.write(separator.join(chunk))
+            chunk = []
+            first = False
+    if chunk:
+        if not first:
+            file.write(separator)
+        file.write(separator.join(chunk))
 
 # The code below is a modified Earley Parser.
 # 1) The parse tree is not built from the table, it's built in the PartialRules themselves,
@@ -932,130 +2136,579 @@ def unparse(parse_tree):
 #    the set used for completion rules is still being written to), by storing completed items in a separate
 #    structure. Aycock and Horspool's solution is much neater, but requires pre-computation.
 #      Aycock & Horspool "Practical Earley Parsing", The Computer Journal, Vol. 45, No. 6, 2002
+# 4) The chart is a list of Column objects, one per position in the token stream. Processing a column only
+#    creates PartialRules that end at that column, and scanning a token only creates PartialRules in the next column.
+#    So once a column has been processed it is never modified again, and can be shared freely. This is what
+#    ParseSession uses to reparse and fork without redoing work.
 #
 # TODO: Apply this optimization? http://loup-vaillant.fr/tutorials/earley-parsing/right-recursion
 
-def parse(rule_set, head, tokens, *, fail_if_empty=True):
-    """Parses a stream of ``tokens`` according to the grammer in ``rule_set`` by attempting to match
-    the non-terminal specified by ``head``."""
-    # Returns a PartialRule that represents a parse forest
-
-    token_stream = list(tokens)
-
-    # We enforce single object identify amongst PartialRules
-    # so that we can keep references to them in sources
-    # and update those references
-    canon_rules = [PartialRuleSet()]
-
-    def make_canon(partial_rule):
-        return canon_rules[partial_rule.end_index].add(partial_rule)
-
-    # List of dict of suspended rules keyd by what they are waiting for
-    pending_rules = []
-    # List of dict of completed rules keyd by their head
-    completed_rules = []
-    # We start with a fake rule called gamma that matches head
-    # This awkwardness is because we don't otherwise have an object for
-    # "all the rules with the starting head"
-    gamma_rule = ParseRule("anon gamma", [GammaNonTerminal(head)])
-    current_rules = set([make_canon(PartialRule(gamma_rule, 0, 0, 0, 0))])
-    # Likewise we need a fake token at the end
-    # Because one more loop is required to close all the objects
-    end_sentinel = object()
-
-    next_rules = set()
-    final_state = None
-    for index, token in enumerate(token_stream + [end_sentinel]):
-        pending_rules.append(defaultdict(list))
-        completed_rules.append(defaultdict(list))
-        canon_rules.append(PartialRuleSet())
-        terminal_partial_rules = []
-        while current_rules:
-            partial_rule = current_rules.pop()
-            if partial_rule is None:
-                continue
+class Column:
+    """All the PartialRules ending at a single position in the token stream.
+    This is often called an Earley Set in the literature"""
+    __slots__ = ("index", "canon_rules", "new_rules", "pending_rules", "terminal_partial_rules", "final_state",
+                 "item_count", "exits", "expected_terminals", "terminal_index", "lazy_rules")
+
+    def __init__(self, index):
+        self.index = index
+        # We enforce single object identify amongst PartialRules
+        # so that we can keep references to them in sources
+        # and update those references
+        self.canon_rules = PartialRuleSet()
+        # PartialRules that still need processing
+        self.new_rules = []
+        # Dict of suspended rules keyed by the head they are waiting for
+        self.pending_rules = defaultdict(list)
+        # PartialRules waiting for a terminal
+        self.terminal_partial_rules = []
+        # The completed gamma rule, if the tokens so far are a complete parse
+        self.final_state = None
+        # The number of PartialRules ending at this column
+        self.item_count = 0
+        # Cached results of expected_exits, and ParseSession.expected_terminals
+        self.exits = None
+        self.expected_terminals = None
+        # Cached result of Vocabulary._index_terminals for terminal_partial_rules
+        self.terminal_index = None
+        # Predicted rules starting with a plain Terminal, not yet created. Dict keyed by head of dicts keyed by token id
+        self.lazy_rules = {}
+
+    def add(self, partial_rule):
+        canon_rule = self.canon_rules.add(partial_rule)
+        if canon_rule is not None:
+            self.new_rules.append(canon_rule)
+
+    def process(self, chart):
+        """Runs prediction, completion and skipping to a fixed point. chart.columns must end with self"""
+        index = self.index
+        columns = chart.columns
+        rule_set = chart.rule_set
+        gamma_rule = chart.gamma_rule
+        add = self.add
+        new_rules = self.new_rules
+        pending_rules = self.pending_rules
+        terminal_partial_rules = self.terminal_partial_rules
+        vocabulary = chart.vocabulary
+        lazy_rules = self.lazy_rules
+        limits = chart.limits
+        steps = 0
+        # Dict of rules completed without consuming any tokens, keyed by their head
+        completed_rules = defaultdict(list)
+        while new_rules:
+            partial_rule = new_rules.pop()
+            if limits is not None:
+                steps += 1
+                if steps % 1024 == 0:
+                    try:
+                        limits.check_progress(self, chart.stats)
+                    except ParseLimitError:
+                        # A half processed column can't be extended, so drop it from the chart
+                        columns.pop()
+                        raise
             if partial_rule.is_complete:
                 # Completion
-                if token is end_sentinel and partial_rule.rule is gamma_rule and partial_rule.start_index == 0:
-                    # Don't return immediately when we've found the final state
+                head = partial_rule.rule.head
+                if partial_rule.rule is gamma_rule:
+                    # Don't stop when we've found the final state
                     # as there may be more completions filling in sources
-                    final_state = partial_rule
-                for progressed_rule in pending_rules[partial_rule.start_index][partial_rule.rule.head]:
-                    current_rules.add(make_canon(progressed_rule.extend(partial_rule, index)))
+                    self.final_state = partial_rule
+                for progressed_rule in columns[partial_rule.start_index].pending_rules[head]:
+                    add(progressed_rule.extend(partial_rule, index))
                 if partial_rule.start_index == index:
-                    completed_rules[partial_rule.start_index][partial_rule.rule.head].append(partial_rule)
+                    completed_rules[head].append(partial_rule)
             else:
                 symbol = partial_rule.next_symbol
-                # Some head's are considered "anonymous" and we expand them instead of reporting them.
-                # TODO: empty is here as a quick hack. Need to figure out how to give sensible reporting for any
-                # possibly empty rule
                 if not symbol.is_terminal:
                     # Prediction
                     head = symbol.head
-                    pending_rules[-1][head].append(partial_rule)
-                    for rule in rule_set.get(head):
-                        current_rules.add(make_canon(PartialRule(rule, 0, 0, index, index)))
-                    for completed_rule in completed_rules[index][head]:
+                    pending_rules[head].append(partial_rule)
+                    rules = chart.get_rules(head)
+                    if vocabulary is not None:
+                        rules, lazy_rules[head] = vocabulary._split_rules(head, rules)
+                    for rule in rules:
+                        add(PartialRule(rule, 0, 0, index, index))
+                    for completed_rule in completed_rules[head]:
                         assert completed_rule.end_index == index
-                        current_rules.add(make_canon(partial_rule.extend(completed_rule, completed_rule.end_index)))
-                elif symbol.is_terminal:
-                    # Scanning
-                    if token is not end_sentinel and symbol.match(token):
-                        next_rules.add(make_canon(partial_rule.extend(token, index + 1)))
+                        add(partial_rule.extend(completed_rule, completed_rule.end_index))
+                else:
+                    # Scanning happens later, in scan
                     terminal_partial_rules.append(partial_rule)
                 # Skipping
                 if symbol.optional or symbol.multiple:
                     skipped = partial_rule.skip()
                     if skipped is not None:
-                        current_rules.add(make_canon(skipped))
-        current_rules, next_rules = next_rules, set()
-        if len(current_rules) == 0 and final_state is None:
-            if token is end_sentinel and not fail_if_empty:
-                return ParseForest(PartialRule(ParseRule("gamma", []), 0, 0, 0, 0))
-
-            # We have a list of all terminals that were evaluated,
-            # But we can give higher level information about what was expected
-            open_set = set(terminal_partial_rules)
-            visited = set()
-            children = defaultdict(list)
-            exits = []
-            while open_set:
-                partial_rule = open_set.pop()
-                if partial_rule in visited:
-                    continue
-                visited.add(partial_rule)
-                if partial_rule.rule is gamma_rule:
-                    exits.append(partial_rule)
-                elif partial_rule.state == 0 and partial_rule.sub_state == 0:
-                    parent_list = list(pending_rules[index][partial_rule.rule.head])
-                    assert len(parent_list) > 0
-                    for parent in parent_list:
-                        children[parent].append(partial_rule)
-                        open_set.add(parent)
+                        add(skipped)
+        self.item_count = len(self.canon_rules.d)
+        chart.stats.items += self.item_count
+        chart.stats.tokens = index
+        if limits is not None:
+            limits.check_column(self, chart.stats)
+        # With a front to back order of evaluation, the PartialRules for this
+        # column are complete, so we don't need to canonicalize any more
+        self.canon_rules = None
+
+    def scan(self, token, match_cache=None, vocabulary=None, token_id=None):
+        """Returns the next column, seeded with every PartialRule that matches token, or None if there are none.
+        token_id is the id of token in vocabulary, if already known"""
+        next_column = Column(self.index + 1)
+        terminal_partial_rules = self.terminal_partial_rules
+        if vocabulary is not None:
+            # Plain terminals are found by token id, and character classes by character, leaving only other
+            # terminals to call match on.
+            # The index is kept, as columns can be scanned repeatedly by ParseSession and parse_batch.
+            if self.terminal_index is None:
+                self.terminal_index = vocabulary._index_terminals(terminal_partial_rules)
+            by_id, by_char, terminal_partial_rules = self.terminal_index
+            if token_id is None:
+                try:
+                    token_id = vocabulary.ids.get(token)
+                except TypeError:
+                    # Unhashable tokens can only match terminals outside the vocabulary
+                    pass
+            if token_id is not None:
+                for partial_rule in by_id.get(token_id, ()):
+                    next_column.add(partial_rule.extend(token, self.index + 1))
+                for lazy_by_id in self.lazy_rules.values():
+                    for rule in lazy_by_id.get(token_id, ()):
+                        predicted = PartialRule(rule, 0, 0, self.index, self.index)
+                        next_column.add(predicted.extend(token, self.index + 1))
+            # Character classes only match single characters
+            if by_char is not None and isinstance(token, str) and len(token) == 1:
+                table, groups = by_char
+                matched = table.get(token)
+                if matched is None:
+                    matched = table[token] = tuple(i for i, (symbol, _) in enumerate(groups) if symbol.match(token))
+                for i in matched:
+                    for partial_rule in groups[i][1]:
+                        next_column.add(partial_rule.extend(token, self.index + 1))
+        # Many PartialRules can be waiting on the same terminal, so results are memoized
+        # by match_key, or failing that, by the identity of the terminal.
+        matches = {}
+        for partial_rule in terminal_partial_rules:
+            symbol = partial_rule.next_symbol
+            key = getattr(symbol, "match_key", None)
+            if key is None:
+                key = id(symbol)
+            matched = matches.get(key)
+            if matched is None:
+                if match_cache is not None:
+                    matched = match_cache.match(symbol, token)
                 else:
-                    exits.append(partial_rule)
-            non_anon_exits = set()
-            while exits:
-                exit = exits.pop()
-                next_symbol = exit.next_symbol
-                if not next_symbol.is_terminal:
-                    if rule_set.is_anonymous(next_symbol.head) or exit.rule is gamma_rule:
-                        exits.extend(children[exit])
-                        continue
-                non_anon_exits.add(exit)
-            encountered_token = token if token is not end_sentinel else None
-            encountered_token_str = repr(token) if token is not end_sentinel else "end"
+                    matched = bool(symbol.match(token))
+                matches[key] = matched
+            if matched:
+                next_column.add(partial_rule.extend(token, self.index + 1))
+        if not next_column.new_rules:
+            return None
+        return next_column
+
+    def expand_lazy_rules(self):
+        """Creates any predicted PartialRules that were deferred by a `Vocabulary`,
+        so terminal_partial_rules lists everything expected at this column"""
+        if not self.lazy_rules:
+            return
+        for lazy_by_id in self.lazy_rules.values():
+            for rules in lazy_by_id.values():
+                for rule in rules:
+                    self.terminal_partial_rules.append(PartialRule(rule, 0, 0, self.index, self.index))
+        self.lazy_rules = {}
+        self.terminal_index = None
+
+    def expected_exits(self, chart):
+        """Returns the PartialRules whose next symbols summarize the terminals expected at this column"""
+        if self.exits is not None:
+            return self.exits
+        self.expand_lazy_rules()
+        gamma_rule = chart.gamma_rule
+        # We have a list of all terminals that were evaluated,
+        # But we can give higher level information about what was expected
+        open_set = set(self.terminal_partial_rules)
+        visited = set()
+        children = defaultdict(list)
+        exits = []
+        while open_set:
+            partial_rule = open_set.pop()
+            if partial_rule in visited:
+                continue
+            visited.add(partial_rule)
+            if partial_rule.rule is gamma_rule:
+                exits.append(partial_rule)
+            elif partial_rule.state == 0 and partial_rule.sub_state == 0:
+                parent_list = list(self.pending_rules[partial_rule.rule.head])
+                assert len(parent_list) > 0
+                for parent in parent_list:
+                    children[parent].append(partial_rule)
+                    open_set.add(parent)
+            else:
+                exits.append(partial_rule)
+        non_anon_exits = set()
+        while exits:
+            exit = exits.pop()
+            next_symbol = exit.next_symbol
+            if not next_symbol.is_terminal:
+                if chart.rule_set.is_anonymous(next_symbol.head) or exit.rule is gamma_rule:
+                    exits.extend(children[exit])
+                    continue
+            non_anon_exits.add(exit)
+        # Columns never change once processed, so this can be cached
+        self.exits = non_anon_exits
+        return non_anon_exits
+
+    def no_parse_error(self, chart, token=None, at_end=False):
+        """Describes the failure to parse token (or the end of the stream) at this column.
+        The expected symbols are only worked out if the error's description is read."""
+        encountered_token = token if not at_end else None
+
+        def describe():
+            non_anon_exits = self.expected_exits(chart)
+            encountered_token_str = repr(token) if not at_end else "end"
             expected = ", ".join(sorted(set(str(partial_rule.next_symbol) for partial_rule in non_anon_exits)))
-            raise NoParseError("Unexpected {0}, was expecting {1}.".format(encountered_token_str, expected),
-                               index, index,
-                               encountered_token,
-                               [partial_rule.next_symbol for partial_rule in terminal_partial_rules],
-                               [partial_rule.next_symbol for partial_rule in non_anon_exits])
+            return ("Unexpected {0}, was expecting {1}.".format(encountered_token_str, expected),
+                    [partial_rule.next_symbol for partial_rule in self.terminal_partial_rules],
+                    [partial_rule.next_symbol for partial_rule in non_anon_exits])
+        return NoParseError(None, self.index, self.index, encountered_token, None, None, describe)
+
+
+def unique_symbols(partial_rules):
+    """Returns the distinct next symbols of some PartialRules, in order"""
+    seen = set()
+    symbols = []
+    for partial_rule in partial_rules:
+        symbol = partial_rule.next_symbol
+        if id(symbol) not in seen:
+            seen.add(id(symbol))
+            symbols.append(symbol)
+    return symbols
+
+
+class Chart:
+    """The Earley chart for a stream of tokens. This is a list of Column objects, one for each position,
+    plus everything needed to compute more of them."""
+    def __init__(self, rule_set, head, limits=None, vocabulary=None):
+        self.rule_set = rule_set
+        # We start with a fake rule called gamma that matches head
+        # This awkwardness is because we don't otherwise have an object for
+        # "all the rules with the starting head"
+        self.gamma_rule = ParseRule("anon gamma", [GammaNonTerminal(head)])
+        self.limits = _start_limits(limits)
+        self.match_cache = getattr(rule_set, "match_cache", None)
+        self.vocabulary = vocabulary
+        # Results of rule_set.get by head, if they can be memoized
+        self.rule_memo = {} if getattr(rule_set, "memoize_get", False) else None
+        self.rule_cache = getattr(rule_set, "rule_cache", None)
+        self.stats = ParseStats()
+        column = Column(0)
+        column.add(PartialRule(self.gamma_rule, 0, 0, 0, 0))
+        self.columns = [column]
+        column.process(self)
+
+    def get_rules(self, head):
+        """Returns the rules for a predicted head"""
+        stats = self.stats
+        stats.rule_lookups += 1
+        rule_memo = self.rule_memo
+        if rule_memo is None:
+            stats.rule_gets += 1
+            return self.rule_set.get(head)
+        rules = rule_memo.get(head)
+        if rules is None:
+            stats.rule_gets += 1
+            if self.rule_cache is not None:
+                rules = self.rule_cache.get(self.rule_set, head)
+            else:
+                rules = _as_rule_list(self.rule_set.get(head))
+            rule_memo[head] = rules
+        return rules
+
+    def extend(self, tokens):
+        """Appends a processed column for each token, or raises NoParseError"""
+        columns = self.columns
+        column = columns[-1]
+        for token in tokens:
+            next_column = column.scan(token, self.match_cache, self.vocabulary)
+            if next_column is None:
+                raise column.no_parse_error(self, token)
+            columns.append(next_column)
+            next_column.process(self)
+            column = next_column
+
+    def extend_ids(self, token_ids):
+        """Like extend, but for a sequence of ids from self.vocabulary"""
+        columns = self.columns
+        column = columns[-1]
+        vocabulary = self.vocabulary
+        tokens = vocabulary.tokens
+        for token_id in token_ids:
+            if not 0 <= token_id < len(tokens):
+                raise column.no_parse_error(self, token_id)
+            # Tokens are shared with the vocabulary, so no objects are created per token
+            token = tokens[token_id]
+            next_column = column.scan(token, self.match_cache, vocabulary, token_id)
+            if next_column is None:
+                raise column.no_parse_error(self, token)
+            columns.append(next_column)
+            next_column.process(self)
+            column = next_column
+
+    def truncate(self, position):
+        """Discards the columns after position"""
+        for column in self.columns[position + 1:]:
+            self.stats.items -= column.item_count
+        del self.columns[position + 1:]
+        self.stats.tokens = len(self.columns) - 1
+
+    def copy(self, position):
+        """Returns a new chart, sharing the columns up to position"""
+        chart = Chart.__new__(Chart)
+        chart.__dict__.update(self.__dict__)
+        # Processed columns are never modified, so they can be shared rather than copied
+        chart.columns = list(self.columns)
+        chart.stats = self.stats.copy()
+        chart.truncate(position)
+        return chart
+
+    def forest(self, fail_if_empty=True):
+        """Returns the ParseForest for the tokens so far, as if there were no more, or raises NoParseError"""
+        final_state = self.columns[-1].final_state
+        if final_state is None:
+            if not fail_if_empty:
+                return ParseForest(PartialRule(ParseRule("gamma", []), 0, 0, 0, 0))
+            raise self.columns[-1].no_parse_error(self, at_end=True)
+        return ParseForest(final_state, limits=self.limits, stats=self.stats)
+
+
+def parse(rule_set, head, tokens, *, fail_if_empty=True, limits=None, vocabulary=None, encoded=False):
+    """Parses a stream of ``tokens`` according to the grammer in ``rule_set`` by attempting to match
+    the non-terminal specified by ``head``.
+
+    ``tokens`` is only iterated over once, and is never copied, so it can be a generator or a ``str``
+    (for scannerless parsing, see `CharacterClass`). ``limits`` is an optional `ParseLimits` bounding
+    the work done. ``vocabulary`` is an optional `Vocabulary`, which speeds up matching plain `Terminal`
+    objects, particularly in grammars with many alternative terminals.
+
+    If ``encoded`` is set, ``tokens`` is a sequence of integer ids from ``vocabulary`` instead. Objects supporting
+    the buffer protocol, such as ``array("I")``, numpy arrays and ``memoryview`` casts of memory-mapped files, are
+    read in place. The parse results contain the tokens of ``vocabulary``, so no objects are created per token."""
+    chart = Chart(rule_set, head, limits, vocabulary)
+    if encoded:
+        if vocabulary is None:
+            raise ValueError("Encoded tokens require a vocabulary")
+        token_ids = _token_ids(tokens)
+        try:
+            chart.extend_ids(token_ids)
+        finally:
+            # Release our view promptly, so a memory-mapped file can be closed even if an error is kept
+            if isinstance(token_ids, memoryview):
+                token_ids.release()
+    else:
+        chart.extend(tokens)
+    return chart.forest(fail_if_empty)
+
+
+def _token_ids(tokens):
+    # Buffers are viewed rather than iterated directly, so numpy arrays give ints rather than numpy scalars
+    try:
+        view = memoryview(tokens)
+    except TypeError:
+        return tokens
+    if view.ndim != 1:
+        raise ValueError("Token buffers must be one dimensional")
+    return view
+
+
+def parse_batch(rule_set, head, token_sequences, *, fail_if_empty=True, limits=None, return_errors=False,
+                vocabulary=None):
+    """Parses several sequences of tokens, returning a list of `ParseForest` in the same order.
+
+    This gives the same results as calling `parse` for each sequence, but sequences with a common prefix share the
+    work of parsing it, so is considerably faster for inputs that often start the same way. Tokens must be
+    hashable. If a sequence fails to parse, the error is raised, or if ``return_errors`` is set, it is
+    returned in place of the forest. ``vocabulary`` is as for `parse`, and is particularly effective here, as
+    each position in a shared prefix can be scanned for many different tokens."""
+    # Build a trie of the token sequences. Each node is a pair of a dict of child nodes by token,
+    # and a list of indices of sequences that end at that node.
+    root = ({}, [])
+    count = 0
+    for tokens in token_sequences:
+        node = root
+        for token in tokens:
+            child = node[0].get(token)
+            if child is None:
+                child = node[0][token] = ({}, [])
+            node = child
+        node[1].append(count)
+        count += 1
+
+    results = [None] * count
+
+    def finish(chart, indices):
+        try:
+            forest = chart.forest(fail_if_empty)
+            # The chart's stats keep changing as the walk continues
+            forest.stats = forest.stats.copy()
+        except ParseError as e:
+            forest = e
+        for index in indices:
+            results[index] = forest
+
+    def fail(node, error):
+        # Every sequence passing through node fails the same way
+        stack = [node]
+        while stack:
+            children, indices = stack.pop()
+            for index in indices:
+                results[index] = error
+            stack.extend(children.values())
+
+    chart = Chart(rule_set, head, limits, vocabulary)
+    finish(chart, root[1])
+    # Walk the trie depth first. Everything on the stack is a child of a node on the path to the
+    # current node, so the chart only ever needs truncating back to that parent before extending.
+    stack = [(0, token, child) for token, child in root[0].items()]
+    while stack:
+        depth, token, node = stack.pop()
+        chart.truncate(depth)
+        try:
+            chart.extend((token,))
+        except ParseError as e:
+            fail(node, e)
+            continue
+        children, indices = node
+        if indices:
+            finish(chart, indices)
+        stack.extend((depth + 1, child_token, child) for child_token, child in children.items())
+
+    if not return_errors:
+        for result in results:
+            if isinstance(result, ParseError):
+                raise result
+    return results
+
+
+class ParseSession:
+    """Parses a list of tokens that can be extended or rolled back after parsing, re-using the work done so far.
+
+    The session keeps the Earley chart for the tokens, which contains a column for each position.
+    Columns only depend on the tokens before them, so appending tokens only computes the new columns, and
+    rolling back just discards columns. `edit` keeps the columns before the edit, but reparses every token
+    after it, so it is only cheap near the end of the input.
+
+    The session always holds the edited tokens, even if they can't be parsed. In that case,
+    the method making the change raises `NoParseError`, and so does `forest` until the tokens are fixed.
+    The constructor doesn't raise, so that the session can still be used to fix the tokens; check `error`
+    or call `forest` to find out if the initial tokens parse."""
+    def __init__(self, rule_set, head, tokens=(), *, limits=None):
+        self.rule_set = rule_set
+        self.head = head
+        #: The `ParseLimits` for each change, and for `forest`, or ``None``
+        self.limits = limits
+        self._tokens = []
+        self._chart = Chart(rule_set, head)
+        #: The `NoParseError` (or `ParseLimitError`) for the current tokens, or ``None`` if they parse so far
+        self.error = None
+        try:
+            self.edit(0, 0, tokens)
+        except ParseError:
+            # Kept in self.error
+            pass
 
-        # With a front to back order of evaluation, we don't need this any longer
-        completed_rules[index] = None
+    @property
+    def tokens(self):
+        """A tuple of the current tokens"""
+        return tuple(self._tokens)
+
+    @property
+    def stats(self):
+        """`ParseStats` for the chart of the current tokens"""
+        return self._chart.stats
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def feed(self, token):
+        """Appends a token"""
+        self.edit(len(self._tokens), len(self._tokens), [token])
+
+    def extend(self, tokens):
+        """Appends several tokens"""
+        self.edit(len(self._tokens), len(self._tokens), tokens)
+
+    def edit(self, start, end, tokens):
+        """Replaces ``self.tokens[start:end]`` with ``tokens`` and reparses from ``start``.
+
+        This is the same as rolling back to ``start`` and extending with the new tokens and those after ``end``.
+        Nothing after the edit is reused, so the cost is proportional to the number of tokens after ``start``."""
+        self._tokens[start:end] = tokens
+        # Columns up to and including start are unaffected. If the previous tokens failed to parse,
+        # there may be fewer columns than that.
+        chart = self._chart
+        chart.truncate(start)
+        chart.limits = _start_limits(self.limits)
+        self.error = None
+        try:
+            chart.extend(self._tokens[len(chart.columns) - 1:])
+        except ParseError as e:
+            # Includes ParseLimitError, which also leaves the chart covering only some of the tokens
+            self.error = e
+            raise
+
+    @property
+    def is_complete(self):
+        """True if the current tokens are a complete parse of `head`, i.e. `forest` will not raise"""
+        return self.error is None and self._chart.columns[-1].final_state is not None
+
+    def accepts(self, token):
+        """Returns true if ``token`` could be fed next without raising `NoParseError`"""
+        if self.error is not None:
+            return False
+        terminal_partial_rules = self._chart.columns[-1].terminal_partial_rules
+        return any(partial_rule.next_symbol.match(token) for partial_rule in terminal_partial_rules)
+
+    def expected_terminals(self):
+        """Returns a list of the terminal symbols that could match the next token.
+        This is empty if the current tokens can't be parsed."""
+        if self.error is not None:
+            return []
+        column = self._chart.columns[-1]
+        if column.expected_terminals is None:
+            column.expected_terminals = unique_symbols(column.terminal_partial_rules)
+        return list(column.expected_terminals)
+
+    def expected(self):
+        """Returns a list of terminal and non-terminal symbols summarizing `expected_terminals`,
+        in the same way as `NoParseError.expected`."""
+        if self.error is not None:
+            return []
+        return unique_symbols(self._chart.columns[-1].expected_exits(self._chart))
+
+    def rollback(self, position):
+        """Discards all tokens after ``position``"""
+        self.edit(position, len(self._tokens), [])
+
+    def fork(self, position=None):
+        """Returns a new session for the first ``position`` tokens, or all of them by default.
+
+        The new session shares the chart for those tokens with this one, so forking is cheap. Either session can
+        then be changed without affecting the other."""
+        if position is None:
+            position = len(self._tokens)
+        fork = ParseSession.__new__(ParseSession)
+        fork.rule_set = self.rule_set
+        fork.head = self.head
+        fork.limits = self.limits
+        fork._tokens = self._tokens[:position]
+        fork._chart = self._chart.copy(position)
+        # Keep the error only if it's for one of the forked tokens
+        fork.error = self.error if len(self._chart.columns) <= position else None
+        return fork
+
+    def forest(self):
+        """Returns a `ParseForest` for the current tokens, or raises `NoParseError`"""
+        if self.error is not None:
+            raise self.error
+        self._chart.limits = _start_limits(self.limits)
+        return self._chart.forest()
 
-    return ParseForest(final_state)
 
 __all__ = [
     "ParseRule",
@@ -1064,14 +2717,29 @@ __all__ = [
     "AmbiguousParseError",
     "NoParseError",
     "InfiniteParseError",
+    "ParseLimitError",
+    "ParseLimits",
+    "ParseStats",
     "ParseForest",
+    "CompactParseForest",
     "ParseRuleSet",
+    "FrozenParseRuleSet",
+    "MatchCache",
+    "RuleCache",
+    "Vocabulary",
     "unparse",
+    "iter_unparse",
+    "unparse_to",
     "parse",
+    "parse_batch",
+    "ParseSession",
     "Builder",
     "make_list_builder",
     "make_iter_builder",
+    "ParseEvent",
     "Symbol",
     "NonTerminal",
     "Terminal",
+    "CharacterClass",
+    "RegexTerminal",
 ]
\ No newline at end of file
@@ -0,0 +1,36 @@
+"""Parsing tokens from an asyncio ``async`` iterator."""
+import asyncio
+from itertools import islice
+
+from axaxaxas import Chart
+
+
+async def parse_async(rule_set, head, tokens, *, fail_if_empty=True, limits=None, yield_every=1000):
+    """Coroutine version of `parse`, that reads ``tokens`` from an async iterator (or a normal iterable).
+
+    Parsing gives control back to the event loop every ``yield_every`` tokens, so that a long parse doesn't
+    stop other tasks from running, even if ``tokens`` never has to wait. Returns a `ParseForest`."""
+    if yield_every < 1:
+        raise ValueError("yield_every must be at least 1")
+    chart = Chart(rule_set, head, limits)
+    if hasattr(tokens, "__aiter__"):
+        count = 0
+        async for token in tokens:
+            chart.extend((token,))
+            count += 1
+            if count % yield_every == 0:
+                await asyncio.sleep(0)
+    else:
+        tokens = iter(tokens)
+        while True:
+            count = len(chart.columns)
+            chart.extend(islice(tokens, yield_every))
+            if len(chart.columns) - count < yield_every:
+                break
+            await asyncio.sleep(0)
+    return chart.forest(fail_if_empty)
+
+
+__all__ = [
+    "parse_async",
+]
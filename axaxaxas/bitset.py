@@ -0,0 +1,298 @@
+"""A recognizer that checks whether tokens match a grammar, using NumPy to process many Earley items at once.
+
+This module requires NumPy. The grammar is compiled into a fixed set of states, one for each position in each
+rule, and each column of the chart is stored as a boolean matrix of states for each starting position. Prediction,
+completion and scanning are then matrix products, rather than work done one item at a time::
+
+    recognizer = BitsetRecognizer(grammar, "sentence")
+    for line in lines:
+        if not recognizer.accepts(line.split()):
+            ...
+
+It only answers whether the tokens can be parsed, so it is useful for validating large numbers of inputs.
+The chart uses memory proportional to the square of the number of tokens, so it suits many short inputs,
+rather than a few long ones.
+
+Each token still costs several NumPy calls, so it is only much faster than `~axaxaxas.parse` when each token
+produces many Earley items. That happens with highly ambiguous grammars, or heads with hundreds of alternatives.
+For mostly unambiguous grammars, such as those for programming languages, it is barely faster.
+"""
+from collections import defaultdict
+
+import numpy
+
+from axaxaxas import Vocabulary, parse
+
+
+class BitsetRecognizer:
+    """Compiles the rules of ``rule_set`` reachable from ``head`` for fast recognition.
+
+    Rules are found with `~axaxaxas.ParseRuleSet.get`, so rule sets that generate rules on the fly work, provided
+    they only generate finitely many. The recognizer doesn't change when rules are added to ``rule_set``
+    afterwards. Tokens are matched in the same way as `~axaxaxas.parse`, with plain `~axaxaxas.Terminal` objects
+    looked up by token, and other terminals having `~axaxaxas.Terminal.match` called once per token."""
+    def __init__(self, rule_set, head):
+        self.rule_set = rule_set
+        self.head = head
+        self._compile()
+
+    def accepts(self, tokens):
+        """Returns true if ``tokens`` is a complete parse of the head"""
+        return self._run(tokens, [])[0]
+
+    def recognize(self, tokens):
+        """Returns nothing if ``tokens`` is a complete parse of the head, otherwise raises the same
+        `~axaxaxas.NoParseError` as `~axaxaxas.parse` would."""
+        seen = []
+        accepted, failed_at = self._run(tokens, seen)
+        if accepted:
+            return
+        # Errors are rare, so they are described by the ordinary parser,
+        # which stops at the same token as this one.
+        end = len(seen) if failed_at is None else failed_at + 1
+        parse(self.rule_set, self.head, seen[:end])
+        assert False, "BitsetRecognizer accepted tokens that parse rejected"
+
+    def _compile(self):
+        # Number every state, which is a position in a rule, plus two states for a rule matching the head
+        heads = [self.head]
+        head_ids = {self.head: 0}
+        rules = []
+        for head in heads:
+            for rule in self.rule_set.get(head):
+                rules.append(rule)
+                for symbol in rule.symbols:
+                    if not symbol.is_terminal and symbol.head not in head_ids:
+                        head_ids[symbol.head] = len(heads)
+                        heads.append(symbol.head)
+        gamma_start = 0
+        gamma_end = 1
+        state_count = 2
+        rule_starts = []
+        for rule in rules:
+            rule_starts.append(state_count)
+            state_count += len(rule.symbols) + 1
+
+        # Edges between states, labelled with a terminal index or head index
+        terminals = []
+        terminal_ids = {}
+        terminal_edges = defaultdict(list)
+        head_edges = defaultdict(list)
+        head_edges[0].append((gamma_start, gamma_end))
+        skip_edges = defaultdict(list)
+        for rule, start in zip(rules, rule_starts):
+            for i, symbol in enumerate(rule.symbols):
+                if symbol.is_terminal:
+                    key = getattr(symbol, "match_key", None)
+                    if key is None:
+                        key = id(symbol)
+                    if key not in terminal_ids:
+                        terminal_ids[key] = len(terminals)
+                        terminals.append(symbol)
+                    edges = terminal_edges[terminal_ids[key]]
+                else:
+                    edges = head_edges[head_ids[symbol.head]]
+                edges.append((start + i, start + i + 1))
+                if symbol.multiple:
+                    # Once matched, a star or plus symbol can be matched again
+                    edges.append((start + i + 1, start + i + 1))
+                if symbol.optional or symbol.min_occurs == 0:
+                    skip_edges[start + i].append(start + i + 1)
+
+        # Non-terminals that match no tokens can be skipped too
+        nullable = set()
+        changed = True
+        while changed:
+            changed = False
+            for rule, start in zip(rules, rule_starts):
+                head_id = head_ids[rule.head]
+                end = start + len(rule.symbols)
+                if head_id not in nullable and end in _reach(skip_edges, start):
+                    nullable.add(head_id)
+                    for src, dst in head_edges[head_id]:
+                        if src != dst:
+                            skip_edges[src].append(dst)
+                    changed = True
+        # States reachable from each state by skipping
+        skips = [_reach(skip_edges, state) for state in range(state_count)]
+
+        def closed(edges):
+            return [(src, skipped) for src, dst in edges for skipped in skips[dst]]
+
+        self._terminal_edges = [closed(terminal_edges[terminal_id]) for terminal_id in range(len(terminals))]
+        self._head_edges = [closed(head_edges[head_id]) for head_id in range(len(heads))]
+
+        # The head completed by each final state
+        self._final_states = numpy.array([start + len(rule.symbols) for rule, start in zip(rules, rule_starts)],
+                                         dtype=numpy.intp)
+        self._final_heads = numpy.array([head_ids[rule.head] for rule in rules], dtype=numpy.intp)
+
+        # Prediction goes from states to the heads they expect, to every head that predicts, to the states
+        # starting those heads.
+        self._expects = _Relation([(src, head_id) for head_id in range(len(heads))
+                                   for src, dst in head_edges[head_id]])
+        head_starts = numpy.zeros((len(heads), state_count), dtype=bool)
+        for rule, start in zip(rules, rule_starts):
+            head_starts[head_ids[rule.head], skips[start]] = True
+        predicts = numpy.eye(len(heads), dtype=bool)
+        for head_id in range(len(heads)):
+            expected = numpy.zeros(len(heads), dtype=bool)
+            self._expects.apply(head_starts[head_id], expected)
+            predicts[head_id] |= expected
+        self._head_predicts = _transitive(predicts)
+        self._head_starts = head_starts
+
+        self._start = numpy.zeros(state_count, dtype=bool)
+        self._start[skips[gamma_start]] = True
+        self._gamma_end = gamma_end
+        self._state_count = state_count
+        self._head_count = len(heads)
+        self._terminals = terminals
+        # Plain terminals are found by looking up the token. Others are matched individually.
+        self._plain = {}
+        self._other = []
+        for terminal_id, terminal in enumerate(terminals):
+            if Vocabulary._is_plain(terminal):
+                self._plain.setdefault(terminal.token, []).append(terminal_id)
+            else:
+                self._other.append(terminal_id)
+        # Relations for each combination of terminals or heads seen so far
+        self._scan_cache = {}
+        self._complete_cache = {}
+
+    def _scan_step(self, token):
+        # Returns the relation taking states to the states after token, or None if no terminal matches it
+        try:
+            terminal_ids = list(self._plain.get(token, ()))
+        except TypeError:
+            terminal_ids = []
+        terminals = self._terminals
+        terminal_ids.extend(terminal_id for terminal_id in self._other if terminals[terminal_id].match(token))
+        if not terminal_ids:
+            return None
+        key = tuple(terminal_ids)
+        step = self._scan_cache.get(key)
+        if step is None:
+            step = self._scan_cache[key] = _Relation(
+                [edge for terminal_id in terminal_ids for edge in self._terminal_edges[terminal_id]])
+        return step
+
+    def _predict(self, states):
+        # Returns the states predicted by a set of states
+        expected = numpy.zeros(self._head_count, dtype=bool)
+        self._expects.apply(states, expected)
+        return (expected @ self._head_predicts) @ self._head_starts
+
+    def _run(self, tokens, seen):
+        # Returns whether the tokens were accepted, and the index of the first token that couldn't be scanned.
+        # Tokens are appended to seen.
+        state_count = self._state_count
+        # Column j is a pair of an array of the positions k that items start at, and a matrix with the set of states
+        # of items starting at each k, having matched tokens k to j. Positions with no items are left out.
+        column = numpy.zeros((1, state_count), dtype=bool)
+        column[0] = self._start
+        column[0] |= self._predict(column[0])
+        columns = [(numpy.zeros(1, dtype=numpy.intp), column)]
+        for index, token in enumerate(tokens):
+            seen.append(token)
+            step = self._scan_step(token)
+            if step is None:
+                return False, index
+            # While being built, a column has a row for every position
+            starts, states = columns[-1]
+            column = numpy.zeros((index + 2, state_count), dtype=bool)
+            column[starts] = step.map(states)
+            if not column.any():
+                return False, index
+            self._complete(columns, column)
+            column[index + 1] = self._predict(column.any(axis=0))
+            starts = column.any(axis=1).nonzero()[0]
+            columns.append((starts, column[starts]))
+        starts, states = columns[-1]
+        return bool(starts[0] == 0 and states[0, self._gamma_end]), None
+
+    def _complete(self, columns, column):
+        # Advances items waiting on any head completed in column. Items starting at the current position never
+        # need this, as nullable heads are skipped, so only earlier starts are considered, from latest to earliest,
+        # since completing an item starting at k only adds items starting at k or before.
+        final_states = self._final_states
+        end = len(column) - 1
+        while end > 0:
+            starts = column[:end, final_states].any(axis=1).nonzero()[0]
+            if not len(starts):
+                break
+            start = starts[-1]
+            finished = None
+            while True:
+                # Completing can finish more rules starting at the same place
+                new_finished = column[start, final_states].tobytes()
+                if new_finished == finished:
+                    break
+                finished = new_finished
+                starts, states = columns[start]
+                column[starts] |= self._complete_step(finished).map(states)
+            end = start
+
+    def _complete_step(self, finished):
+        # Returns the relation taking states to the states after any head completed by the finished final states
+        step = self._complete_cache.get(finished)
+        if step is None:
+            mask = numpy.frombuffer(finished, dtype=bool)
+            head_ids = set(self._final_heads[mask].tolist())
+            step = self._complete_cache[finished] = _Relation(
+                [edge for head_id in head_ids for edge in self._head_edges[head_id]])
+        return step
+
+
+class _Relation:
+    """A set of (source, destination) pairs of states, applied to many sets of states at once"""
+    def __init__(self, pairs):
+        pairs = sorted(set(pairs), key=lambda pair: (pair[1], pair[0]))
+        self.sources = numpy.array([src for src, dst in pairs], dtype=numpy.intp)
+        destinations = numpy.array([dst for src, dst in pairs], dtype=numpy.intp)
+        # Pairs are grouped by destination, so each group can be reduced to a single column
+        self.group_starts = numpy.flatnonzero(numpy.concatenate([[True], destinations[1:] != destinations[:-1]]))
+        self.destinations = destinations[self.group_starts]
+        # If no destination has several sources, there is nothing to reduce
+        self.one_to_one = len(self.destinations) == len(self.sources)
+
+    def map(self, states):
+        """Returns the destinations of every pair whose source is in ``states``"""
+        out = numpy.zeros(states.shape, dtype=bool)
+        self.apply(states, out)
+        return out
+
+    def apply(self, states, out):
+        """ORs the destinations of every pair whose source is in ``states`` into ``out``"""
+        if self.one_to_one:
+            if len(self.sources):
+                out[..., self.destinations] |= states[..., self.sources]
+        else:
+            out[..., self.destinations] |= numpy.logical_or.reduceat(states[..., self.sources], self.group_starts,
+                                                                      axis=-1)
+
+
+def _reach(edges, state):
+    # Returns the states reachable from state using a dict of edge lists, including itself
+    reached = [state]
+    seen = {state}
+    for current in reached:
+        for next_state in edges.get(current, ()):
+            if next_state not in seen:
+                seen.add(next_state)
+                reached.append(next_state)
+    return reached
+
+
+def _transitive(matrix):
+    # Returns the transitive closure of a boolean matrix, by repeated squaring
+    while True:
+        closed = matrix | (matrix @ matrix)
+        if (closed == matrix).all():
+            return closed
+        matrix = closed
+
+
+__all__ = [
+    "BitsetRecognizer",
+]
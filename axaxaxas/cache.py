@@ -0,0 +1,196 @@
+"""Caching of parse results, for inputs that are parsed repeatedly.
+
+`ParseCache` remembers the `CompactParseForest` (or the result of a builder) for each token sequence it has seen,
+keyed by the rule set, its `~axaxaxas.ParseRuleSet.version`, the head and the tokens. Adding a rule to a
+`ParseRuleSet` changes its version, so results from an older grammar are never returned::
+
+    cache = ParseCache(maxsize=1000)
+    tree = cache.parse(grammar, "sentence", tokens).single()
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import weakref
+
+from axaxaxas import parse
+
+
+class ParseCache:
+    """A least-recently-used cache of parse results.
+
+    At most ``maxsize`` results are kept in memory. If ``directory`` is set, results are also pickled to files
+    in that directory, so they can be shared between processes and runs. Disk entries are keyed on a
+    fingerprint of the pickled rules rather than the version, so the rules, tokens and results must be
+    picklable. `~axaxaxas.ParseRule` objects referenced by a result are stored by position in the rule set,
+    so loaded results refer to the rules of the current grammar.
+
+    Cached results are returned to every caller that asks for them, so should not be modified. Rule sets without a
+    ``version`` attribute are never cached. Parse errors are not cached either. Calls with ``limits``,
+    ``vocabulary`` or ``encoded`` set are always parsed, as the cache can't tell if they would give the same
+    result. The cache doesn't keep rule sets alive, so results for a rule set that has been freed are never
+    returned, and are eventually evicted.
+
+    .. warning::
+        Loading a pickle can run arbitrary code, so anyone who can write to ``directory`` can run code in every
+        process using the cache. Only use a directory that no untrusted user can write to. If the directory
+        doesn't exist, it is created readable and writable by the current user only."""
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        #: Number of lookups found in the cache, in memory or on disk
+        self.hits = 0
+        #: Number of lookups that had to parse
+        self.misses = 0
+        self._entries = OrderedDict()
+        # An object standing in for each rule set in the keys of _entries, held weakly so rule sets can be freed
+        self._rule_set_keys = weakref.WeakKeyDictionary()
+        # (version, fingerprint) of each rule set, held weakly so rule sets can be freed
+        self._fingerprints = weakref.WeakKeyDictionary()
+
+    @property
+    def hit_rate(self):
+        """The fraction of lookups found in the cache"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def parse(self, rule_set, head, tokens, **kwargs):
+        """Like `~axaxaxas.parse`, but returns a cached `CompactParseForest` if possible.
+        ``tokens`` must be a finite sequence of hashable tokens."""
+        return self._lookup(rule_set, head, tokens, None, None, kwargs)
+
+    def apply(self, rule_set, head, tokens, builder, key=None, **kwargs):
+        """Returns the result of applying ``builder`` to the forest for ``tokens``, or a cached result.
+
+        Results are cached by ``key``, so builders with the same key must construct equivalent results. It defaults
+        to the class of ``builder``, and of the builder it wraps, for builders with an ``underlying`` attribute such
+        as those from `~axaxaxas.make_list_builder`."""
+        if key is None:
+            key = _builder_key(builder)
+        return self._lookup(rule_set, head, tokens, builder, key, kwargs)
+
+    def clear(self):
+        """Discards all results held in memory. Files on disk are left in place."""
+        self._entries.clear()
+        self._rule_set_keys.clear()
+        self._fingerprints.clear()
+
+    def _lookup(self, rule_set, head, tokens, builder, builder_key, kwargs):
+        version = getattr(rule_set, "version", None)
+        uncacheable = kwargs.get("limits") is not None or kwargs.get("vocabulary") is not None or kwargs.get("encoded")
+        if version is None or uncacheable:
+            self.misses += 1
+            return self._compute(rule_set, head, tokens, builder, kwargs)
+
+        tokens = tuple(tokens)
+        fail_if_empty = bool(kwargs.get("fail_if_empty", True))
+        rule_set_key = self._rule_set_keys.get(rule_set)
+        if rule_set_key is None:
+            rule_set_key = self._rule_set_keys[rule_set] = object()
+        key = (rule_set_key, version, head, tokens, builder_key, fail_if_empty)
+        entries = self._entries
+        if key in entries:
+            entries.move_to_end(key)
+            self.hits += 1
+            return entries[key]
+
+        path = None
+        if self.directory is not None:
+            disk_key = (self._fingerprint(rule_set), head, tokens, builder_key, fail_if_empty)
+            path = self._path(disk_key)
+            found, value = self._load(rule_set, path, disk_key)
+            if found:
+                self.hits += 1
+                self._store(key, value)
+                return value
+
+        self.misses += 1
+        value = self._compute(rule_set, head, tokens, builder, kwargs)
+        self._store(key, value)
+        if path is not None:
+            self._save(rule_set, path, disk_key, value)
+        return value
+
+    def _compute(self, rule_set, head, tokens, builder, kwargs):
+        forest = parse(rule_set, head, tokens, **kwargs)
+        if builder is not None:
+            return forest.apply(builder)
+        return forest.compact()
+
+    def _store(self, key, value):
+        entries = self._entries
+        entries[key] = value
+        while len(entries) > self.maxsize:
+            entries.popitem(last=False)
+
+    def _fingerprint(self, rule_set):
+        version = rule_set.version
+        entry = self._fingerprints.get(rule_set)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        fingerprint = hashlib.sha256(pickle.dumps(list(rule_set), protocol=4)).hexdigest()
+        self._fingerprints[rule_set] = (version, fingerprint)
+        return fingerprint
+
+    def _path(self, disk_key):
+        name = hashlib.sha256(repr(disk_key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + ".pickle")
+
+    def _load(self, rule_set, path, disk_key):
+        try:
+            with open(path, "rb") as f:
+                stored_key, value = _RulePickle(rule_set).load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        # Guard against hash collisions
+        if stored_key != disk_key:
+            return False, None
+        return True, value
+
+    def _save(self, rule_set, path, disk_key, value):
+        # Anyone who can write to the directory can make loading run arbitrary code
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        # Write then rename, so concurrent readers never see a partial file
+        temp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(temp_path, "wb") as f:
+            _RulePickle(rule_set).dump(f, (disk_key, value))
+        os.replace(temp_path, path)
+
+
+def _builder_key(builder):
+    key = "{0}.{1}".format(type(builder).__module__, type(builder).__qualname__)
+    underlying = getattr(builder, "underlying", None)
+    if underlying is not None:
+        key = (key, _builder_key(underlying))
+    return key
+
+
+class _RulePickle:
+    """Pickles ParseRule objects from a rule set as references to their position in it"""
+    def __init__(self, rule_set):
+        self.rule_set = rule_set
+        self.ids = {}
+        self.rules = {}
+        for rule in rule_set:
+            index = len(self.rules)
+            self.ids[id(rule)] = index
+            self.rules[index] = rule
+
+    def dump(self, f, value):
+        pickler = pickle.Pickler(f, protocol=4)
+        pickler.persistent_id = lambda obj: self.ids.get(id(obj))
+        pickler.dump(value)
+
+    def load(self, f):
+        unpickler = pickle.Unpickler(f)
+        def persistent_load(index):
+            if index not in self.rules:
+                raise pickle.UnpicklingError("Unknown rule")
+            return self.rules[index]
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+
+__all__ = [
+    "ParseCache",
+]
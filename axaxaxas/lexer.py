@@ -0,0 +1,128 @@
+"""An optional tokenizer generated from the terminals of a grammar.
+
+The lexer collects the ``str`` tokens of every `Terminal` in a `ParseRuleSet`, plus any `RegexTerminal`,
+and compiles them into a single regular expression. Tokens are produced lazily, so they can be streamed
+straight into `parse`::
+
+    lexer = Lexer(grammar)
+    forest = parse(grammar, "sentence", lexer.tokenize(text))
+"""
+import re
+
+from axaxaxas import ParseError, RegexTerminal, Terminal
+
+
+class Token(str):
+    """A ``str`` produced by `Lexer`, annotated with where it was found"""
+    def __new__(cls, text, kind, start, flags=0):
+        token = str.__new__(cls, text)
+        #: The pattern of the `RegexTerminal` that matched this token, or ``None`` for a literal token
+        token.kind = kind
+        #: The flags `kind` was matched with
+        token.flags = flags
+        #: Offset of the first character of this token in the lexed text
+        token.start = start
+        return token
+
+    @property
+    def end(self):
+        """Offset after the last character of this token in the lexed text"""
+        return self.start + len(self)
+
+    def __repr__(self):
+        return str.__repr__(self)
+
+
+class LexError(ParseError):
+    """Indicates the lexer could not match any token. Unlike other errors, `start_index` and
+    `end_index` are character offsets into the text, not token indices."""
+    pass
+
+
+class Lexer:
+    """Tokenizer for all the terminals used by a `ParseRuleSet`.
+
+    Literal ``str`` tokens of `Terminal` objects are matched exactly, longest first, and take priority over
+    `RegexTerminal` patterns. The exception is literals which a pattern also matches (for example keywords
+    and an identifier pattern): these are found by that pattern, then recognized as the literal, so
+    ``"iffy"`` is never split into ``"if"`` and ``"fy"``. Patterns are tried in the order they are found, and
+    a token found by one pattern still matches any other `RegexTerminal` that fully matches it.
+
+    ``terminals`` lists additional `RegexTerminal` objects to recognize, and ``ignore`` is a pattern
+    for text to skip between tokens, such as whitespace and comments. Patterns must not contain
+    numbered backreferences, as they are combined into a single expression."""
+    def __init__(self, rule_set, terminals=(), *, ignore=r"\s+", flags=0):
+        literals = set()
+        keys = []
+        for symbol in list(terminals) + [symbol for rule in rule_set for symbol in rule.symbols]:
+            if isinstance(symbol, RegexTerminal):
+                key = (symbol.pattern, symbol.flags | flags)
+                if key not in keys:
+                    keys.append(key)
+            elif isinstance(symbol, Terminal) and isinstance(symbol.token, str) and symbol.token:
+                literals.add(symbol.token)
+        #: The regular expression source of each `RegexTerminal` recognized, in priority order
+        self.patterns = [pattern for pattern, pattern_flags in keys]
+        #: The literal tokens recognized
+        self.literals = frozenset(literals)
+
+        compiled = [re.compile(pattern, pattern_flags) for pattern, pattern_flags in keys]
+        keywords = set(literal for literal in literals
+                       if any(regex.fullmatch(literal) for regex in compiled))
+        alternatives = []
+        if ignore is not None:
+            alternatives.append("(?P<ignore>{0})".format(ignore))
+        plain_literals = sorted(literals - keywords, key=lambda literal: (-len(literal), literal))
+        if plain_literals:
+            alternatives.append("(?P<literal>{0})".format("|".join(map(re.escape, plain_literals))))
+        for i, (pattern, pattern_flags) in enumerate(keys):
+            alternatives.append("(?P<p{0}>{1})".format(i, _scoped(pattern, pattern_flags & ~flags)))
+        self._regex = re.compile("|".join(alternatives) or "(?!)", flags)
+        # Maps group name to the pattern and flags returned in the Token
+        self._kinds = dict(("p{0}".format(i), key) for i, key in enumerate(keys))
+        self._keywords = keywords
+
+    def tokenize(self, text):
+        """Generates a `Token` for each token in ``text``, or raises `LexError`"""
+        match = self._regex.match
+        kinds = self._kinds
+        keywords = self._keywords
+        pos = 0
+        end = len(text)
+        while pos < end:
+            m = match(text, pos)
+            if m is None or m.end() == pos:
+                raise LexError("Unexpected character {0!r}.".format(text[pos]), pos, pos)
+            group = m.lastgroup
+            if group != "ignore":
+                value = m.group()
+                if group == "literal" or value in keywords:
+                    yield Token(value, None, pos)
+                else:
+                    pattern, pattern_flags = kinds[group]
+                    yield Token(value, pattern, pos, pattern_flags)
+            pos = m.end()
+
+    __call__ = tokenize
+
+
+# Flags that can be applied to part of an expression, with their inline letters
+_INLINE_FLAGS = [(re.ASCII, "a"), (re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"), (re.VERBOSE, "x")]
+
+
+def _scoped(pattern, flags):
+    # Returns pattern in a group applying flags, so it can be combined with patterns using other flags
+    letters = "".join(letter for flag, letter in _INLINE_FLAGS if flags & flag)
+    if not letters:
+        return pattern
+    if flags & re.VERBOSE:
+        # A comment would otherwise swallow the closing parenthesis
+        pattern += "\n"
+    return "(?{0}:{1})".format(letters, pattern)
+
+
+__all__ = [
+    "Lexer",
+    "Token",
+    "LexError",
+]
@@ -0,0 +1,180 @@
+"""Parsing of large inputs in several processes at once.
+
+Many inputs are a long repetition of independent items, such as statements ending in ``;``. `parse_parallel`
+splits the tokens after each synchronization token, parses groups of items in worker processes, and combines the
+results as if the whole input had been parsed at once::
+
+    tree = parse_parallel(grammar, "program", tokens, sync_tokens={";", "}"})
+"""
+from concurrent.futures import ProcessPoolExecutor
+import io
+import os
+
+from axaxaxas import (BuilderContext, LinearParseTreeBuilder, NoParseError, NonTerminal, ParseError,
+                      parse)
+from axaxaxas.cache import _RulePickle
+
+
+def parse_parallel(rule_set, head, tokens, sync_tokens, *, builder=None, processes=None, chunk_size=1000):
+    """Returns the result of applying ``builder`` to the parse of ``tokens``, parsing parts of it in parallel.
+
+    ``head`` must have a single rule, consisting of a ``star`` or ``plus`` non-terminal for the repeated item.
+    Items are assumed to end after any of the ``sync_tokens``. The tokens are split into chunks of roughly
+    ``chunk_size`` tokens at those points, and each chunk is parsed by one of ``processes`` worker processes
+    (by default, one per CPU). ``builder`` defaults to a `~axaxaxas.LinearParseTreeBuilder`, so the result is the
+    same as ``parse(rule_set, head, tokens).single()``.
+
+    When a sync token turns out to be inside an item, for example a ``;`` in a nested block, the item is parsed
+    again with the following tokens, so the result is still correct. If part of the input can't be parsed, the
+    whole input is parsed serially, so errors are the same as from `parse`. But parses where an item doesn't end at a
+    sync token are never found, so ambiguity can go unreported.
+
+    The rule set, tokens, builder and its results must all be picklable. Each item is parsed on its own, so the
+    `BuilderContext` indices seen by ``builder`` are relative to the start of the item."""
+    rule, item_head = _repetition_rule(rule_set, head)
+    if builder is None:
+        builder = LinearParseTreeBuilder()
+    tokens = list(tokens)
+    statements = _split(tokens, frozenset(sync_tokens))
+    chunks = _group(statements, chunk_size)
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    try:
+        if processes <= 1 or len(chunks) <= 1:
+            results = [_parse_statements(rule_set, item_head, builder, chunk) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                     initargs=(rule_set, item_head, builder)) as executor:
+                results = [_loads(rule_set, data) for data in executor.map(_parse_chunk, chunks)]
+        items = _stitch(rule_set, item_head, builder, chunks, results)
+    except ParseError:
+        # Errors found in a single item have indices relative to that item
+        items = None
+    if items is None or (not items and rule.symbols[0].min_occurs != 0):
+        return parse(rule_set, head, tokens).apply(builder)
+    return _build(builder, rule, items, len(tokens))
+
+
+def _repetition_rule(rule_set, head):
+    # Finds the rule for head, and the head of the item it repeats
+    rules = list(rule_set.get(head))
+    if len(rules) == 1 and len(rules[0].symbols) == 1:
+        symbol = rules[0].symbols[0]
+        if isinstance(symbol, NonTerminal) and symbol.multiple:
+            return rules[0], symbol.head
+    raise ValueError("{0!r} must have a single rule, with a single star or plus non-terminal".format(head))
+
+
+def _split(tokens, sync_tokens):
+    # Returns lists of tokens, each ending with a sync token except perhaps the last
+    statements = []
+    start = 0
+    for i, token in enumerate(tokens):
+        if token in sync_tokens:
+            statements.append(tokens[start:i + 1])
+            start = i + 1
+    if start < len(tokens):
+        statements.append(tokens[start:])
+    return statements
+
+
+def _group(statements, chunk_size):
+    # Returns lists of statements, of roughly chunk_size tokens each
+    chunks = []
+    chunk = []
+    size = 0
+    for statement in statements:
+        chunk.append(statement)
+        size += len(statement)
+        if size >= chunk_size:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _parse_statements(rule_set, item_head, builder, statements):
+    """Parses each statement as an item, joining statements that only parse together.
+    Returns a list of (value, length) for each item, and the index of the first statement that couldn't be parsed,
+    or None. Returns None instead of a list if the input can't be parsed whatever follows it."""
+    items = []
+    i = 0
+    while i < len(statements):
+        tokens = statements[i]
+        j = i + 1
+        while True:
+            try:
+                forest = parse(rule_set, item_head, tokens)
+                break
+            except NoParseError as e:
+                if e.start_index < len(tokens):
+                    # Earley parsers detect errors as soon as possible, so no further tokens can help
+                    return None, i
+                if j == len(statements):
+                    return items, i
+                tokens = tokens + statements[j]
+                j += 1
+        items.append((forest.apply(builder), len(tokens)))
+        i = j
+    return items, None
+
+
+def _stitch(rule_set, item_head, builder, chunks, results):
+    # Combines the items parsed from each chunk, re-parsing where a chunk didn't end with a complete item.
+    # Returns None if the input can't be split into items.
+    items = []
+    carry = []
+    for chunk, (chunk_items, failed_at) in zip(chunks, results):
+        if carry:
+            # The last item of the previous chunk continues into this one
+            chunk_items, failed_at = _parse_statements(rule_set, item_head, builder, carry + chunk)
+            chunk = carry + chunk
+        if chunk_items is None:
+            return None
+        items.extend(chunk_items)
+        carry = chunk[failed_at:] if failed_at is not None else []
+    if carry:
+        return None
+    return items
+
+
+def _build(builder, rule, items, length):
+    # Makes the same builder calls as ParseForest.apply would for rule matching the items
+    value = builder.start_rule(BuilderContext(rule, 0, 0, 0))
+    value = builder.begin_multiple(BuilderContext(rule, 0, 0, 0), value)
+    position = 0
+    for item_value, item_length in items:
+        value = builder.extend(BuilderContext(rule, 0, 0, position), value, item_value)
+        position += item_length
+    value = builder.end_multiple(BuilderContext(rule, 0, 0, length), value)
+    return builder.end_rule(BuilderContext(rule, 1, 0, length), value)
+
+
+# State of each worker process, set by _init_worker
+_worker = None
+
+
+def _init_worker(rule_set, item_head, builder):
+    global _worker
+    _worker = (rule_set, item_head, builder)
+
+
+def _parse_chunk(statements):
+    rule_set, item_head, builder = _worker
+    result = _parse_statements(rule_set, item_head, builder, statements)
+    # Rules are sent by position, so the results refer to the rules of the calling process
+    f = io.BytesIO()
+    _RulePickle(rule_set).dump(f, result)
+    return f.getvalue()
+
+
+def _loads(rule_set, data):
+    return _RulePickle(rule_set).load(io.BytesIO(data))
+
+
+__all__ = [
+    "parse_parallel",
+]
@@ -0,0 +1,65 @@
+"""Compares `BitsetRecognizer.accepts` with `parse` for validating many inputs. Requires NumPy.
+
+Run from the repository root with::
+
+    PYTHONPATH=. python benchmarks/bitset_benchmark.py
+"""
+import random
+import time
+
+from axaxaxas import ParseRule, ParseRuleSet, Terminal as T, NonTerminal as NT, parse
+from axaxaxas.bitset import BitsetRecognizer
+
+
+def statements(rng):
+    rule_set = ParseRuleSet()
+    rule_set.add(ParseRule("program", [NT("stmt", star=True)]))
+    rule_set.add(ParseRule("stmt", [T("id"), T("="), NT("expr"), T(";")]))
+    rule_set.add(ParseRule("stmt", [T("{"), NT("program"), T("}")]))
+    rule_set.add(ParseRule("expr", [NT("expr"), T("+"), NT("term")]))
+    rule_set.add(ParseRule("expr", [NT("term")]))
+    rule_set.add(ParseRule("term", [NT("term"), T("*"), NT("atom")]))
+    rule_set.add(ParseRule("term", [NT("atom")]))
+    rule_set.add(ParseRule("atom", [T("id")]))
+    rule_set.add(ParseRule("atom", [T("("), NT("expr"), T(")")]))
+    text = "id = id + id * ( id + id ) ; { id = id ; } "
+    return rule_set, "program", [(text * rng.randrange(1, 9)).split() for i in range(200)]
+
+
+def keywords(rng):
+    rule_set = ParseRuleSet()
+    words = ["w{0}".format(i) for i in range(300)]
+    rule_set.add(ParseRule("top", [NT("word", star=True)]))
+    for word in words:
+        rule_set.add(ParseRule("word", [T(word)]))
+    return rule_set, "top", [[rng.choice(words) for j in range(30)] for i in range(30)]
+
+
+def ambiguous(rng):
+    rule_set = ParseRuleSet()
+    rule_set.add(ParseRule("expr", [NT("expr"), T("+"), NT("expr")]))
+    rule_set.add(ParseRule("expr", [T("x")]))
+    return rule_set, "expr", [("x + " * rng.randrange(5, 30) + "x").split() for i in range(12)]
+
+
+def measure(function, inputs):
+    start = time.perf_counter()
+    for tokens in inputs:
+        function(tokens)
+    return time.perf_counter() - start
+
+
+def main():
+    rng = random.Random(0)
+    print("{0:<12} {1:>8} {2:>9} {3:>9} {4:>8}".format("grammar", "tokens", "parse s", "bitset s", "speedup"))
+    for name, make in [("statements", statements), ("keywords", keywords), ("ambiguous", ambiguous)]:
+        rule_set, head, inputs = make(rng)
+        recognizer = BitsetRecognizer(rule_set, head)
+        parse_time = measure(lambda tokens: parse(rule_set, head, tokens), inputs)
+        bitset_time = measure(recognizer.accepts, inputs)
+        print("{0:<12} {1:>8} {2:>9.2f} {3:>9.2f} {4:>8.1f}".format(
+            name, sum(map(len, inputs)), parse_time, bitset_time, parse_time / bitset_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Measures the time and memory taken by long ``star`` and ``plus`` repetitions.
+
+Chart items and forest nodes are reported for reference. The chart still holds one item per match for the
+repeated symbol itself, so they grow linearly; it is the size of each item that has been reduced.
+
+Run from the repository root with::
+
+    PYTHONPATH=. python benchmarks/star_memory_benchmark.py [n ...]
+"""
+import gc
+import sys
+import time
+import tracemalloc
+
+from axaxaxas import ParseRule, ParseRuleSet, Terminal as T, NonTerminal as NT, parse
+
+
+def grammars():
+    terminal_star = ParseRuleSet()
+    terminal_star.add(ParseRule("top", [T("x", star=True)]))
+
+    terminal_plus = ParseRuleSet()
+    terminal_plus.add(ParseRule("top", [T("x", plus=True), T("end", optional=True)]))
+
+    nonterminal_star = ParseRuleSet()
+    nonterminal_star.add(ParseRule("top", [NT("item", star=True)]))
+    nonterminal_star.add(ParseRule("item", [T("x")]))
+
+    nonterminal_plus = ParseRuleSet()
+    nonterminal_plus.add(ParseRule("top", [T("("), NT("item", plus=True), T(")", optional=True)]))
+    nonterminal_plus.add(ParseRule("item", [T("x")]))
+
+    return [
+        ("terminal star", terminal_star, lambda n: ["x"] * n),
+        ("terminal plus", terminal_plus, lambda n: ["x"] * n),
+        ("nonterminal star", nonterminal_star, lambda n: ["x"] * n),
+        ("nonterminal plus", nonterminal_plus, lambda n: ["("] + ["x"] * n),
+    ]
+
+
+def measure(rule_set, tokens):
+    gc.collect()
+    start = time.perf_counter()
+    forest = parse(rule_set, "top", tokens)
+    parse_time = time.perf_counter() - start
+    start = time.perf_counter()
+    forest.single()
+    single_time = time.perf_counter() - start
+    del forest
+
+    # Memory is measured separately, as tracing slows parsing down considerably
+    gc.collect()
+    tracemalloc.start()
+    forest = parse(rule_set, "top", tokens)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return forest.stats.items, forest.stats.forest_nodes, parse_time, single_time, peak
+
+
+def main(sizes):
+    print("{0:<18} {1:>7} {2:>9} {3:>10} {4:>9} {5:>9} {6:>11}".format(
+        "grammar", "n", "items", "forest", "parse s", "single s", "peak MiB"))
+    for name, rule_set, make_tokens in grammars():
+        for n in sizes:
+            items, forest_nodes, parse_time, single_time, peak = measure(rule_set, make_tokens(n))
+            print("{0:<18} {1:>7} {2:>9} {3:>10} {4:>9.2f} {5:>9.2f} {6:>11.1f}".format(
+                name, n, items, forest_nodes, parse_time, single_time, peak / 2**20))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 50000])
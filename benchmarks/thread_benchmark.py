@@ -0,0 +1,77 @@
+"""Measures parsing throughput with several threads sharing one frozen grammar.
+
+Run from the repository root with::
+
+    PYTHONPATH=. python benchmarks/thread_benchmark.py [threads ...]
+
+With the GIL, extra threads add no throughput, but the results are still correct. On a free-threaded build of
+CPython, throughput should scale with the number of cores.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import random
+import sys
+import time
+
+from axaxaxas import ParseRule, ParseRuleSet, Terminal as T, NonTerminal as NT, parse
+
+
+def grammar():
+    rule_set = ParseRuleSet()
+    rule_set.add(ParseRule("expr", [NT("term"), NT("more", star=True)]))
+    rule_set.add(ParseRule("more", [T("+"), NT("term")]))
+    rule_set.add(ParseRule("more", [T("-"), NT("term")]))
+    rule_set.add(ParseRule("term", [NT("atom"), NT("factor", star=True)]))
+    rule_set.add(ParseRule("factor", [T("*"), NT("atom")]))
+    rule_set.add(ParseRule("atom", [T("x")]))
+    rule_set.add(ParseRule("atom", [T("("), NT("expr"), T(")")]))
+    return rule_set.freeze()
+
+
+def random_expr(rng, depth=0):
+    tokens = random_term(rng, depth)
+    for i in range(rng.randrange(4)):
+        tokens += [rng.choice("+-")] + random_term(rng, depth)
+    return tokens
+
+
+def random_term(rng, depth):
+    tokens = random_atom(rng, depth)
+    for i in range(rng.randrange(3)):
+        tokens += ["*"] + random_atom(rng, depth)
+    return tokens
+
+
+def random_atom(rng, depth):
+    if depth < 3 and rng.random() < 0.3:
+        return ["("] + random_expr(rng, depth + 1) + [")"]
+    return ["x"]
+
+
+def measure(rule_set, inputs, threads):
+    def work(tokens):
+        return parse(rule_set, "expr", tokens).single()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for tree in executor.map(work, inputs):
+            pass
+    return time.perf_counter() - start
+
+
+def main(thread_counts):
+    rng = random.Random(0)
+    rule_set = grammar()
+    inputs = [random_expr(rng) for i in range(500)]
+    tokens = sum(map(len, inputs))
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print("{0} inputs, {1} tokens, GIL {2}".format(len(inputs), tokens, "enabled" if gil else "disabled"))
+    print("{0:>7} {1:>9} {2:>12} {3:>9}".format("threads", "time s", "tokens/s", "speedup"))
+    baseline = None
+    for threads in thread_counts:
+        elapsed = measure(rule_set, inputs, threads)
+        baseline = baseline or elapsed
+        print("{0:>7} {1:>9.2f} {2:>12.0f} {3:>9.2f}".format(threads, elapsed, tokens / elapsed, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1, 2, 4, 8])
@@ -17,5 +17,6 @@ setup(
         ],
     keywords='earley parser natural language',
     packages=["axaxaxas"],
+    extras_require={"numpy": ["numpy"]},
 )
 
@@ -0,0 +1,59 @@
+from axaxaxas import ParseRule, ParseRuleSet, Terminal as T, NonTerminal as NT, NoParseError, parse
+from axaxaxas.aio import parse_async
+import asyncio
+import unittest
+
+
+async def async_tokens(tokens):
+    for token in tokens:
+        yield token
+
+
+class ParseAsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.grammar = grammar = ParseRuleSet()
+        grammar.add(ParseRule("list", [NT("item", star=True)]))
+        grammar.add(ParseRule("item", [T("a")]))
+        grammar.add(ParseRule("item", [T("("), NT("list"), T(")")]))
+
+    def test_parse(self):
+        tokens = "( a a ) a ( ( a ) )".split()
+        for source in [async_tokens(tokens), tokens]:
+            forest = asyncio.run(parse_async(self.grammar, "list", source, yield_every=2))
+            self.assertEqual(forest.single(), parse(self.grammar, "list", tokens).single())
+
+    def test_error(self):
+        with self.assertRaises(NoParseError) as cm:
+            asyncio.run(parse_async(self.grammar, "list", async_tokens("( a ) )".split())))
+        self.assertEqual(cm.exception.start_index, 3)
+        with self.assertRaises(NoParseError):
+            asyncio.run(parse_async(self.grammar, "list", async_tokens("( a".split())))
+
+    def test_yield_every_invalid(self):
+        for source in [async_tokens(["a"]), ["a"]]:
+            with self.assertRaises(ValueError):
+                asyncio.run(parse_async(self.grammar, "list", source, yield_every=0))
+
+    def test_yields_to_loop(self):
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0)
+
+        async def main(source):
+            task = asyncio.ensure_future(ticker())
+            await asyncio.sleep(0)
+            ticks.clear()
+            forest = await parse_async(self.grammar, "list", source, yield_every=100)
+            task.cancel()
+            return forest
+
+        for source in [async_tokens(["a"] * 1000), ["a"] * 1000]:
+            forest = asyncio.run(main(source))
+            self.assertEqual(forest.count(), 1)
+            self.assertGreaterEqual(len(ticks), 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,8 +3,16 @@ import os
 sys.path.insert(0, os.path.abspath('../axaxaxas'))
 
 import unittest
-from axaxaxas import parse, unparse, ParseRuleSet, NoParseError, AmbiguousParseError, InfiniteParseError, ParseTree, NonTerminal, Terminal
+from axaxaxas import parse, parse_batch, unparse, iter_unparse, unparse_to, ParseRuleSet, NoParseError, AmbiguousParseError, InfiniteParseError, ParseTree, NonTerminal, Terminal, CharacterClass, ParseSession, ParseLimits, ParseLimitError
+import pickle
+import threading
+import time
+import tracemalloc
 import axaxaxas
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # The simplest possible lexer, for testing
 def lex(s):
@@ -33,8 +41,10 @@ class EarleyParserTestCase(unittest.TestCase):
         parse_forest = parse(self.p, "top", lex(text))
         result_trees1 = set(map(simplify_parse_tree, parse_forest))
         result_trees2 = set(map(simplify_parse_tree, parse_forest.all()))
+        result_trees3 = set(map(simplify_parse_tree, parse_forest.compact().all()))
         expected_trees = set(trees)
         self.assertSetEqual(result_trees1, result_trees2)
+        self.assertSetEqual(result_trees1, result_trees3)
         extra_results = result_trees1 - expected_trees
         missing_results = expected_trees - result_trees1
         t = []
@@ -46,13 +56,23 @@ class EarleyParserTestCase(unittest.TestCase):
             self.assertFalse(extra_results or missing_results, "\n".join(t))
 
     def roundtrip(self, text):
-        round_trip = unlex(unparse(parse(self.p, "top", lex(text)).single()))
+        forest = parse(self.p, "top", lex(text))
+        round_trip = unlex(unparse(forest.single()))
         self.assertEqual(text.strip(), round_trip.strip())
+        self.assertFalse(forest.is_ambiguous())
+        self.assertEqual(forest.ambiguities(), [])
 
     def ambig(self, text, start_index=None, end_index=None, values=None):
         with self.assertRaises(AmbiguousParseError) as cm:
             parse(self.p, "top", lex(text)).single()
         e = cm.exception
+        with self.assertRaises(AmbiguousParseError) as cm:
+            parse(self.p, "top", lex(text)).compact().single()
+        self.assertEqual((e.start_index, e.end_index), (cm.exception.start_index, cm.exception.end_index))
+        forest = parse(self.p, "top", lex(text))
+        self.assertTrue(forest.is_ambiguous())
+        self.assertIn((e.start_index, e.end_index),
+                      [(context.start_index, context.end_index) for kind, context in forest.ambiguities()])
         if start_index is not None:
             self.assertEqual(e.start_index, start_index)
         if end_index is not None:
@@ -322,6 +342,65 @@ class EarleyParserTestCase(unittest.TestCase):
         self.assertEqual(forest.count(), 1)
         self.assertEqual(forest.internal_node_count, 3 + 3 * n)
 
+    def test_star_items_per_match(self):
+        # Repetitions are represented as before, at a fixed number of items for each match:
+        # the repeated rule, the rule after skipping the star, and the completed parse
+        p = self.p
+        p.add(ParseRule("1","top",[Terminal("a", star=True)]))
+
+        n = 1000
+        forest = parse(self.p, "top", ["a"] * n)
+        self.assertEqual(forest.stats.items, 4 + 3 * n)
+        self.assertEqual(forest.internal_node_count, 4 + n)
+
+    def test_complexity_star_tree(self):
+        # Building the tree for a long star symbol should take linear time too
+        p = self.p
+        p.add(ParseRule("1","top",[NonTerminal("a", star=True), Terminal("b")]))
+        p.add(ParseRule("2","a",[Terminal("a")]))
+
+        n = 20000
+        tree = parse(self.p, "top", ["a"] * n + ["b"]).single()
+        self.assertEqual(len(tree.children[0]), n)
+        self.assertEqual(tree.children[0][-1].children, ("a",))
+        self.assertEqual(tree.children[1], "b")
+
+    def test_ambig_star_values(self):
+        # Ambiguity in the middle of a star still reports the partial parse trees
+        p = self.p
+        p.add(ParseRule("1","top",[NonTerminal("a", star=True), Terminal("b")]))
+        p.add(ParseRule("2","a",[Terminal("a")]))
+        p.add(ParseRule("3","a",[Terminal("a"), Terminal("a")]))
+        with self.assertRaises(AmbiguousParseError) as cm:
+            parse(self.p, "top", lex("a a b")).single()
+        for value in cm.exception.values:
+            self.assertIsInstance(value, ParseTree)
+
+    def test_tree_builder_subclass(self):
+        # Subclasses of SingleParseTreeBuilder are passed ParseTree values, as they always were
+        p = self.p
+        p.add(ParseRule("1","top",[Terminal("b"), Terminal("a", star=True)]))
+        seen = []
+        class LastChildBuilder(axaxaxas.SingleParseTreeBuilder):
+            def extend(self, context, prev_value, extension_value):
+                seen.append((type(prev_value), prev_value.children[-1] if prev_value.children else None))
+                return super().extend(context, prev_value, extension_value)
+        tree = parse(self.p, "top", lex("b a a")).apply(LastChildBuilder())
+        self.assertEqual(tree.children, ("b", ("a", "a")))
+        self.assertEqual(seen, [(ParseTree, None), (ParseTree, ()), (ParseTree, ("a",))])
+
+    def test_linear_tree_builder_subclass(self):
+        # LinearParseTreeBuilder passes PartialParseTree values, which can still be read like a ParseTree
+        p = self.p
+        p.add(ParseRule("1","top",[Terminal("b"), Terminal("a", star=True)]))
+        seen = []
+        class LastChildBuilder(axaxaxas.LinearParseTreeBuilder):
+            def extend(self, context, prev_value, extension_value):
+                seen.append((prev_value.rule.head, prev_value.children[-1] if prev_value.children else None))
+                return super().extend(context, prev_value, extension_value)
+        tree = parse(self.p, "top", lex("b a a")).apply(LastChildBuilder())
+        self.assertEqual(tree, parse(self.p, "top", lex("b a a")).apply(axaxaxas.SingleParseTreeBuilder()))
+        self.assertEqual(seen, [("top", None), ("top", ()), ("top", ("a",))])
 
     
     def test_greedy(self):
@@ -381,5 +460,1029 @@ class EarleyParserTestCase(unittest.TestCase):
     
         self.roundtrip("a")
 
+class CountingRuleSet(ParseRuleSet):
+    def __init__(self):
+        super().__init__()
+        self.anonymous_calls = 0
+
+    def is_anonymous(self, head):
+        self.anonymous_calls += 1
+        return super().is_anonymous(head)
+
+class LazyNoParseErrorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = p = CountingRuleSet()
+        p.add(ParseRule("sum", "expr", [NonTerminal("expr"), Terminal("+"), NonTerminal("expr")]))
+        p.add(ParseRule("x", "expr", [Terminal("x")]))
+
+    def test_lazy(self):
+        with self.assertRaises(NoParseError) as cm:
+            parse(self.p, "expr", lex("x +"))
+        e = cm.exception
+        self.assertEqual((e.start_index, e.encountered), (2, None))
+        self.assertEqual(self.p.anonymous_calls, 0)
+        self.assertEqual(list(map(repr, e.expected)), list(map(repr, [NonTerminal("expr")])))
+        self.assertGreater(self.p.anonymous_calls, 0)
+        self.assertEqual(list(map(repr, e.expected_terminals)), list(map(repr, [Terminal("x")])))
+        self.assertEqual(str(e), "Unexpected end, was expecting <expr>.")
+        self.assertEqual(e.args, (e.message,))
+
+    def test_str(self):
+        with self.assertRaises(NoParseError) as cm:
+            parse(self.p, "expr", lex("x x"))
+        self.assertEqual(str(cm.exception), "Unexpected 'x', was expecting '+'.")
+        self.assertIn("Unexpected 'x'", repr(cm.exception))
+
+    def test_pickle(self):
+        with self.assertRaises(NoParseError) as cm:
+            parse(self.p, "expr", lex("x x"))
+        e = pickle.loads(pickle.dumps(cm.exception))
+        self.assertEqual((e.start_index, e.end_index, e.encountered), (1, 1, "x"))
+        self.assertEqual(e.message, "Unexpected 'x', was expecting '+'.")
+        self.assertEqual(list(map(repr, e.expected)), list(map(repr, [Terminal("+")])))
+
+    def test_eager(self):
+        e = NoParseError("message", 0, 0, "a", [Terminal("b")], [NonTerminal("c")])
+        self.assertEqual(str(e), "message")
+        self.assertEqual(list(map(repr, e.expected_terminals)), list(map(repr, [Terminal("b")])))
+        self.assertEqual(list(map(repr, e.expected)), list(map(repr, [NonTerminal("c")])))
+
+class CountingTerminal(Terminal):
+    calls = 0
+
+    def match(self, token):
+        CountingTerminal.calls += 1
+        return token.isdigit()
+
+class MatchMemoTestCase(unittest.TestCase):
+    def setUp(self):
+        CountingTerminal.calls = 0
+        self.digit = CountingTerminal(None)
+        self.p = p = ParseRuleSet()
+        # Several rules wait on the same terminal at each position
+        p.add(ParseRule("top", "top", [NonTerminal("x", star=True)]))
+        p.add(ParseRule("x1", "x", [self.digit, Terminal("a")]))
+        p.add(ParseRule("x2", "x", [self.digit, Terminal("b")]))
+        p.add(ParseRule("x3", "x", [self.digit, Terminal("c")]))
+
+    def test_per_position(self):
+        parse(self.p, "top", lex("1 a 2 b 3 c"))
+        # Called once per position where a digit is possible
+        self.assertEqual(CountingTerminal.calls, 3)
+
+    def test_match_key(self):
+        # Distinct terminals that declare the same match key are only called once
+        other = CountingTerminal(None)
+        self.digit.match_key = other.match_key = "digit"
+        self.p.add(ParseRule("x4", "x", [other, Terminal("d")]))
+        self.assertEqual(parse(self.p, "top", lex("1 a 2 d")).count(), 1)
+        self.assertEqual(CountingTerminal.calls, 2)
+
+    def test_match_cache(self):
+        self.p.match_cache = cache = axaxaxas.MatchCache()
+        parse(self.p, "top", lex("1 a 1 b 1 c"))
+        parse(self.p, "top", lex("1 a"))
+        self.assertEqual(CountingTerminal.calls, 1)
+        # The digit is found 3 times out of 4. The a, b and c terminals are checked against
+        # "a", "b" and "c" by the first parse, and "a" again by the second.
+        self.assertEqual((cache.hits, cache.misses), (3 + 3, 1 + 9))
+        self.assertEqual(cache.hit_rate, 6 / 16)
+
+    def test_builtin_keys(self):
+        self.assertEqual(CharacterClass("ab").match_key, CharacterClass("ba").match_key)
+        self.assertNotEqual(CharacterClass("ab").match_key, CharacterClass("ab", negate=True).match_key)
+        self.assertEqual(axaxaxas.RegexTerminal("a+").match_key, axaxaxas.RegexTerminal("a+").match_key)
+        self.assertIsNone(Terminal("a").match_key)
+
+class GeneratingRuleSet(ParseRuleSet):
+    """Generates rules for "list" on the fly, counting calls to get"""
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def get(self, head, lookahead_token=None):
+        self.calls += 1
+        if head == "list":
+            return (rule for rule in [ParseRule("list", "list", [NonTerminal("item", star=True)])])
+        return super().get(head)
+
+class RuleMemoTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = p = GeneratingRuleSet()
+        p.add(ParseRule("a", "item", [Terminal("a")]))
+        p.add(ParseRule("parens", "item", [Terminal("("), NonTerminal("list"), Terminal(")")]))
+
+    def test_per_parse(self):
+        forest = parse(self.p, "list", lex("a ( a ( a ) ) a"))
+        self.assertEqual(forest.count(), 1)
+        # Once for each of list and item
+        self.assertEqual(self.p.calls, 2)
+        self.assertEqual(forest.stats.rule_gets, 2)
+        self.assertEqual(forest.stats.rule_lookups, 12)
+
+    def test_not_memoized(self):
+        self.p.memoize_get = False
+        forest = parse(self.p, "list", lex("a ( a ( a ) ) a"))
+        self.assertEqual(self.p.calls, 12)
+        self.assertEqual(forest.stats.rule_gets, 12)
+
+    def test_rule_cache(self):
+        self.p.rule_cache = cache = axaxaxas.RuleCache()
+        parse(self.p, "list", lex("a ( a )"))
+        parse(self.p, "list", lex("a"))
+        self.assertEqual(self.p.calls, 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(cache.hit_rate, 0.5)
+        # Adding a rule discards cached results
+        self.p.add(ParseRule("b", "item", [Terminal("b")]))
+        self.assertEqual(parse(self.p, "list", lex("a b")).count(), 1)
+        self.assertEqual(self.p.calls, 4)
+
+    def test_rule_cache_maxsize(self):
+        self.p.rule_cache = cache = axaxaxas.RuleCache(maxsize=2)
+        parse(self.p, "list", lex("a"))
+        parse(self.p, "list", lex("a"))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        # Each parse looks up list then item, so with room for one, neither is found
+        self.p.rule_cache = cache = axaxaxas.RuleCache(maxsize=1)
+        parse(self.p, "list", lex("a"))
+        parse(self.p, "list", lex("a"))
+        self.assertEqual((cache.hits, cache.misses), (0, 4))
+
+class FreezeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = p = ParseRuleSet()
+        p.add(ParseRule("sum", "expr", [NonTerminal("expr"), Terminal("+"), NonTerminal("expr")]))
+        p.add(ParseRule("parens", "expr", [Terminal("("), NonTerminal("expr"), Terminal(")")]))
+        p.add(ParseRule("x", "expr", [Terminal("x")]))
+        self.frozen = self.p.freeze()
+
+    def test_snapshot(self):
+        self.assertEqual(list(self.frozen), list(self.p))
+        self.assertIs(self.frozen.freeze(), self.frozen)
+        self.p.add(ParseRule("y", "expr", [Terminal("y")]))
+        self.assertEqual(parse(self.p, "expr", lex("x + y")).count(), 1)
+        with self.assertRaises(NoParseError):
+            parse(self.frozen, "expr", lex("x + y"))
+        with self.assertRaises(TypeError):
+            self.frozen.add(ParseRule("y", "expr", [Terminal("y")]))
+
+    def test_get(self):
+        self.assertEqual(len(self.frozen.get("expr")), 3)
+        self.assertEqual(self.frozen.get("missing"), ())
+        self.assertNotIn("missing", self.frozen._rules)
+
+    def test_threads(self):
+        inputs = ["x", "x + x", "( x + x ) + x", "x + ( x + ( x ) )", "x + x + x + x", "( x"]
+        expected = []
+        for s in inputs:
+            try:
+                expected.append(sorted(map(repr, parse(self.frozen, "expr", lex(s)).all())))
+            except NoParseError as e:
+                expected.append(str(e))
+        failures = []
+
+        def run():
+            for i in range(20):
+                for s, e in zip(inputs, expected):
+                    try:
+                        result = sorted(map(repr, parse(self.frozen, "expr", lex(s)).all()))
+                    except NoParseError as error:
+                        result = str(error)
+                    if result != e:
+                        failures.append((s, result))
+
+        threads = [threading.Thread(target=run) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+
+class VocabularyTestCase(unittest.TestCase):
+    def setUp(self):
+        CountingTerminal.calls = 0
+        self.p = p = ParseRuleSet()
+        p.add(ParseRule("top", "top", [NonTerminal("x", star=True)]))
+        for word in ["a", "b", "c", "d"]:
+            p.add(ParseRule(word, "x", [Terminal(word)]))
+        p.add(ParseRule("digit", "x", [CountingTerminal(None)]))
+        self.v = axaxaxas.Vocabulary.from_rule_set(p)
+
+    def test_from_rule_set(self):
+        # Only plain terminals are included
+        self.assertEqual(self.v.tokens, ["a", "b", "c", "d"])
+        self.assertEqual(self.v.encode(["b", "1", "a"]), [1, -1, 0])
+        self.assertEqual(self.v.decode([3, 2]), ["d", "c"])
+        self.assertEqual(len(self.v), 4)
+
+    def test_parse(self):
+        tokens = lex("a 1 d c 2")
+        expected = parse(self.p, "top", tokens).single()
+        CountingTerminal.calls = 0
+        tree = parse(self.p, "top", tokens, vocabulary=self.v).single()
+        self.assertEqual(tree, expected)
+        # Plain terminals are looked up by id, so only the digit terminal is matched
+        self.assertEqual(CountingTerminal.calls, 5)
+        # Rules starting with a plain terminal are only created if the token matches
+        self.assertLess(parse(self.p, "top", tokens, vocabulary=self.v).stats.items,
+                        parse(self.p, "top", tokens).stats.items)
+
+    def test_error(self):
+        with self.assertRaises(NoParseError) as cm:
+            parse(self.p, "top", lex("a e"), vocabulary=self.v)
+        self.assertEqual(cm.exception.encountered, "e")
+        self.assertEqual(sorted(str(symbol) for symbol in cm.exception.expected_terminals),
+                         ["'None'", "'a'", "'b'", "'c'", "'d'"])
+
+    def test_added_terminals(self):
+        # Terminals not in the vocabulary are given ids as they are found
+        self.p.add(ParseRule("e", "x", [Terminal("e")]))
+        self.assertEqual(parse(self.p, "top", lex("e a"), vocabulary=self.v).count(), 1)
+        self.assertEqual(self.v.ids["e"], 4)
+
+    def test_batch(self):
+        forests = parse_batch(self.p, "top", [lex("a b"), lex("a 1"), lex("a c")], vocabulary=self.v)
+        self.assertEqual([forest.count() for forest in forests], [1, 1, 1])
+
+class EncodedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = p = ParseRuleSet()
+        p.add(ParseRule("top", "top", [NonTerminal("x", star=True)]))
+        p.add(ParseRule("word", "x", [Terminal("a")]))
+        p.add(ParseRule("word", "x", [Terminal("b")]))
+        p.add(ParseRule("any", "x", [Terminal("c"), CharacterClass("ab")]))
+        self.v = axaxaxas.Vocabulary(["a", "b", "c"])
+
+    def check(self, token_ids):
+        tree = parse(self.p, "top", token_ids, vocabulary=self.v, encoded=True).single()
+        self.assertEqual(unparse(tree), self.v.decode(token_ids))
+        return tree
+
+    def test_array(self):
+        from array import array
+        tree = self.check(array("I", [0, 2, 1, 1]))
+        # Leaves are the tokens of the vocabulary
+        self.assertIs(unparse(tree)[0], self.v.tokens[0])
+
+    def test_list(self):
+        self.check([2, 0, 1])
+
+    def test_mmap(self):
+        import mmap
+        import tempfile
+        from array import array
+        with tempfile.TemporaryFile() as f:
+            f.write(array("I", [0, 1, 2, 0]).tobytes())
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m).cast("I")
+                try:
+                    self.check(view)
+                    with self.assertRaises(NoParseError) as cm:
+                        parse(self.p, "top", view[:3], vocabulary=self.v, encoded=True)
+                finally:
+                    view.release()
+
+    @unittest.skipUnless(numpy, "numpy is not installed")
+    def test_numpy(self):
+        self.check(numpy.array([1, 2, 0, 0], dtype=numpy.uint32))
+
+    def test_errors(self):
+        with self.assertRaises(NoParseError) as cm:
+            parse(self.p, "top", [0, 7], vocabulary=self.v, encoded=True)
+        self.assertEqual(cm.exception.encountered, 7)
+        self.assertEqual(cm.exception.start_index, 1)
+        with self.assertRaises(NoParseError):
+            parse(self.p, "top", [0, -1], vocabulary=self.v, encoded=True)
+        with self.assertRaises(NoParseError) as cm:
+            parse(self.p, "top", [2, 2], vocabulary=self.v, encoded=True)
+        self.assertEqual(cm.exception.encountered, "c")
+        with self.assertRaises(ValueError):
+            parse(self.p, "top", memoryview(bytes(4)).cast("B", (2, 2)), vocabulary=self.v, encoded=True)
+        with self.assertRaises(ValueError):
+            parse(self.p, "top", [0], encoded=True)
+
+class CharacterClassTestCase(unittest.TestCase):
+    def test_match(self):
+        c = CharacterClass("_", ranges=[("a", "z"), ("0", "9")])
+        self.assertTrue(c.match("a"))
+        self.assertTrue(c.match("q"))
+        self.assertTrue(c.match("_"))
+        self.assertTrue(c.match("9"))
+        self.assertFalse(c.match("A"))
+        self.assertFalse(c.match("ab"))
+        self.assertFalse(c.match(1))
+
+    def test_match_non_latin(self):
+        c = CharacterClass("\u00e9", ranges=[("\u0391", "\u03a9"), ("\u4e00", "\u9fff")])
+        self.assertTrue(c.match("\u00e9"))
+        self.assertTrue(c.match("\u03a3"))
+        self.assertTrue(c.match("\u6587"))
+        self.assertFalse(c.match("\u03b1"))
+        self.assertFalse(c.match("\U0001F600"))
+
+    def test_negate(self):
+        c = CharacterClass("\"\\", negate=True)
+        self.assertTrue(c.match("a"))
+        self.assertTrue(c.match("\u6587"))
+        self.assertFalse(c.match("\""))
+        self.assertFalse(c.match("\\"))
+
+    def test_ranges_merged(self):
+        c = CharacterClass("abcx", ranges=[("b", "f")])
+        self.assertEqual(c.ranges, ((ord("a"), ord("f")), (ord("x"), ord("x"))))
+        self.assertEqual(str(c), "[a-fx]")
+
+    def test_scannerless(self):
+        p = ParseRuleSet()
+        p.add(ParseRule("list", "list", [NonTerminal("ident"), NonTerminal("more", star=True)]))
+        p.add(ParseRule("more", "more", [Terminal(","), NonTerminal("ident")]))
+        p.add(ParseRule("ident", "ident", [CharacterClass("_", ranges=[("a", "z")], plus=True)]))
+
+        text = "foo,bar_baz,q"
+        tree = parse(p, "list", text).single()
+        self.assertEqual("".join(unparse(tree)), text)
+        self.assertEqual(len(tree.children[1]), 2)
+
+        with self.assertRaises(NoParseError) as cm:
+            parse(p, "list", "foo,,bar").single()
+        self.assertEqual(cm.exception.start_index, 4)
+
+    def test_scannerless_vocabulary(self):
+        # Character classes are looked up by character, giving the same results as calling match
+        p = ParseRuleSet()
+        p.add(ParseRule("list", "list", [NonTerminal("word"), NonTerminal("more", star=True)]))
+        p.add(ParseRule("more", "more", [Terminal(","), NonTerminal("word")]))
+        p.add(ParseRule("word", "word", [CharacterClass("_", ranges=[("a", "z")], plus=True)]))
+        p.add(ParseRule("word", "word", [CharacterClass(",", negate=True), CharacterClass(ranges=[("0", "9")])]))
+        vocabulary = axaxaxas.Vocabulary.from_rule_set(p)
+        for text in ["foo,a1,\u6587\u0032,bar_baz", "x9"]:
+            trees = parse(p, "list", text, vocabulary=vocabulary).all()
+            self.assertEqual(sorted(map(repr, trees)), sorted(map(repr, parse(p, "list", text).all())))
+        self.assertTrue(vocabulary._class_tables)
+        with self.assertRaises(NoParseError) as cm:
+            parse(p, "list", "foo,,bar", vocabulary=vocabulary)
+        self.assertEqual(cm.exception.start_index, 4)
+
+    def test_scannerless_generator(self):
+        # The token stream is consumed lazily, so any iterator will do
+        p = ParseRuleSet()
+        p.add(ParseRule("digits", "digits", [CharacterClass(ranges=[("0", "9")], star=True)]))
+        forest = parse(p, "digits", (c for c in "0123456789" * 100))
+        self.assertEqual(len(forest.single().children[0]), 1000)
+
+class ParseSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = p = ParseRuleSet()
+        p.add(ParseRule("top", "top", [NonTerminal("item", star=True, greedy=True)]))
+        p.add(ParseRule("item1", "item", [Terminal("a")]))
+        p.add(ParseRule("item2", "item", [Terminal("b"), Terminal("a")]))
+
+    def check(self, session):
+        # A session should always agree with parsing from scratch
+        expected = simplify_parse_tree(parse(self.p, "top", session.tokens).single())
+        self.assertEqual(simplify_parse_tree(session.forest().single()), expected)
+
+    def test_feed(self):
+        session = ParseSession(self.p, "top")
+        for token in lex("a b a a"):
+            session.feed(token)
+        self.check(session)
+        self.assertEqual(session.tokens, ("a", "b", "a", "a"))
+        session.extend(lex("b a"))
+        self.check(session)
+
+    def test_edit(self):
+        session = ParseSession(self.p, "top", lex("a a a a a a"))
+        self.check(session)
+        prefix_columns = session._chart.columns[:4]
+        session.edit(3, 4, ["b"])
+        self.assertEqual(session.tokens, tuple(lex("a a a b a a")))
+        # The columns before the edit are reused as is
+        self.assertEqual(session._chart.columns[:4], prefix_columns)
+        self.check(session)
+        session.edit(1, 3, [])
+        self.check(session)
+        session.edit(0, 0, ["b", "a"])
+        self.check(session)
+
+    def test_error(self):
+        session = ParseSession(self.p, "top", lex("a a"))
+        with self.assertRaises(NoParseError) as cm:
+            session.edit(1, 1, ["c", "a"])
+        self.assertEqual(cm.exception.start_index, 1)
+        self.assertIs(session.error, cm.exception)
+        self.assertEqual(session.tokens, tuple(lex("a c a a")))
+        with self.assertRaises(NoParseError):
+            session.forest()
+        # Fixing the error recovers the session
+        session.edit(1, 2, ["b"])
+        self.assertIsNone(session.error)
+        self.check(session)
+
+    def test_initial_error(self):
+        # The constructor keeps the error rather than raising, so the session can be fixed
+        session = ParseSession(self.p, "top", lex("a c a"))
+        self.assertIsInstance(session.error, NoParseError)
+        self.assertEqual(session.error.start_index, 1)
+        self.assertEqual(session.tokens, tuple(lex("a c a")))
+        self.assertFalse(session.is_complete)
+        self.assertEqual(session.expected(), [])
+        with self.assertRaises(NoParseError):
+            session.forest()
+        session.edit(1, 2, ["b"])
+        self.assertIsNone(session.error)
+        self.check(session)
+
+    def test_incomplete(self):
+        p = ParseRuleSet()
+        p.add(ParseRule("top", "top", [Terminal("a"), Terminal("b")]))
+        session = ParseSession(p, "top", ["a"])
+        with self.assertRaises(NoParseError) as cm:
+            session.forest()
+        self.assertEqual(cm.exception.encountered, None)
+        session.feed("b")
+        self.assertEqual(session.forest().count(), 1)
+
+    def test_fork(self):
+        session = ParseSession(self.p, "top", lex("a b a"))
+        fork1 = session.fork()
+        fork2 = session.fork(1)
+        self.assertEqual(fork2.tokens, ("a",))
+        # The chart for the shared prefix is shared
+        self.assertIs(fork1._chart.columns[3], session._chart.columns[3])
+        self.assertIs(fork2._chart.columns[1], session._chart.columns[1])
+        fork1.extend(lex("a a"))
+        fork2.extend(lex("b a"))
+        session.feed("b")
+        self.assertEqual(fork1.tokens, tuple(lex("a b a a a")))
+        self.assertEqual(fork2.tokens, tuple(lex("a b a")))
+        self.assertEqual(session.tokens, tuple(lex("a b a b")))
+        self.check(fork1)
+        self.check(fork2)
+        with self.assertRaises(NoParseError):
+            session.forest()
+
+    def test_fork_error(self):
+        session = ParseSession(self.p, "top", lex("b a"))
+        with self.assertRaises(NoParseError):
+            session.extend(lex("c a"))
+        self.assertIsNotNone(session.fork().error)
+        self.assertIsNone(session.fork(2).error)
+        self.assertEqual(session.fork(2).forest().count(), 1)
+
+    def test_rollback(self):
+        session = ParseSession(self.p, "top", lex("a a"))
+        position = len(session)
+        for continuation in [lex("b a"), lex("a"), lex("c")]:
+            try:
+                session.extend(continuation)
+            except NoParseError:
+                pass
+            session.rollback(position)
+            self.assertIsNone(session.error)
+            self.check(session)
+        self.assertEqual(session.tokens, ("a", "a"))
+
+    def test_expected(self):
+        p = ParseRuleSet()
+        p.add(ParseRule("top", "top", [Terminal("I"), Terminal("want"), NonTerminal("item")]))
+        p.add(ParseRule("ham", "item", [Terminal("ham")]))
+        p.add(ParseRule("eggs", "item", [Terminal("eggs"), Terminal("and", optional=True)]))
+        session = ParseSession(p, "top", ["I"])
+        self.assertEqual(list(map(repr, session.expected_terminals())), ["Terminal('want')"])
+        self.assertFalse(session.is_complete)
+        session.feed("want")
+        self.assertEqual(set(map(repr, session.expected_terminals())), {"Terminal('ham')", "Terminal('eggs')"})
+        self.assertEqual(list(map(repr, session.expected())), ["NonTerminal('item')"])
+        self.assertTrue(session.accepts("ham"))
+        self.assertFalse(session.accepts("want"))
+        session.feed("eggs")
+        # Optional symbols may be expected, even when the tokens are already complete
+        self.assertTrue(session.is_complete)
+        self.assertEqual(list(map(repr, session.expected_terminals())), ["Terminal('and')"])
+        self.assertRaises(NoParseError, session.feed, "ham")
+        self.assertEqual(session.expected_terminals(), [])
+        self.assertEqual(session.expected(), [])
+        self.assertFalse(session.accepts("and"))
+        self.assertFalse(session.is_complete)
+
+    def test_forest_does_not_modify_chart(self):
+        # Building a forest trims links according to greedy, penalty etc.
+        # That must not affect later forests from the same session
+        p = ParseRuleSet()
+        p.add(ParseRule("top", "top", [Terminal("a", star=True, greedy=True), NonTerminal("x")]))
+        p.add(ParseRule("x1", "x", [Terminal("a", optional=True)]))
+        p.add(ParseRule("x2", "x", [Terminal("a"), Terminal("b")]))
+        session = ParseSession(p, "top", lex("a a"))
+        # Greedy trims the parse where x matches the second a
+        self.assertEqual(repr(session.forest().single()), "(top: ('a', 'a') (x: None))")
+        # But that's the only possible parse now
+        session.feed("b")
+        self.assertEqual(repr(session.forest().single()), "(top: ('a',) (x: 'a' 'b'))")
+
+class AmbiguitiesTestCase(unittest.TestCase):
+    def merges(self, forest):
+        # Finds the merges a builder is actually asked to make
+        merges = []
+        class MergeBuilder(axaxaxas.CountingBuilder):
+            def merge_vertical(self, context, values):
+                merges.append(("merge_vertical", context))
+                return 1
+            def merge_horizontal(self, context, values):
+                merges.append(("merge_horizontal", context))
+                return 1
+        forest.apply(MergeBuilder())
+        return sorted(merges, key=axaxaxas._ambiguity_key)
+
+    def test_ambiguities(self):
+        p = ParseRuleSet()
+        p.add(ParseRule("top", "top", [NonTerminal("X"), NonTerminal("Y"), NonTerminal("a")]))
+        p.add(ParseRule("X", "X", [Terminal("x"), Terminal("a", optional=True)]))
+        p.add(ParseRule("Y", "Y", [Terminal("a", optional=True), Terminal("y")]))
+        p.add(ParseRule("1", "a", [Terminal("a")]))
+        p.add(ParseRule("2", "a", [Terminal("a")]))
+        forest = parse(p, "top", lex("x a y a"))
+        ambiguities = forest.ambiguities()
+        self.assertEqual([(kind, context.rule.name, context.start_index, context.end_index)
+                          for kind, context in ambiguities],
+                         [("merge_horizontal", "top", 0, 3), ("merge_vertical", "top", 3, 4)])
+        self.assertEqual(ambiguities, self.merges(forest))
+        self.assertEqual(forest.compact().ambiguities(), ambiguities)
+        self.assertTrue(forest.is_ambiguous())
+        self.assertTrue(forest.compact().is_ambiguous())
+
+    def test_order(self):
+        # The gamma rule and top are both ambiguous at (0, 0), and must be ordered the same way by either forest
+        p = ParseRuleSet()
+        p.add(ParseRule("1", "top", [NonTerminal("E")]))
+        p.add(ParseRule("2", "top", []))
+        p.add(ParseRule("E1", "E", []))
+        p.add(ParseRule("E2", "E", []))
+        forest = parse(p, "top", [])
+        ambiguities = forest.ambiguities()
+        self.assertEqual([context.rule.head for kind, context in ambiguities], ["anon gamma", "top"])
+        self.assertEqual(forest.compact().ambiguities(), ambiguities)
+        self.assertEqual(ambiguities, self.merges(forest))
+
+    def test_trimmed(self):
+        # Branches removed by greedy trimming are not ambiguities
+        p = ParseRuleSet()
+        p.add(ParseRule("top", "top", [NonTerminal("B")]))
+        p.add(ParseRule("b", "B", [Terminal("b"), Terminal("a", optional=True, greedy=True),
+                                   NonTerminal("B", star=True, greedy=True)]))
+        forest = parse(p, "top", lex("b b b"))
+        self.assertEqual(forest.count(), 1)
+        self.assertFalse(forest.is_ambiguous())
+        self.assertFalse(forest.compact().is_ambiguous())
+        self.assertEqual(forest.ambiguities(), [])
+        self.assertEqual(forest.compact().ambiguities(), [])
+
+    def test_unambiguous(self):
+        p = ParseRuleSet()
+        p.add(ParseRule("1", "top", [Terminal("a")]))
+        p.add(ParseRule("2", "top", [NonTerminal("top"), NonTerminal("top")]))
+        forest = parse(p, "top", ["a"] * 2)
+        self.assertFalse(forest.is_ambiguous())
+        self.assertFalse(forest.compact().is_ambiguous())
+        forest = parse(p, "top", ["a"] * 8)
+        self.assertEqual(forest.ambiguities(), self.merges(forest))
+
+class SubforestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = p = ParseRuleSet()
+        p.add(ParseRule("s", "s", [NonTerminal("np"), Terminal("saw"), NonTerminal("np")]))
+        p.add(ParseRule("np", "np", [Terminal("I")]))
+        p.add(ParseRule("np", "np", [Terminal("the", optional=True), Terminal("man")]))
+        p.add(ParseRule("np pp", "np", [NonTerminal("np"), NonTerminal("pp")]))
+        p.add(ParseRule("pp", "pp", [Terminal("with"), NonTerminal("np")]))
+        p.add(ParseRule("s pp", "s", [NonTerminal("s"), NonTerminal("pp")]))
+        p.add(ParseRule("np", "np", [Terminal("the", optional=True), Terminal("telescope")]))
+        self.forest = parse(p, "s", lex("I saw the man with the telescope"))
+
+    def test_spans(self):
+        self.assertEqual(self.forest.count(), 2)
+        self.assertEqual(self.forest.spans("np"), [(0, 1), (2, 4), (2, 7), (5, 7)])
+        self.assertEqual(self.forest.spans("pp"), [(4, 7)])
+        self.assertEqual(self.forest.spans("nothing"), [])
+
+    def test_subforest(self):
+        np = self.forest.subforest("np", 2, 7)
+        self.assertEqual(np.count(), 1)
+        self.assertEqual(unparse(np.single()), lex("the man with the telescope"))
+        self.assertEqual(simplify_parse_tree(self.forest.subforest("np", 0, 1).single()), "(np: I)")
+        self.assertIsNone(self.forest.subforest("np", 0, 2))
+        s = self.forest.subforest("s", 0, 7)
+        self.assertEqual(set(map(simplify_parse_tree, s)), set(map(simplify_parse_tree, self.forest)))
+        self.assertEqual(s.internal_node_count, self.forest.internal_node_count)
+        self.assertEqual([event.kind for event in np.iter_events()][:2], ["start_rule", "start_rule"])
+
+    def test_trimmed(self):
+        # Sub forests only contain parses that survived trimming
+        p = ParseRuleSet()
+        p.add(ParseRule("top", "top", [NonTerminal("x", star=True)]))
+        p.add(ParseRule("x1", "x", [Terminal("a")]))
+        p.add(ParseRule("x2", "x", [Terminal("a"), Terminal("a")], penalty=1))
+        forest = parse(p, "top", lex("a a"))
+        self.assertEqual(forest.spans("x"), [(0, 1), (1, 2)])
+        self.assertEqual(forest.subforest("top", 0, 2).count(), 1)
+
+class EventTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = p = ParseRuleSet()
+        p.add(ParseRule("list", "list", [Terminal("("), NonTerminal("item", star=True), Terminal(")")]))
+        p.add(ParseRule("a", "item", [Terminal("a"), Terminal("!", optional=True)]))
+        p.add(ParseRule("b", "item", [Terminal("<"), Terminal("b", plus=True), Terminal(">")]))
+        p.add(ParseRule("sub", "item", [NonTerminal("list")]))
+
+    def rebuild(self, events):
+        # Reconstructs the parse tree from events, checking they are properly nested
+        stack = [[]]
+        for kind, context, token in events:
+            if kind == "start_rule":
+                stack.append([])
+            elif kind == "end_rule":
+                children = stack.pop()
+                stack[-1].append(ParseTree(context.rule, tuple(children)))
+            elif kind == "terminal":
+                stack[-1].append(token)
+            elif kind == "skip_optional":
+                stack[-1].append(None)
+            elif kind == "begin_multiple":
+                stack.append([])
+            elif kind == "end_multiple":
+                children = stack.pop()
+                stack[-1].append(tuple(children))
+        self.assertEqual(len(stack), 1)
+        self.assertEqual(len(stack[0]), 1)
+        return stack[0][0]
+
+    def test_events(self):
+        forest = parse(self.p, "list", lex("( a a ! ( < b b > ) ( ) )"))
+        tree = self.rebuild(forest.iter_events())
+        self.assertEqual(tree, forest.single())
+        events = []
+        forest.walk(lambda kind, context, token: events.append(kind))
+        self.assertEqual(events[:4], ["start_rule", "terminal", "begin_multiple", "start_rule"])
+
+    def test_deep(self):
+        n = 5000
+        forest = parse(self.p, "list", ["("] * n + [")"] * n)
+        kinds = [event.kind for event in forest.iter_events()]
+        self.assertEqual(kinds.count("start_rule"), 2 * n - 1)
+        self.assertEqual(kinds.count("terminal"), 2 * n)
+
+    def test_segments(self):
+        # Long repetitions are walked in segments, which must give the same events
+        tokens = lex("( " + "a a ! < b b b > ( a ) " * 20 + ")")
+        forest = parse(self.p, "list", tokens)
+        expected = list(forest.iter_events())
+        for block in [1, 2, 3, 7]:
+            forest._chain_block = block
+            self.assertEqual(list(forest.iter_events()), expected)
+        self.assertEqual(self.rebuild(expected), forest.single())
+
+    def test_long_repetition_memory(self):
+        forest = parse(self.p, "list", ["("] + ["a"] * 20000 + [")"])
+        tracemalloc.start()
+        try:
+            count = 0
+            for event in forest.iter_events():
+                count += 1
+            size, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(count, 4 * 20000 + 6)
+        # Holding every source of the repetition would take at least 8 bytes per item
+        self.assertLess(peak, 20000 * 8 / 2)
+
+    def test_trimmed(self):
+        # Branches removed by greedy trimming are not ambiguities, so the only tree can be walked
+        p = ParseRuleSet()
+        p.add(ParseRule("top", "top", [NonTerminal("B")]))
+        p.add(ParseRule("b", "B", [Terminal("b"), Terminal("a", optional=True, greedy=True),
+                                   NonTerminal("B", star=True, greedy=True)]))
+        forest = parse(p, "top", lex("b b b"))
+        self.assertEqual(forest.count(), 1)
+        self.assertEqual(self.rebuild(forest.iter_events()), forest.single())
+        events = []
+        forest.walk(lambda kind, context, token: events.append(kind))
+        self.assertEqual(events.count("start_rule"), 4)
+
+    def test_ambiguous(self):
+        self.p.add(ParseRule("a2", "item", [Terminal("a")]))
+        with self.assertRaises(AmbiguousParseError) as cm:
+            list(parse(self.p, "list", lex("( < b > a )")).iter_events())
+        self.assertEqual((cm.exception.start_index, cm.exception.end_index), (4, 5))
+
+class UnparseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rule = ParseRule("r", "r", [Terminal("a"), NonTerminal("r", optional=True), Terminal("b", star=True)])
+
+    def deep_tree(self, n):
+        tree = None
+        for i in range(n):
+            tree = ParseTree(self.rule, (str(i), tree, ("x", "y")))
+        return tree
+
+    def test_unparse(self):
+        tree = self.deep_tree(2)
+        self.assertEqual(unparse(tree), ["1", "0", "x", "y", "x", "y"])
+        self.assertEqual(list(iter_unparse(tree)), unparse(tree))
+        self.assertEqual(unparse([tree, None, "z"]), unparse(tree) + ["z"])
+        self.assertEqual(unparse(None), [])
+
+    def test_deep(self):
+        n = 10000
+        tokens = iter_unparse(self.deep_tree(n))
+        self.assertEqual(next(tokens), str(n - 1))
+        self.assertEqual(len(list(tokens)), 3 * n - 1)
+
+    def test_unparse_to(self):
+        import io
+        tree = self.deep_tree(1000)
+        f = io.StringIO()
+        unparse_to(tree, f, " ")
+        self.assertEqual(f.getvalue(), " ".join(unparse(tree)))
+        f = io.StringIO()
+        unparse_to(ParseTree(self.rule, ("a", None, ())), f, " ")
+        self.assertEqual(f.getvalue(), "a")
+
+class InternTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = p = ParseRuleSet()
+        p.add(ParseRule("1", "top", [Terminal("a")]))
+        p.add(ParseRule("2", "top", [NonTerminal("top"), NonTerminal("top")]))
+
+    def subtrees(self, trees):
+        seen = {}
+        stack = list(trees)
+        while stack:
+            tree = stack.pop()
+            if isinstance(tree, ParseTree) and id(tree) not in seen:
+                seen[id(tree)] = tree
+                stack.extend(tree.children)
+        return seen.values()
+
+    def test_all(self):
+        forest = parse(self.p, "top", ["a"] * 6)
+        trees = forest.all()
+        interned = forest.all(intern=True)
+        self.assertEqual(trees, interned)
+        self.assertEqual(set(trees), set(interned))
+        self.assertEqual(len(set(interned)), 42)
+        # Every distinct subtree is a single object
+        subtrees = self.subtrees(interned)
+        self.assertEqual(len(subtrees), len(set(subtrees)))
+        self.assertLess(len(subtrees), len(self.subtrees(trees)))
+
+    def test_single(self):
+        p = ParseRuleSet()
+        p.add(ParseRule("pair", "pair", [NonTerminal("x"), NonTerminal("x")]))
+        p.add(ParseRule("x", "x", [Terminal("a")]))
+        tree = parse(p, "pair", ["a", "a"]).single(intern=True)
+        self.assertIs(tree.children[0], tree.children[1])
+        self.assertEqual(tree, parse(p, "pair", ["a", "a"]).single())
+
+    def test_equal_tokens(self):
+        # Equal tokens from different positions aren't merged
+        from axaxaxas.lexer import Lexer
+        p = ParseRuleSet()
+        p.add(ParseRule("pair", "pair", [NonTerminal("x"), NonTerminal("x")]))
+        p.add(ParseRule("x", "x", [Terminal("a")]))
+        tree = parse(p, "pair", Lexer(p).tokenize("a a")).single(intern=True)
+        self.assertIsNot(tree.children[0], tree.children[1])
+        self.assertEqual([x.children[0].start for x in tree.children], [0, 2])
+
+    def test_pickle(self):
+        import pickle
+        tree = parse(self.p, "top", ["a"] * 3).all()[0]
+        hash(tree)
+        copy = pickle.loads(pickle.dumps(tree))
+        self.assertIsNone(copy._hash)
+        self.assertEqual(repr(copy), repr(tree))
+        self.assertEqual(hash(copy), hash(copy.to_tuple()))
+
+class ParseBatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = p = ParseRuleSet()
+        p.add(ParseRule("top", "top", [Terminal("a"), NonTerminal("item", star=True)]))
+        p.add(ParseRule("x", "item", [Terminal("x")]))
+        p.add(ParseRule("y", "item", [Terminal("y"), Terminal("y", optional=True)]))
+
+    def test_batch(self):
+        inputs = ["a x y", "a", "a x y y x", "a x", "a y y y", "a x y"]
+        results = parse_batch(self.p, "top", map(lex, inputs))
+        self.assertEqual(len(results), len(inputs))
+        for text, forest in zip(inputs, results):
+            self.assertEqual(repr(forest.all()), repr(parse(self.p, "top", lex(text)).all()))
+
+    def test_errors(self):
+        inputs = ["a x", "a z x", "a z y", "x", "", "a y"]
+        results = parse_batch(self.p, "top", map(lex, inputs), return_errors=True)
+        self.assertEqual([isinstance(result, NoParseError) for result in results],
+                         [False, True, True, True, True, False])
+        self.assertIs(results[1], results[2])
+        self.assertEqual(results[1].start_index, 1)
+        self.assertEqual(results[4].start_index, 0)
+        with self.assertRaises(NoParseError):
+            parse_batch(self.p, "top", map(lex, inputs))
+
+    def test_fail_if_empty(self):
+        results = parse_batch(self.p, "top", [["a", "z"], [], ["a"]], fail_if_empty=False, return_errors=True)
+        self.assertIsInstance(results[0], NoParseError)
+        self.assertEqual(repr(results[1].all()), repr(parse(self.p, "top", [], fail_if_empty=False).all()))
+        self.assertEqual(len(results[2]), 1)
+
+class CompactParseForestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = p = ParseRuleSet()
+        p.add(ParseRule("1", "top", [Terminal("a")]))
+        p.add(ParseRule("2", "top", [NonTerminal("top"), NonTerminal("top")]))
+        p.add(ParseRule("list", "list", [NonTerminal("top", star=True), Terminal("b", optional=True)]))
+
+    def test_count(self):
+        forest = parse(self.p, "top", ["a"] * 10)
+        compact = forest.compact()
+        self.assertEqual(compact.count(), 4862)
+        self.assertEqual(len(compact), 4862)
+        self.assertEqual(compact.internal_node_count, forest.internal_node_count)
+        self.assertEqual(compact.tokens, ["a"] * 10)
+
+    def test_trees(self):
+        forest = parse(self.p, "list", ["a", "a", "b"])
+        compact = forest.compact()
+        self.assertEqual(set(map(simplify_parse_tree, compact)), set(map(simplify_parse_tree, forest)))
+        self.assertEqual(set(map(simplify_parse_tree, compact.all())), set([
+            "(list: ((1: a) (1: a)) b)",
+            "(list: ((2: (1: a) (1: a))) b)",
+        ]))
+
+    def test_single(self):
+        tree = parse(self.p, "list", ["a", "b"]).compact().single()
+        self.assertEqual(unparse(tree), ["a", "b"])
+
+    def test_pickle(self):
+        import pickle
+        compact = parse(self.p, "list", ["a", "a", "a"]).compact()
+        self.assertEqual(pickle.loads(pickle.dumps(compact)).count(), compact.count())
+
+    def check_trimmed(self, p, head, tokens):
+        # Both kinds of forest must give the same answers after trimming
+        forest = parse(p, head, tokens)
+        compact = forest.compact()
+        self.assertEqual(compact.count(), forest.count())
+        self.assertEqual(sorted(map(repr, compact.all())), sorted(map(repr, forest.all())))
+        self.assertEqual(compact.is_ambiguous(), forest.is_ambiguous())
+        self.assertEqual(compact.ambiguities(), forest.ambiguities())
+        for rule in p:
+            self.assertEqual(compact.spans(rule.head), forest.spans(rule.head))
+        if forest.count() == 1:
+            self.assertEqual(repr(compact.single()), repr(forest.single()))
+        return compact
+
+    def test_trimmed(self):
+        # Greedy and penalty trimming remove every source of some nodes, which must not become rule starts
+        p = ParseRuleSet()
+        p.add(ParseRule("s1", "S", [NonTerminal("B"), NonTerminal("S")], penalty=1))
+        p.add(ParseRule("s2", "S", [NonTerminal("B", star=True)]))
+        p.add(ParseRule("s3", "S", []))
+        p.add(ParseRule("a1", "A", [Terminal("a", plus=True, greedy=True)]))
+        p.add(ParseRule("a2", "A", [], penalty=1))
+        p.add(ParseRule("b", "B", [NonTerminal("A"), Terminal("b", star=True)]))
+        compact = self.check_trimmed(p, "S", lex("a a a"))
+        self.assertEqual(simplify_parse_tree(compact.single()), "(s2: ((b: (a1: (a a a)) ())))")
+
+    def test_trimmed_repetition(self):
+        # Greedy trimming kills the branches where the star stops early, which must not count as ambiguities
+        p = ParseRuleSet()
+        p.add(ParseRule("top", "top", [NonTerminal("B")]))
+        p.add(ParseRule("b", "B", [Terminal("b"), Terminal("a", optional=True, greedy=True),
+                                   NonTerminal("B", star=True, greedy=True)]))
+        compact = self.check_trimmed(p, "top", lex("b b b"))
+        self.assertEqual(compact.spans("B"), [(0, 3), (1, 3), (2, 3)])
+
+    def test_trimmed_to_nothing(self):
+        p = ParseRuleSet()
+        p.add(ParseRule("s1", "S", [], penalty=1))
+        p.add(ParseRule("s2", "S", [NonTerminal("S", star=True, lazy=True), NonTerminal("B")], penalty=1))
+        p.add(ParseRule("s3", "S", [Terminal("a", optional=True), NonTerminal("B")], penalty=1))
+        p.add(ParseRule("b1", "B", [], penalty=1))
+        p.add(ParseRule("b2", "B", [], penalty=1))
+        p.add(ParseRule("b3", "B", [Terminal("b")]))
+        compact = self.check_trimmed(p, "S", lex("a b"))
+        self.assertEqual(compact.count(), 0)
+        self.assertEqual(compact.internal_node_count, 0)
+
+    def test_terminal_context(self):
+        contexts = []
+        class TerminalBuilder(axaxaxas.Builder):
+            def start_rule(self, context): pass
+            def end_rule(self, context, prev_value): pass
+            def extend(self, context, prev_value, extension_value): pass
+            def skip_optional(self, context, prev_value): pass
+            def begin_multiple(self, context, prev_value): pass
+            def end_multiple(self, context, prev_value): pass
+            def terminal(self, context, token):
+                contexts.append((context.rule.name, context.symbol_index, context.end_index, token))
+        parse(self.p, "list", ["a", "b"]).compact().apply(TerminalBuilder())
+        self.assertEqual(sorted(contexts), [("1", 0, 0, "a"), ("list", 1, 1, "b")])
+
+class ParseLimitsTestCase(unittest.TestCase):
+    def setUp(self):
+        # Highly ambiguous, O(n^3) grammar
+        self.p = p = ParseRuleSet()
+        p.add(ParseRule("1", "top", [Terminal("a")]))
+        p.add(ParseRule("2", "top", [NonTerminal("top"), NonTerminal("top")]))
+
+    def limit(self, limits, n, limit):
+        with self.assertRaises(ParseLimitError) as cm:
+            parse(self.p, "top", ["a"] * n, limits=limits).count()
+        self.assertEqual(cm.exception.limit, limit)
+        return cm.exception
+
+    def test_no_limits(self):
+        forest = parse(self.p, "top", ["a"] * 10, limits=ParseLimits(max_items=1000, max_sources=10, max_forest_nodes=1000))
+        self.assertEqual(forest.count(), 4862)
+        self.assertEqual(forest.stats.tokens, 10)
+        self.assertEqual(forest.stats.forest_nodes, forest.internal_node_count)
+
+    def test_max_items(self):
+        e = self.limit(ParseLimits(max_items=1000), 100, "max_items")
+        self.assertGreater(e.stats.items, 1000)
+        self.assertEqual(e.stats.tokens, e.start_index)
+
+    def test_max_sources(self):
+        self.limit(ParseLimits(max_sources=5), 100, "max_sources")
+
+    def test_max_forest_nodes(self):
+        self.limit(ParseLimits(max_forest_nodes=100), 20, "max_forest_nodes")
+
+    def test_timeout(self):
+        self.limit(ParseLimits(timeout=-1), 10, "timeout")
+
+    def test_timeout_reused(self):
+        # The clock starts again for each call
+        limits = ParseLimits(timeout=0.2)
+        parse(self.p, "top", ["a"] * 5, limits=limits).count()
+        session = ParseSession(self.p, "top", ["a"] * 5, limits=limits)
+        time.sleep(0.3)
+        forest = parse(self.p, "top", ["a"] * 5, limits=limits)
+        forest.count()
+        time.sleep(0.3)
+        self.assertEqual(forest.count(), 14)
+        session.feed("a")
+        self.assertEqual(session.forest().count(), 42)
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        timer = threading.Timer(0.1, cancel.set)
+        timer.start()
+        try:
+            e = self.limit(ParseLimits(cancel=cancel), 1000, "cancel")
+        finally:
+            timer.cancel()
+        self.assertLess(e.start_index, 1000)
+
+    def test_cancel_apply(self):
+        forest = parse(self.p, "top", ["a"] * 30)
+        cancel = threading.Event()
+        forest.limits = ParseLimits(cancel=cancel)
+        forest.count()
+        cancel.set()
+        with self.assertRaises(ParseLimitError):
+            forest.count()
+
+    def test_long_column(self):
+        # Limits are checked while a column is processed, not just once it's finished
+        p = ParseRuleSet()
+        for i in range(5000):
+            p.add(ParseRule(str(i), str(i), [NonTerminal(str(i + 1))]))
+        p.add(ParseRule("end", "5000", [Terminal("a")]))
+        with self.assertRaises(ParseLimitError) as cm:
+            parse(p, "0", ["a"], limits=ParseLimits(max_items=1000))
+        self.assertEqual(cm.exception.limit, "max_items")
+        self.assertEqual(cm.exception.start_index, 0)
+        self.assertLess(cm.exception.stats.items, 2000)
+        session = ParseSession(p, "0", limits=ParseLimits(max_items=8000))
+        with self.assertRaises(ParseLimitError):
+            session.feed("a")
+        # The half processed column was dropped, so it's parsed again from scratch
+        session.limits = None
+        session.extend([])
+        self.assertEqual(session.forest().count(), 1)
+
+    def test_session(self):
+        session = ParseSession(self.p, "top", ["a"] * 10, limits=ParseLimits(max_items=2000))
+        items = session.stats.items
+        session.rollback(5)
+        self.assertLess(session.stats.items, items)
+        with self.assertRaises(ParseLimitError):
+            session.extend(["a"] * 100)
+        self.assertRaises(ParseLimitError, session.forest)
+        session.rollback(5)
+        self.assertEqual(session.forest().count(), 14)
+
 if __name__ == '__main__':
     unittest.main()
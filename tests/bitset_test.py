@@ -0,0 +1,96 @@
+from axaxaxas import ParseRule, ParseRuleSet, Terminal as T, NonTerminal as NT, CharacterClass, NoParseError, InfiniteParseError, parse
+import itertools
+import random
+import unittest
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    from axaxaxas.bitset import BitsetRecognizer
+
+
+def parses(grammar, head, tokens):
+    try:
+        parse(grammar, head, tokens)
+        return True
+    except NoParseError:
+        return False
+    except InfiniteParseError:
+        # The tokens are recognized, there are just infinitely many ways to parse them
+        return True
+
+
+@unittest.skipUnless(numpy, "numpy is not installed")
+class BitsetRecognizerTest(unittest.TestCase):
+    def check_all(self, grammar, head, alphabet, max_length):
+        # Compares with the ordinary parser for every input up to max_length tokens
+        recognizer = BitsetRecognizer(grammar, head)
+        for length in range(max_length + 1):
+            for tokens in itertools.product(alphabet, repeat=length):
+                self.assertEqual(recognizer.accepts(tokens), parses(grammar, head, tokens), tokens)
+
+    def test_expressions(self):
+        grammar = ParseRuleSet()
+        grammar.add(ParseRule("expr", [NT("expr"), T("+"), NT("expr")]))
+        grammar.add(ParseRule("expr", [T("("), NT("expr"), T(")")]))
+        grammar.add(ParseRule("expr", [T("x")]))
+        self.check_all(grammar, "expr", ["x", "+", "(", ")"], 7)
+
+    def test_repetition(self):
+        grammar = ParseRuleSet()
+        grammar.add(ParseRule("top", [T("a", star=True), NT("b", plus=True), NT("c", optional=True)]))
+        grammar.add(ParseRule("b", [T("b"), T("a", optional=True)]))
+        grammar.add(ParseRule("c", [T("c"), NT("top", star=True)]))
+        self.check_all(grammar, "top", ["a", "b", "c"], 7)
+
+    def test_nullable(self):
+        grammar = ParseRuleSet()
+        grammar.add(ParseRule("top", [NT("empty"), NT("list"), NT("empty"), T("x")]))
+        grammar.add(ParseRule("empty", []))
+        grammar.add(ParseRule("empty", [NT("empty"), NT("empty")]))
+        grammar.add(ParseRule("list", [NT("list"), NT("item")]))
+        grammar.add(ParseRule("list", []))
+        grammar.add(ParseRule("item", [NT("empty"), T("y")]))
+        grammar.add(ParseRule("item", [NT("list"), T("z"), NT("list")]))
+        self.check_all(grammar, "top", ["x", "y", "z"], 6)
+
+    def test_custom_terminals(self):
+        grammar = ParseRuleSet()
+        grammar.add(ParseRule("word", [CharacterClass("", ranges=[("a", "z")], plus=True)]))
+        grammar.add(ParseRule("word", [T("a"), T("1")]))
+        self.check_all(grammar, "word", ["a", "b", "1", ["a"]], 4)
+
+    def test_random(self):
+        grammar = ParseRuleSet()
+        grammar.add(ParseRule("program", [NT("stmt", star=True)]))
+        grammar.add(ParseRule("stmt", [T("id"), T("="), NT("expr"), T(";")]))
+        grammar.add(ParseRule("stmt", [T("{"), NT("program"), T("}")]))
+        grammar.add(ParseRule("expr", [NT("expr"), T("+"), NT("expr")]))
+        grammar.add(ParseRule("expr", [T("id")]))
+        recognizer = BitsetRecognizer(grammar, "program")
+        rng = random.Random(0)
+        alphabet = ["id", "=", ";", "{", "}", "+"]
+        valid = "id = id + id ; { id = id ; { } } id = id ;".split()
+        for i in range(200):
+            tokens = list(valid)
+            for j in range(rng.randrange(3)):
+                tokens[rng.randrange(len(tokens))] = rng.choice(alphabet)
+            self.assertEqual(recognizer.accepts(tokens), parses(grammar, "program", tokens), tokens)
+
+    def test_recognize(self):
+        grammar = ParseRuleSet()
+        grammar.add(ParseRule("top", [T("a"), NT("rest", star=True)]))
+        grammar.add(ParseRule("rest", [T("b"), T("c")]))
+        recognizer = BitsetRecognizer(grammar, "top")
+        self.assertIsNone(recognizer.recognize(iter(["a", "b", "c"])))
+        for tokens in [["a", "b", "b"], ["a", "b"], ["b"], []]:
+            with self.assertRaises(NoParseError) as expected:
+                parse(grammar, "top", tokens)
+            with self.assertRaises(NoParseError) as actual:
+                recognizer.recognize(iter(tokens))
+            self.assertEqual(str(actual.exception), str(expected.exception))
+            self.assertEqual(actual.exception.start_index, expected.exception.start_index)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -105,7 +105,7 @@ class Builder(unittest.TestCase):
     v6 = builder.terminal({rule1, 0}, 'a')
     v7 = builder.extend({rule1, 0}, v5, v6)
     v8 = builder.extend({rule1, 1}, v7, v4)
-    v9 = builder.terminal({rule1, 1}, 'c')
+    v9 = builder.terminal({rule1, 2}, 'c')
     v10 = builder.extend({rule1, 2}, v8, v9)
     v11 = builder.end_rule({rule1, 3}, v10)
         """)
@@ -155,5 +155,29 @@ class Builder(unittest.TestCase):
     v20 = builder.end_rule({sentence, 2}, v19)
         """)
 
+    def test_terminal_contexts(self):
+        # Both kinds of forest pass the same context to terminal
+        stmt = ParseRule("stmt", [T("a"), NT("expr", star=True), T("b", optional=True), T("c")])
+        expr = ParseRule("expr", [T("x"), T("y", plus=True)])
+        grammar = ParseRuleSet()
+        grammar.add(stmt)
+        grammar.add(expr)
+        forest = parse(grammar, "stmt", "a x y y x y c".split())
+        contexts = []
+        for f in [forest, forest.compact()]:
+            builder = LoggingBuilder({"stmt": stmt, "expr": expr})
+            builder.terminal = lambda context, token: (token, context.rule.head, context.symbol_index,
+                                                       context.start_index, context.end_index)
+            builder.extend = lambda context, prev_value, extension_value: prev_value + [extension_value]
+            builder.start_rule = lambda context: []
+            builder.begin_multiple = builder.end_multiple = builder.skip_optional = lambda context, prev_value: prev_value
+            builder.end_rule = lambda context, prev_value: prev_value
+            contexts.append(f.apply(builder))
+        self.assertEqual(contexts[0], contexts[1])
+        self.assertEqual(contexts[0][0], ("a", "stmt", 0, 0, 0))
+        self.assertEqual(contexts[0][1][2], ("y", "expr", 1, 1, 3))
+        self.assertEqual(contexts[0][-1], ("c", "stmt", 3, 0, 6))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,175 @@
+from axaxaxas import ParseRule, ParseRuleSet, Terminal as T, NonTerminal as NT, NoParseError, SingleParseTreeBuilder, parse, unparse
+from axaxaxas import CountingBuilder, ParseLimits, ParseLimitError, Vocabulary, make_list_builder
+from axaxaxas.cache import ParseCache
+import gc
+import shutil
+import tempfile
+import unittest
+import weakref
+
+
+class ParseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.grammar = grammar = ParseRuleSet()
+        grammar.add(ParseRule("list", [NT("item", star=True)]))
+        grammar.add(ParseRule("item", [T("a")]))
+        grammar.add(ParseRule("item", [T("("), NT("list"), T(")")]))
+        self.tokens = "( a a ) a".split()
+
+    def test_memory(self):
+        cache = ParseCache()
+        forest = cache.parse(self.grammar, "list", self.tokens)
+        self.assertIs(cache.parse(self.grammar, "list", iter(self.tokens)), forest)
+        self.assertEqual(unparse(forest.single()), self.tokens)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate, 0.5)
+
+    def test_version(self):
+        cache = ParseCache()
+        version = self.grammar.version
+        forest = cache.parse(self.grammar, "list", self.tokens)
+        self.grammar.add(ParseRule("item", [T("b")]))
+        self.assertNotEqual(self.grammar.version, version)
+        self.assertIsNot(cache.parse(self.grammar, "list", self.tokens), forest)
+        self.assertEqual(cache.misses, 2)
+
+    def test_lru(self):
+        cache = ParseCache(maxsize=2)
+        cache.parse(self.grammar, "list", ["a"])
+        cache.parse(self.grammar, "list", ["a", "a"])
+        cache.parse(self.grammar, "list", ["a"])
+        cache.parse(self.grammar, "list", ["a", "a", "a"])
+        cache.parse(self.grammar, "list", ["a"])
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+        cache.parse(self.grammar, "list", ["a", "a"])
+        self.assertEqual(cache.misses, 4)
+
+    def test_errors_not_cached(self):
+        cache = ParseCache()
+        for i in range(2):
+            with self.assertRaises(NoParseError):
+                cache.parse(self.grammar, "list", ["("])
+        self.assertEqual(cache.misses, 2)
+
+    def test_builder(self):
+        cache = ParseCache()
+        tree = cache.apply(self.grammar, "list", self.tokens, SingleParseTreeBuilder())
+        self.assertIs(cache.apply(self.grammar, "list", self.tokens, SingleParseTreeBuilder()), tree)
+        self.assertIsNot(cache.parse(self.grammar, "list", self.tokens), tree)
+
+    def test_fail_if_empty(self):
+        grammar = ParseRuleSet()
+        grammar.add(ParseRule("s", [T("a"), T("b")]))
+        directory = tempfile.mkdtemp()
+        try:
+            cache = ParseCache(directory=directory)
+            cache.parse(grammar, "s", ["a"], fail_if_empty=False)
+            for cache in [cache, ParseCache(directory=directory)]:
+                with self.assertRaises(NoParseError):
+                    cache.parse(grammar, "s", ["a"])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_limits(self):
+        cache = ParseCache()
+        cache.parse(self.grammar, "list", self.tokens)
+        with self.assertRaises(ParseLimitError):
+            cache.parse(self.grammar, "list", self.tokens, limits=ParseLimits(max_items=1))
+        self.assertEqual(cache.misses, 2)
+
+    def test_vocabulary(self):
+        cache = ParseCache()
+        vocabulary = Vocabulary.from_rule_set(self.grammar)
+        forest = cache.parse(self.grammar, "list", self.tokens, vocabulary=vocabulary)
+        self.assertEqual(unparse(forest.single()), self.tokens)
+        self.assertIsNot(cache.parse(self.grammar, "list", self.tokens), forest)
+        self.assertEqual(cache.misses, 2)
+
+    def test_encoded(self):
+        cache = ParseCache()
+        vocabulary = Vocabulary.from_rule_set(self.grammar)
+        token_ids = vocabulary.encode(self.tokens)
+        cache.parse(self.grammar, "list", self.tokens)
+        forest = cache.parse(self.grammar, "list", token_ids, vocabulary=vocabulary, encoded=True)
+        self.assertEqual(unparse(forest.single()), self.tokens)
+        self.assertEqual(cache.misses, 2)
+
+    def test_builder_key(self):
+        cache = ParseCache()
+        self.assertEqual(cache.apply(self.grammar, "list", self.tokens, make_list_builder(CountingBuilder())), [1])
+        trees = cache.apply(self.grammar, "list", self.tokens, make_list_builder(SingleParseTreeBuilder()))
+        self.assertEqual(unparse(trees[0]), self.tokens)
+
+    def test_fingerprints_released(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = ParseCache(maxsize=0, directory=directory)
+            grammar = ParseRuleSet()
+            grammar.add(ParseRule("s", [T("a")]))
+            cache.parse(grammar, "s", ["a"])
+            self.assertEqual(len(cache._fingerprints), 1)
+            del grammar
+            gc.collect()
+            self.assertEqual(len(cache._fingerprints), 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_rule_sets_released(self):
+        cache = ParseCache()
+        grammar = ParseRuleSet()
+        grammar.add(ParseRule("s", [T("a")]))
+        frozen_grammar = grammar.freeze()
+        cache.parse(grammar, "s", ["a"])
+        self.assertIs(cache.parse(frozen_grammar, "s", ["a"]), cache.parse(frozen_grammar, "s", ["a"]))
+        grammar, frozen_grammar = weakref.ref(grammar), weakref.ref(frozen_grammar)
+        gc.collect()
+        self.assertIsNone(grammar())
+        self.assertIsNone(frozen_grammar())
+        self.assertEqual(len(cache._rule_set_keys), 0)
+
+    def test_disk(self):
+        directory = tempfile.mkdtemp()
+        try:
+            tree = ParseCache(directory=directory).apply(self.grammar, "list", self.tokens, SingleParseTreeBuilder())
+            cache = ParseCache(directory=directory)
+            loaded = cache.apply(self.grammar, "list", self.tokens, SingleParseTreeBuilder())
+            self.assertEqual(cache.hits, 1)
+            self.assertEqual(repr(loaded), repr(tree))
+            # Rules are loaded as references to the grammar's own rules
+            self.assertIs(loaded.rule, tree.rule)
+
+            forest = ParseCache(directory=directory).parse(self.grammar, "list", self.tokens)
+            self.assertEqual(forest.count(), 1)
+
+            # A different grammar doesn't share entries
+            self.grammar.add(ParseRule("item", [T("b")]))
+            cache = ParseCache(directory=directory)
+            cache.parse(self.grammar, "list", self.tokens)
+            self.assertEqual(cache.misses, 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_trimmed(self):
+        # Cached forests must have the same trees as the parse, after penalty and greedy trimming
+        grammar = ParseRuleSet()
+        grammar.add(ParseRule("S", [NT("B"), NT("S")], penalty=1))
+        grammar.add(ParseRule("S", [NT("B", star=True)]))
+        grammar.add(ParseRule("S", []))
+        grammar.add(ParseRule("A", [T("a", plus=True, greedy=True)]))
+        grammar.add(ParseRule("A", [], penalty=1))
+        grammar.add(ParseRule("B", [NT("A"), T("b", star=True)]))
+        tokens = "a a a".split()
+        expected = parse(grammar, "S", tokens)
+        directory = tempfile.mkdtemp()
+        try:
+            ParseCache(directory=directory).parse(grammar, "S", tokens)
+            for cache in [ParseCache(), ParseCache(directory=directory)]:
+                forest = cache.parse(grammar, "S", tokens)
+                self.assertEqual(forest.count(), expected.count())
+                self.assertEqual(sorted(map(repr, forest.all())), sorted(map(repr, expected.all())))
+            self.assertEqual(cache.hits, 1)
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+from axaxaxas import ParseRule, ParseRuleSet, Terminal as T, NonTerminal as NT, RegexTerminal as R, NoParseError, parse, unparse
+from axaxaxas.lexer import Lexer, LexError
+import re
+import unittest
+
+
+class LexerTest(unittest.TestCase):
+    def setUp(self):
+        self.grammar = grammar = ParseRuleSet()
+        grammar.add(ParseRule("stmt", [T("if"), NT("expr"), T("then"), NT("stmt")]))
+        grammar.add(ParseRule("stmt", [R("[a-z_]+"), T(":="), NT("expr"), T(";")]))
+        grammar.add(ParseRule("expr", [NT("atom"), NT("tail", star=True)]))
+        grammar.add(ParseRule("tail", [T("+"), NT("atom")]))
+        grammar.add(ParseRule("tail", [T("++"), NT("atom")]))
+        grammar.add(ParseRule("atom", [R("[a-z_]+")]))
+        grammar.add(ParseRule("atom", [R("[0-9]+")]))
+        self.lexer = Lexer(grammar)
+
+    def test_vocabulary(self):
+        self.assertEqual(self.lexer.literals, frozenset(["if", "then", ":=", ";", "+", "++"]))
+        self.assertEqual(self.lexer.patterns, ["[a-z_]+", "[0-9]+"])
+
+    def test_tokenize(self):
+        tokens = list(self.lexer.tokenize("if iffy then x := 1 ++ 22;"))
+        self.assertEqual(tokens, ["if", "iffy", "then", "x", ":=", "1", "++", "22", ";"])
+        self.assertEqual([t.kind for t in tokens],
+                         [None, "[a-z_]+", None, "[a-z_]+", None, "[0-9]+", None, "[0-9]+", None])
+        self.assertEqual(tokens[1].start, 3)
+        self.assertEqual(tokens[1].end, 7)
+
+    def test_parse(self):
+        text = "if a then if b then x := y + 1;"
+        tree = parse(self.grammar, "stmt", self.lexer.tokenize(text)).single()
+        self.assertEqual(" ".join(unparse(tree)), text.replace(";", " ;"))
+
+    def test_keyword_is_not_identifier(self):
+        # "if" is lexed as a keyword, so can't be used as a variable name
+        with self.assertRaises(NoParseError):
+            parse(self.grammar, "stmt", self.lexer.tokenize("if := 1;")).single()
+
+    def test_lex_error(self):
+        with self.assertRaises(LexError) as cm:
+            list(self.lexer.tokenize("x := 1 $ 2;"))
+        self.assertEqual(cm.exception.start_index, 7)
+
+    def test_extra_terminals_and_ignore(self):
+        lexer = Lexer(self.grammar, [R("#.*")], ignore=r"[ \t\n]+")
+        tokens = list(lexer.tokenize("x := 1; # done"))
+        self.assertEqual(tokens, ["x", ":=", "1", ";", "# done"])
+
+    def test_overlapping_patterns(self):
+        # Tokens found by the first pattern still match the second
+        grammar = ParseRuleSet()
+        grammar.add(ParseRule("program", [NT("stmt", star=True)]))
+        grammar.add(ParseRule("stmt", [R("[a-z]+"), T("="), NT("expr"), T(";")]))
+        grammar.add(ParseRule("expr", [R("[a-z0-9]+"), NT("tail", star=True)]))
+        grammar.add(ParseRule("tail", [T("+"), R("[a-z0-9]+")]))
+        text = "a = 1 ; b = a + 2 ;"
+        tokens = list(Lexer(grammar).tokenize(text))
+        self.assertEqual([t.kind for t in tokens[:3]], ["[a-z]+", None, "[a-z0-9]+"])
+        self.assertEqual(parse(grammar, "program", tokens).count(), 1)
+        self.assertEqual(parse(grammar, "program", tokens).single(), parse(grammar, "program", text.split()).single())
+
+    def test_terminal_flags(self):
+        grammar = ParseRuleSet()
+        grammar.add(ParseRule("words", [R("[a-z]+", re.I), R("[a-z]+"), R("[0-9]+ # digits", re.X)]))
+        lexer = Lexer(grammar)
+        self.assertEqual(lexer.patterns, ["[a-z]+", "[a-z]+", "[0-9]+ # digits"])
+        tokens = list(lexer.tokenize("ABC def 12"))
+        self.assertEqual(tokens, ["ABC", "def", "12"])
+        self.assertEqual(parse(grammar, "words", tokens).count(), 1)
+        with self.assertRaises(NoParseError):
+            parse(grammar, "words", lexer.tokenize("ABC DEF 12"))
+
+    def test_regex_terminal_untagged(self):
+        # Without the lexer, RegexTerminal matches plain strings
+        self.assertTrue(R("[0-9]+").match("123"))
+        self.assertFalse(R("[0-9]+").match("123a"))
+        self.assertFalse(R("[0-9]+").match(123))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+from axaxaxas import ParseRule, ParseRuleSet, Terminal as T, NonTerminal as NT, RegexTerminal as R, NoParseError, CountingBuilder, parse
+from axaxaxas.parallel import parse_parallel
+import unittest
+
+
+class ParseParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.grammar = grammar = ParseRuleSet()
+        grammar.add(ParseRule("program", [NT("stmt", star=True)]))
+        grammar.add(ParseRule("stmt", [R("[a-z]+"), T("="), NT("expr"), T(";")]))
+        grammar.add(ParseRule("stmt", [T("{"), NT("stmt", star=True), T("}")]))
+        grammar.add(ParseRule("expr", [R("[a-z0-9]+"), NT("tail", star=True)]))
+        grammar.add(ParseRule("tail", [T("+"), R("[a-z0-9]+")]))
+        self.sync = {";", "}"}
+
+    def check(self, text, **kwargs):
+        tokens = text.split()
+        expected = parse(self.grammar, "program", tokens).single()
+        tree = parse_parallel(self.grammar, "program", tokens, self.sync, **kwargs)
+        self.assertEqual(tree, expected)
+        # The rules are those of the grammar, not copies
+        for child in tree.children[0]:
+            self.assertIn(child.rule, list(self.grammar))
+
+    def test_processes(self):
+        self.check("a = 1 ; b = a + 2 ; " * 50, processes=2, chunk_size=20)
+
+    def test_serial(self):
+        self.check("a = 1 ; b = a + 2 ; " * 5, processes=1, chunk_size=3)
+        self.check("", processes=1)
+
+    def test_nested(self):
+        # The ; and } inside blocks don't end a statement, so chunks must be joined
+        text = "a = 1 ; { b = 2 ; { c = 3 ; } d = 4 ; } e = 5 ; " * 10
+        self.check(text, processes=2, chunk_size=4)
+        self.check(text, processes=1, chunk_size=1)
+
+    def test_builder(self):
+        tokens = ("a = 1 ; { b = 2 ; } " * 10).split()
+        count = parse_parallel(self.grammar, "program", tokens, self.sync, builder=CountingBuilder(),
+                               processes=1, chunk_size=5)
+        self.assertEqual(count, 1)
+
+    def test_errors(self):
+        for text in ["a = 1 ; b = = 2 ; c = 3 ;", "a = 1 ; { b = 2 ;", "a = 1 ; b"]:
+            with self.assertRaises(NoParseError) as serial:
+                parse(self.grammar, "program", text.split())
+            with self.assertRaises(NoParseError) as parallel:
+                parse_parallel(self.grammar, "program", text.split(), self.sync, processes=1, chunk_size=2)
+            self.assertEqual(parallel.exception.start_index, serial.exception.start_index)
+            self.assertEqual(str(parallel.exception), str(serial.exception))
+
+    def test_plus(self):
+        self.grammar.add(ParseRule("some", [NT("stmt", plus=True)]))
+        with self.assertRaises(NoParseError):
+            parse_parallel(self.grammar, "some", [], self.sync, processes=1)
+        tree = parse_parallel(self.grammar, "some", "a = 1 ;".split(), self.sync, processes=1)
+        self.assertEqual(tree, parse(self.grammar, "some", "a = 1 ;".split()).single())
+
+    def test_not_repetition(self):
+        with self.assertRaises(ValueError):
+            parse_parallel(self.grammar, "stmt", "a = 1 ;".split(), self.sync)
+
+if __name__ == '__main__':
+    unittest.main()